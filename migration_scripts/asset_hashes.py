@@ -0,0 +1,220 @@
+"""
+
+Persistent content hash index of Contentful assets.
+
+Maps the SHA-256 of an asset file to the id of the asset holding it, in one
+JSON file. add_asset hashes the EPI image while downloading it once and
+reuses the asset with the same hash instead of creating a copy. Assets are
+added when the sync creates them, existing assets are added once with
+
+    python asset_hashes.py backfill
+
+which downloads and hashes the file of every asset in the environment.
+Hashes of EPI images are kept per URL for the run, so an image is
+downloaded at most once per run.
+
+SYNC_ASSET_HASH_INDEX   index file, empty to disable (default .asset_hashes.json)
+
+"""
+import atexit
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+import asset_probe
+
+INDEX_PATH = os.environ.get(
+    "SYNC_ASSET_HASH_INDEX",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".asset_hashes.json"),
+)
+CHUNK_SIZE = 64 * 1024
+TIMEOUT = (10, 120)
+
+_lock = threading.Lock()
+_index = None
+_dirty = False
+_url_hashes = {}
+_stats = {"hashed": 0, "bytes": 0, "reused": 0}
+
+
+def is_enabled():
+    return bool(INDEX_PATH)
+
+
+def _load():
+    global _index
+    if _index is None:
+        try:
+            with open(INDEX_PATH, "r") as f:
+                _index = json.load(f)
+        except FileNotFoundError:
+            _index = {}
+        except (OSError, ValueError) as e:
+            logging.error("Could not read asset hash index, starting empty: %s" % e)
+            _index = {}
+    return _index
+
+
+def hash_url(url):
+    """
+    Return (SHA-256 hex digest, size) of the file at given URL, computed
+    while streaming it. Raises when it can't be downloaded.
+    """
+
+    with _lock:
+        if url in _url_hashes:
+            return _url_hashes[url]
+
+    digest = hashlib.sha256()
+    size = 0
+    with asset_probe.get_session().get(url, stream=True, timeout=TIMEOUT) as resp:
+        resp.raise_for_status()
+        for chunk in resp.iter_content(CHUNK_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+
+    return remember(url, digest.hexdigest(), size)
+
+
+def remember(url, digest, size):
+    """Keep the hash of a file downloaded elsewhere, e.g. by image_resize"""
+
+    result = (digest, size)
+    with _lock:
+        _url_hashes[url] = result
+        _stats["hashed"] += 1
+        _stats["bytes"] += size
+    return result
+
+
+def lookup(digest):
+    """Return the id of the asset with given content hash, None if unknown"""
+
+    if not is_enabled():
+        return None
+    with _lock:
+        return _load().get(digest)
+
+
+def add(digest, asset_id):
+    global _dirty
+    if not is_enabled():
+        return
+    with _lock:
+        index = _load()
+        if index.get(digest) != asset_id:
+            index[digest] = asset_id
+            _dirty = True
+
+
+def remove(digest):
+    """Drop a hash whose asset doesn't exist anymore"""
+
+    global _dirty
+    if not is_enabled():
+        return
+    with _lock:
+        if _load().pop(digest, None) is not None:
+            _dirty = True
+
+
+def count_reuse():
+    with _lock:
+        _stats["reused"] += 1
+
+
+def save():
+    """Write the index if it changed"""
+
+    global _dirty
+    if not is_enabled():
+        return
+    with _lock:
+        if not _dirty:
+            return
+        data = json.dumps(_index, sort_keys=True).encode("utf-8")
+        _dirty = False
+    tmp_path = "%s.%s.tmp" % (INDEX_PATH, threading.get_ident())
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, INDEX_PATH)
+    except OSError as e:
+        logging.error("Could not save asset hash index, error: %s" % e)
+
+
+atexit.register(save)
+
+
+def reset_stats():
+    with _lock:
+        _url_hashes.clear()
+        for key in _stats:
+            _stats[key] = 0
+
+
+def log_stats():
+    if not is_enabled():
+        return
+    save()
+    with _lock:
+        stats = dict(_stats)
+        size = len(_index or {})
+    logging.info(
+        "Asset hashes: %s images hashed (%.1f MB), %s assets reused, %s hashes indexed"
+        % (stats["hashed"], stats["bytes"] / 1e6, stats["reused"], size)
+    )
+
+
+def backfill(environment, locale):
+    """Hash the files of all assets of given environment missing in the index"""
+
+    with _lock:
+        known = set(_load().values())
+    skip = 0
+    added = 0
+    while True:
+        assets = environment.assets().all(
+            query={"select": "sys.id,fields.file", "limit": 100, "skip": skip}
+        )
+        for asset in assets:
+            if asset.id in known:
+                continue
+            asset_file = asset.fields(locale).get("file") or {}
+            if not asset_file.get("url"):
+                continue
+            try:
+                digest, _ = hash_url("https:" + asset_file["url"])
+            except Exception as e:
+                logging.error("Could not hash asset %s, error: %s" % (asset.id, e))
+                continue
+            # the first asset with a file wins, like the size match did
+            if lookup(digest) is None:
+                add(digest, asset.id)
+                added += 1
+        skip += len(assets)
+        save()
+        logging.info("Hashed %s assets, %s added to the index" % (skip, added))
+        if len(assets) < 100:
+            return added
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] != ["backfill"]:
+        print("Usage: python asset_hashes.py backfill")
+        sys.exit(1)
+
+    import config
+    import helpers
+
+    logging.getLogger().setLevel(logging.INFO)
+    backfill(
+        helpers.create_contentful_environment(
+            config.CTFL_SPACE_ID, config.CTFL_ENV_ID, config.CTFL_MGMT_API_KEY
+        ),
+        config.DEFAULT_LOCALE,
+    )
+    log_stats()
@@ -0,0 +1,105 @@
+"""
+
+Content type and size of asset files, without downloading them.
+
+The sync compares EPI images with the files of existing assets by size and
+needs the content type of new ones. probe() asks with a HEAD request and
+falls back to a GET of the first byte when a server doesn't answer HEAD or
+leaves out the length, reading the total size from Content-Range. All
+requests go through one pooled keep-alive session and their responses are
+closed. Results are kept per URL until reset(), once per run, so syncing
+the same images again costs no request.
+
+SYNC_ASSET_POOL_SIZE   keep-alive connections per host (default 10)
+
+"""
+import logging
+import os
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+POOL_SIZE = int(os.environ.get("SYNC_ASSET_POOL_SIZE", 10))
+TIMEOUT = (10, 60)
+
+_lock = threading.Lock()
+_session = None
+_cache = {}
+_stats = {"probes": 0, "cached": 0, "range_fallbacks": 0}
+
+
+def get_session():
+    """Return the keep-alive session shared by asset downloads and probes"""
+
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _size_from_content_range(value):
+    # "bytes 0-0/12345", the total is "*" when the server doesn't know it
+    total = (value or "").rpartition("/")[2]
+    return int(total) if total.isdigit() else None
+
+
+def _probe(url):
+    session = get_session()
+    with session.head(url, allow_redirects=True, timeout=TIMEOUT) as resp:
+        if resp.ok and "Content-Length" in resp.headers:
+            return resp.headers.get("Content-Type"), int(resp.headers["Content-Length"])
+
+    with _lock:
+        _stats["range_fallbacks"] += 1
+    with session.get(
+        url, headers={"Range": "bytes=0-0"}, stream=True, timeout=TIMEOUT
+    ) as resp:
+        resp.raise_for_status()
+        content_type = resp.headers.get("Content-Type")
+        if resp.status_code == 206:
+            return content_type, _size_from_content_range(
+                resp.headers.get("Content-Range")
+            )
+        # the server ignored the range, the length is the whole file
+        return content_type, int(resp.headers.get("Content-Length", 0))
+
+
+def probe(url):
+    """
+    Return (content type, size in bytes) of the file at given URL, the size
+    is None when the server doesn't tell. Raises when the URL can't be read.
+    """
+
+    with _lock:
+        if url in _cache:
+            _stats["cached"] += 1
+            return _cache[url]
+
+    result = _probe(url)
+    with _lock:
+        _stats["probes"] += 1
+        _cache[url] = result
+    return result
+
+
+def reset():
+    """Forget the probed URLs, files may have changed since the last run"""
+
+    with _lock:
+        _cache.clear()
+        for key in _stats:
+            _stats[key] = 0
+
+
+def log_stats():
+    with _lock:
+        stats = dict(_stats)
+    logging.info(
+        "Asset probes: %(probes)s files probed (%(range_fallbacks)s with a range GET), "
+        "%(cached)s answered from the run cache" % stats
+    )
@@ -0,0 +1,265 @@
+"""
+
+Tracking of assets Contentful is processing.
+
+create_asset and add_asset create an asset and ask Contentful to process
+its file, which happens asynchronously. Every asset sent for processing is
+tracked and a background thread polls the tracked assets in batches, one
+sys.id[in] query for up to 100 of them. An asset that isn't processed yet
+is checked again later, waiting twice as long each time. Processed assets
+are added to a publish queue as soon as they're ready, so a sync publishes
+its assets itself instead of leaving them to publish_imported_assets.py.
+Assets still not processed after SYNC_ASSET_PROCESSING_TIMEOUT seconds are
+given up and reported.
+
+    asset_processing.start(environment)     # at the start of a run
+    asset_processing.track(environment, asset)
+    asset_processing.finish(environment)    # waits, publishes, logs timings
+
+Runs syncing the same environment at the same time share one tracker, it
+stops when the last of them finishes. Runs call finish() in a finally
+block, so a failed run doesn't keep the tracker alive.
+
+SYNC_ASSET_PROCESSING_TIMEOUT   seconds to wait for an asset (default 300)
+
+"""
+import logging
+import os
+import threading
+import time
+
+import config
+import publish_queue
+
+BATCH_SIZE = 100
+FIRST_INTERVAL = 1.0
+MAX_INTERVAL = 30.0
+TIMEOUT = float(os.environ.get("SYNC_ASSET_PROCESSING_TIMEOUT", 300))
+
+_lock = threading.Lock()
+_trackers = {}
+
+
+def is_processed(asset):
+    """True when the file of the asset is processed in every locale it has one"""
+
+    files = [
+        fields.get("file") for fields in asset._fields.values() if fields.get("file")
+    ]
+    return bool(files) and all(asset_file.get("url") for asset_file in files)
+
+
+class ProcessingTracker:
+    """Polls the assets of one environment until they're processed"""
+
+    def __init__(self, environment, queue):
+        self.environment = environment
+        self.queue = queue
+        self.users = 0
+        self.pending = {}
+        self.timings = {}
+        self.timed_out = []
+        self.counters = {"polls": 0}
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._thread = None
+
+    def track(self, asset):
+        now = time.monotonic()
+        with self._condition:
+            self.pending[asset.id] = {
+                "tracked_at": now,
+                "next_check": now + FIRST_INTERVAL,
+                "interval": FIRST_INTERVAL,
+            }
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="asset-processing", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify_all()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                if self._stopping and not self.pending:
+                    return
+                now = time.monotonic()
+                due = [
+                    asset_id
+                    for asset_id, state in self.pending.items()
+                    if state["next_check"] <= now
+                ][:BATCH_SIZE]
+                if not due:
+                    next_check = min(
+                        (state["next_check"] for state in self.pending.values()),
+                        default=now + MAX_INTERVAL,
+                    )
+                    self._condition.wait(max(0.05, next_check - now))
+                    continue
+            try:
+                self._poll(due)
+            except Exception as e:
+                # the thread must keep running, finish() waits for it
+                logging.error("Asset processing poll failed, error: %s" % e)
+                self._postpone(due)
+
+    def _postpone(self, asset_ids):
+        with self._condition:
+            now = time.monotonic()
+            for asset_id in asset_ids:
+                state = self.pending.get(asset_id)
+                if state is not None:
+                    state["interval"] = min(state["interval"] * 2, MAX_INTERVAL)
+                    state["next_check"] = now + state["interval"]
+
+    def _poll(self, asset_ids):
+        try:
+            assets = self.environment.assets().all(
+                query={"sys.id[in]": ",".join(asset_ids), "limit": len(asset_ids)}
+            )
+            found = {asset.id: asset for asset in assets}
+        except Exception as e:
+            logging.error("Could not check asset processing, error: %s" % e)
+            found = {}
+
+        ready = []
+        now = time.monotonic()
+        with self._condition:
+            self.counters["polls"] += 1
+            for asset_id in asset_ids:
+                state = self.pending.get(asset_id)
+                if state is None:
+                    continue
+                asset = found.get(asset_id)
+                if asset is not None and is_processed(asset):
+                    del self.pending[asset_id]
+                    self.timings[asset_id] = now - state["tracked_at"]
+                    ready.append(asset)
+                elif now - state["tracked_at"] > TIMEOUT:
+                    del self.pending[asset_id]
+                    self.timed_out.append(asset_id)
+                    logging.error(
+                        "Asset %s not processed after %ss, not published"
+                        % (asset_id, TIMEOUT)
+                    )
+                else:
+                    state["interval"] = min(state["interval"] * 2, MAX_INTERVAL)
+                    state["next_check"] = now + state["interval"]
+            self._condition.notify_all()
+
+        for asset in ready:
+            logging.info(
+                "Asset %s processed in %.1fs" % (asset.id, self.timings[asset.id])
+            )
+            try:
+                self.queue.add(asset)
+            except Exception as e:
+                logging.error("Could not publish asset %s, error: %s" % (asset.id, e))
+
+    def wait(self):
+        """
+        Wait until every tracked asset is processed or given up, at most
+        TIMEOUT seconds after the last one was tracked
+        """
+
+        with self._condition:
+            while self.pending:
+                if self._thread is None or not self._thread.is_alive():
+                    logging.error(
+                        "Asset processing stopped, %s assets not published"
+                        % len(self.pending)
+                    )
+                    return
+                deadline = (
+                    max(state["tracked_at"] for state in self.pending.values())
+                    + TIMEOUT
+                    + MAX_INTERVAL
+                )
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logging.error(
+                        "Gave up waiting for %s assets, not published"
+                        % len(self.pending)
+                    )
+                    return
+                self._condition.wait(min(remaining, MAX_INTERVAL))
+
+    def stop(self):
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+
+    def log_summary(self):
+        with self._condition:
+            timings = sorted(self.timings.values())
+            timed_out = len(self.timed_out)
+            polls = self.counters["polls"]
+        if not timings and not timed_out:
+            return
+        logging.info(
+            "Asset processing: %s assets processed (%.1fs mean, %.1fs median, %.1fs max), "
+            "%s timed out, %s polls"
+            % (
+                len(timings),
+                sum(timings) / len(timings) if timings else 0,
+                timings[len(timings) // 2] if timings else 0,
+                timings[-1] if timings else 0,
+                timed_out,
+                polls,
+            )
+        )
+
+
+def _key(environment):
+    return getattr(environment, "id", None)
+
+
+def start(environment):
+    """Start tracking the assets a run sends for processing"""
+
+    with _lock:
+        tracker = _trackers.get(_key(environment))
+        if tracker is None:
+            queue = publish_queue.PublishQueue(
+                environment, config.CTFL_SPACE_ID, config.CTFL_MGMT_API_KEY
+            )
+            tracker = ProcessingTracker(environment, queue)
+            _trackers[_key(environment)] = tracker
+        tracker.users += 1
+    return tracker
+
+
+def track(environment, asset):
+    """Publish given asset once Contentful processed it"""
+
+    with _lock:
+        tracker = _trackers.get(_key(environment))
+    if tracker is None:
+        # the asset was created outside of a run, e.g. by a tool
+        return
+    tracker.track(asset)
+
+
+def finish(environment):
+    """
+    Wait for the tracked assets, publish the processed ones and log the
+    processing times
+    """
+
+    with _lock:
+        tracker = _trackers.get(_key(environment))
+    if tracker is None:
+        return
+    try:
+        tracker.wait()
+        tracker.queue.flush()
+        tracker.queue.log_summary()
+        tracker.log_summary()
+    finally:
+        with _lock:
+            tracker.users -= 1
+            if tracker.users <= 0:
+                tracker.stop()
+                if _trackers.get(_key(environment)) is tracker:
+                    del _trackers[_key(environment)]
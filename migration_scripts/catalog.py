@@ -0,0 +1,101 @@
+"""
+
+Multi-locale catalog of EPI items.
+
+EPI serves one list of excursions / programs per market. The catalog is built
+once per run and indexes these lists by item id, so looking up all locale
+variants of an item doesn't scan the lists again.
+
+"""
+import logging
+from typing import Dict, Iterable, List, Optional
+
+import epi_client
+
+
+class LocalizedCatalog:
+    """EPI items of one type indexed by id, with one record per locale"""
+
+    def __init__(self):
+        self.locales: List[str] = []
+        self._records: Dict[str, Dict[str, dict]] = {}
+        self._ids: list = []
+
+    @classmethod
+    def from_urls(
+        cls,
+        urls_by_locale: Dict[str, str],
+        max_workers: Optional[int] = None,
+        fields: Optional[List[str]] = None,
+    ) -> "LocalizedCatalog":
+        """
+        Build catalog from the list endpoint of every locale
+
+        The lists are parsed item by item and only given fields of every item
+        are kept, so the full responses are never held in memory.
+        """
+
+        catalog = cls()
+        items_by_locale = epi_client.get_json_many(
+            urls_by_locale,
+            max_workers,
+            reader=lambda url: list(epi_client.iter_json_items(url, fields)),
+        )
+        for locale in urls_by_locale:
+            if locale not in items_by_locale:
+                logging.warning("No items available for locale %s" % locale)
+                continue
+            catalog.add(locale, items_by_locale[locale])
+        return catalog
+
+    def add(self, locale: str, items: Iterable[dict]) -> None:
+        """Add all items of given locale"""
+
+        if locale not in self.locales:
+            self.locales.append(locale)
+        for item in items:
+            key = str(item["id"])
+            if key not in self._records:
+                self._records[key] = {}
+                self._ids.append(item["id"])
+            # keep the first one like a linear search would
+            self._records[key].setdefault(locale, item)
+
+    def ids(self) -> list:
+        """EPI ids of all items, in the order they were first listed"""
+
+        return list(self._ids)
+
+    def by_locale(self, item_id, exclude: Iterable[str] = ()) -> Dict[str, dict]:
+        """Return {locale: item} for every locale that has the item"""
+
+        records = self._records.get(str(item_id), {})
+        return {
+            locale: records[locale]
+            for locale in self.locales
+            if locale in records and locale not in exclude
+        }
+
+    def get(self, item_id, locale: str) -> Optional[dict]:
+        """Return the item in given locale, None if the locale doesn't have it"""
+
+        return self._records.get(str(item_id), {}).get(locale)
+
+    def default(
+        self, item_id, default_locale: str, exclude: Iterable[str] = ()
+    ) -> Optional[dict]:
+        """
+        Return the item in the default locale, falling back to the first
+        locale that has the item
+        """
+
+        records = self.by_locale(item_id, exclude)
+        if default_locale in records:
+            return records[default_locale]
+        return next(iter(records.values()), None)
+
+    def __contains__(self, item_id):
+        return str(item_id) in self._records
+
+    def __len__(self):
+        return len(self._records)
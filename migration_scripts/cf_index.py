@@ -0,0 +1,208 @@
+"""
+
+Run-scoped index of the entries and assets of a Contentful environment.
+
+At the start of a run all entry and asset ids are read with a few paged bulk
+queries (sys only), together with their version, content type and published
+version. The helpers keep the index current when they create, save, publish
+or delete content, so existence checks during the run are answered from
+memory instead of a CMA GET per id. Entries written during the run are kept
+too, so writing the same entry again doesn't need to read it first as long
+as its version is still the indexed one.
+
+Without a loaded index, or for another environment than the indexed one,
+the lookups return None and the helpers fall back to asking Contentful.
+
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+import cf_loader
+
+PAGE_SIZE = 1000
+# Number of written entries kept for later writes in the same run
+CACHED_ENTRIES = 2000
+
+_lock = threading.Lock()
+_index = None
+
+
+class ContentIndex:
+    """Entry and asset sys records of one environment, keyed by id"""
+
+    def __init__(self, environment_id):
+        self.environment_id = environment_id
+        self.entries = {}
+        self.assets = {}
+        self.written = OrderedDict()
+
+    def records(self, kind):
+        return self.entries if kind == "entry" else self.assets
+
+
+def _environment_id(environment):
+    return getattr(environment, "id", None)
+
+
+def _sys_record(resource):
+    sys = resource.sys
+    content_type = sys.get("content_type")
+    return {
+        "version": sys.get("version"),
+        "published_version": sys.get("published_version"),
+        "content_type": getattr(content_type, "id", None),
+    }
+
+
+def _read_all(collection):
+    resources = []
+    while True:
+        page = collection.all(
+            query={
+                "select": "sys",
+                "order": "sys.createdAt",
+                "limit": PAGE_SIZE,
+                "skip": len(resources),
+            }
+        )
+        resources += list(page)
+        if len(page) < PAGE_SIZE:
+            return resources
+
+
+def load(environment):
+    """Index all entries and assets of given environment for this run"""
+
+    global _index
+    started = time.perf_counter()
+    index = ContentIndex(_environment_id(environment))
+    for entry in _read_all(environment.entries()):
+        index.entries[entry.id] = _sys_record(entry)
+    for asset in _read_all(environment.assets()):
+        index.assets[asset.id] = _sys_record(asset)
+    with _lock:
+        _index = index
+    # entries and assets read by id in an earlier run may have changed since
+    cf_loader.clear()
+    logging.info(
+        "Indexed %s entries and %s assets of Contentful environment %s in %.1fs"
+        % (
+            len(index.entries),
+            len(index.assets),
+            index.environment_id,
+            time.perf_counter() - started,
+        )
+    )
+    return index
+
+
+def clear():
+    global _index
+    with _lock:
+        _index = None
+
+
+def _current(environment):
+    index = _index
+    if index is None or index.environment_id != _environment_id(environment):
+        return None
+    return index
+
+
+def exists(environment, kind, resource_id):
+    """
+    True or False if the index knows whether the entry / asset exists,
+    None if there is no index for the environment
+    """
+
+    index = _current(environment)
+    if index is None:
+        return None
+    with _lock:
+        return resource_id in index.records(kind)
+
+
+def get(environment, kind, resource_id):
+    """Return the indexed sys record of an entry / asset, None if unknown"""
+
+    index = _current(environment)
+    if index is None:
+        return None
+    with _lock:
+        record = index.records(kind).get(resource_id)
+        return dict(record) if record is not None else None
+
+
+def is_published(environment, kind, resource_id):
+    record = get(environment, kind, resource_id)
+    if record is None:
+        return None
+    return record["published_version"] is not None
+
+
+def record(environment, kind, resource):
+    """Update the index after an entry / asset was created, saved or published"""
+
+    index = _current(environment)
+    if index is None or resource is None or not hasattr(resource, "sys"):
+        return
+    with _lock:
+        index.records(kind)[resource.id] = _sys_record(resource)
+
+
+def remove(environment, kind, resource_id):
+    """Update the index after an entry / asset was deleted"""
+
+    index = _current(environment)
+    if index is None:
+        return
+    with _lock:
+        index.records(kind).pop(resource_id, None)
+        if kind == "entry":
+            index.written.pop(resource_id, None)
+
+
+def remember(environment, entry):
+    """Keep a written entry, so the next write of it can skip reading it"""
+
+    index = _current(environment)
+    if index is None:
+        return
+    with _lock:
+        index.entries[entry.id] = _sys_record(entry)
+        index.written[entry.id] = entry
+        index.written.move_to_end(entry.id)
+        while len(index.written) > CACHED_ENTRIES:
+            index.written.popitem(last=False)
+
+
+def forget(environment, entry_id):
+    """Drop a written entry whose local state may differ from Contentful"""
+
+    index = _current(environment)
+    if index is None:
+        return
+    with _lock:
+        index.written.pop(entry_id, None)
+
+
+def written_entry(environment, entry_id):
+    """
+    Return the entry as written earlier in this run, None if it wasn't
+    written or changed since
+    """
+
+    index = _current(environment)
+    if index is None:
+        return None
+    with _lock:
+        entry = index.written.get(entry_id)
+        record = index.entries.get(entry_id)
+        if entry is None or record is None:
+            return None
+        if entry.sys.get("version") != record["version"]:
+            del index.written[entry_id]
+            return None
+        return entry
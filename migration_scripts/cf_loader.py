@@ -0,0 +1,158 @@
+"""
+
+Batched lookups of Contentful entries and assets by id.
+
+Writing an existing entry or asset reads it first, one GET per id. A loader
+collects the ids a run is about to look up and reads them together with
+sys.id[in] queries of up to 100 ids each. Every result, found or not, is
+kept for the rest of the run.
+
+    loader = cf_loader.entries(environment)
+    loader.prime(ids)           # announce ids, nothing is read yet
+    entry = loader.load(id)     # reads id and all primed ids not read yet
+
+load() returns None for ids that don't exist. Threads loading an id that
+another thread is already reading wait for that read instead of sending
+their own. The commit graph primes the ids of every asset and entry it is
+about to write, so a voyage with 50 image wrappers and itinerary days reads
+them with one request instead of 50.
+
+The loaders are dropped when cf_index.load() starts a new run.
+
+"""
+import logging
+import threading
+
+BATCH_SIZE = 100
+
+_lock = threading.Lock()
+_loaders = {}
+
+
+class Loader:
+    """Batches and memoises lookups of fetch(keys) -> {key: value}"""
+
+    def __init__(self, fetch, batch_size=BATCH_SIZE):
+        self._fetch = fetch
+        self.batch_size = batch_size
+        self._values = {}
+        self._pending = []
+        self._loading = {}
+        self._lock = threading.Lock()
+        self.stats = {"lookups": 0, "requests": 0}
+
+    def prime(self, keys):
+        """Read given keys with the next load(), unless they're read already"""
+
+        with self._lock:
+            for key in keys:
+                if (
+                    key not in self._values
+                    and key not in self._loading
+                    and key not in self._pending
+                ):
+                    self._pending.append(key)
+
+    def load(self, key):
+        return self.load_many([key])[key]
+
+    def load_many(self, keys):
+        """Return {key: value or None} of given keys, reading the missing and primed ones"""
+
+        with self._lock:
+            self.stats["lookups"] += len(keys)
+            batch = []
+            for key in self._pending + list(keys):
+                if (
+                    key not in self._values
+                    and key not in self._loading
+                    and key not in batch
+                ):
+                    batch.append(key)
+            self._pending = []
+            done = threading.Event()
+            for key in batch:
+                self._loading[key] = done
+            waiting = {self._loading[key] for key in keys if key in self._loading}
+            waiting.discard(done)
+
+        try:
+            for start in range(0, len(batch), self.batch_size):
+                self._read(batch[start : start + self.batch_size])
+        finally:
+            with self._lock:
+                for key in batch:
+                    self._loading.pop(key, None)
+            done.set()
+
+        for event in waiting:
+            event.wait()
+        with self._lock:
+            missing = [key for key in keys if key not in self._values]
+        if missing:
+            # the read of another thread failed, read them here
+            self._read(missing)
+        with self._lock:
+            return {key: self._values.get(key) for key in keys}
+
+    def _read(self, keys):
+        values = self._fetch(keys)
+        with self._lock:
+            self.stats["requests"] += 1
+            for key in keys:
+                self._values[key] = values.get(key)
+
+    def set(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+    def forget(self, key):
+        """Read key again on the next load(), e.g. after it changed"""
+
+        with self._lock:
+            self._values.pop(key, None)
+
+
+def _by_id(collection, ids):
+    resources = collection.all(query={"sys.id[in]": ",".join(ids), "limit": len(ids)})
+    return {resource.id: resource for resource in resources}
+
+
+def _loader(environment, kind):
+    key = (getattr(environment, "id", None), kind)
+    with _lock:
+        loader = _loaders.get(key)
+        if loader is None:
+            if kind == "entry":
+                loader = Loader(lambda ids: _by_id(environment.entries(), ids))
+            else:
+                loader = Loader(lambda ids: _by_id(environment.assets(), ids))
+            _loaders[key] = loader
+        return loader
+
+
+def entries(environment):
+    """Loader of the entries of given environment"""
+
+    return _loader(environment, "entry")
+
+
+def assets(environment):
+    """Loader of the assets of given environment"""
+
+    return _loader(environment, "asset")
+
+
+def clear():
+    with _lock:
+        _loaders.clear()
+
+
+def log_stats():
+    with _lock:
+        loaders = dict(_loaders)
+    for (environment_id, kind), loader in loaders.items():
+        logging.info(
+            "Contentful %s lookups: %s ids looked up with %s requests"
+            % (kind, loader.stats["lookups"], loader.stats["requests"])
+        )
@@ -0,0 +1,241 @@
+"""
+
+Shared, rate limited client for the Contentful Management API.
+
+Every Contentful write of a run, from all sync threads, uploads and bulk
+actions, goes through one pooled keep-alive session and one token bucket
+sized to the request rate limit of the space. The bucket starts at
+SYNC_CONTENTFUL_RATE_LIMIT and follows the per second limit Contentful
+reports in X-Contentful-RateLimit-Second-Limit. When Contentful still answers
+429, every request waits for the X-Contentful-RateLimit-Reset seconds of that
+response before the request is retried, so parallel threads don't keep
+hitting the limit.
+
+    client = cma_client.get_client(config.CTFL_MGMT_API_KEY)
+    environment = client.environments(space_id).find(environment_id)
+
+usage() returns the live request rate and the remaining quota for monitoring.
+
+SYNC_CONTENTFUL_RATE_LIMIT      requests per second (default 10)
+SYNC_CONTENTFUL_POOL_SIZE       keep-alive connections (default 20)
+SYNC_CONTENTFUL_MAX_RETRIES     retries of throttled requests (default 5)
+
+"""
+import collections
+import logging
+import os
+import random
+import threading
+import time
+
+import contentful_management
+import requests
+from contentful_management.errors import RateLimitExceededError
+from requests.adapters import HTTPAdapter
+
+import plan
+from rate_limit import TokenBucket
+
+RATE_LIMIT = float(os.environ.get("SYNC_CONTENTFUL_RATE_LIMIT", 10))
+POOL_SIZE = int(os.environ.get("SYNC_CONTENTFUL_POOL_SIZE", 20))
+MAX_RETRIES = int(os.environ.get("SYNC_CONTENTFUL_MAX_RETRIES", 5))
+TIMEOUT = (10, 120)
+# Seconds over which the live request rate is measured
+USAGE_WINDOW = 10
+
+RATE_LIMIT_HEADERS = {
+    "second_limit": "X-Contentful-RateLimit-Second-Limit",
+    "second_remaining": "X-Contentful-RateLimit-Second-Remaining",
+    "hour_limit": "X-Contentful-RateLimit-Hour-Limit",
+    "hour_remaining": "X-Contentful-RateLimit-Hour-Remaining",
+}
+RESET_HEADER = "X-Contentful-RateLimit-Reset"
+
+_lock = threading.Lock()
+_condition = threading.Condition(_lock)
+_session = None
+_clients = {}
+_bucket = TokenBucket(RATE_LIMIT, max(1, RATE_LIMIT))
+_paused_until = 0.0
+_recent = collections.deque()
+_quota = dict.fromkeys(RATE_LIMIT_HEADERS)
+
+
+def _new_stats():
+    return {"requests": 0, "throttled": 0, "retries": 0, "waited": 0.0}
+
+
+_stats = _new_stats()
+
+
+def get_session():
+    """Return the keep-alive session shared by all CMA requests"""
+
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=2, pool_maxsize=POOL_SIZE)
+            _session.mount("https://", adapter)
+            _session.mount("http://", adapter)
+        return _session
+
+
+def _acquire():
+    """Wait for a token of the bucket and for a running 429 pause"""
+
+    started = time.monotonic()
+    with _condition:
+        while True:
+            now = time.monotonic()
+            wait = max(_paused_until - now, _bucket.wait_time(now))
+            if wait <= 0:
+                _bucket.take(now)
+                _recent.append(now)
+                while _recent[0] < now - USAGE_WINDOW:
+                    _recent.popleft()
+                _stats["requests"] += 1
+                _stats["waited"] += now - started
+                return
+            _condition.wait(wait)
+
+
+def _observe(response):
+    """Follow the limits Contentful reports and pause everyone on a 429"""
+
+    global _paused_until
+    headers = response.headers
+    with _condition:
+        for name, header in RATE_LIMIT_HEADERS.items():
+            if header in headers:
+                try:
+                    _quota[name] = int(headers[header])
+                except ValueError:
+                    pass
+        second_limit = _quota["second_limit"]
+        if second_limit and min(second_limit, RATE_LIMIT) != _bucket.rate:
+            _bucket.rate = float(min(second_limit, RATE_LIMIT))
+            _bucket.burst = max(1.0, _bucket.rate)
+            logging.info("Contentful request rate set to %s/s" % _bucket.rate)
+
+        if response.status_code != 429:
+            return False
+        try:
+            reset = float(headers.get(RESET_HEADER, 1))
+        except ValueError:
+            reset = 1.0
+        _stats["throttled"] += 1
+        _paused_until = max(
+            _paused_until, time.monotonic() + reset * random.uniform(1.0, 1.2)
+        )
+        _bucket.tokens = 0
+        _condition.notify_all()
+    logging.warning("Contentful rate limit hit, pausing requests for %ss" % reset)
+    return True
+
+
+def request(method, url, **kwargs):
+    """
+    Send a CMA request through the shared session and rate limit, retrying
+    throttled requests. Returns the last response.
+    """
+
+    if plan.active() and method.lower() not in ("get", "head"):
+        # every write of a planned run has to be recorded instead, see plan.py
+        raise RuntimeError("%s %s not sent, running in plan mode" % (method.upper(), url))
+
+    kwargs.setdefault("timeout", TIMEOUT)
+    session = get_session()
+    for attempt in range(MAX_RETRIES + 1):
+        _acquire()
+        response = session.request(method, url, **kwargs)
+        if not _observe(response) or attempt == MAX_RETRIES:
+            return response
+        with _lock:
+            _stats["retries"] += 1
+        data = kwargs.get("data")
+        if hasattr(data, "seek"):
+            # uploads send an open file, send it from the start again
+            data.seek(0)
+    return response
+
+
+class Client(contentful_management.Client):
+    """contentful_management.Client sending its requests through request()"""
+
+    def __init__(self, access_token, **kwargs):
+        # throttled requests are retried by request(), not by the library
+        kwargs.setdefault("max_rate_limit_retries", 0)
+        super().__init__(access_token, **kwargs)
+
+    def _http_request(self, method, url, request_kwargs=None):
+        kwargs = request_kwargs if request_kwargs is not None else {}
+
+        headers = self._request_headers()
+        headers.update(self.additional_headers)
+        if "headers" in kwargs:
+            headers.update(kwargs["headers"])
+        kwargs["headers"] = headers
+
+        if self._has_proxy():
+            kwargs["proxies"] = self._proxy_parameters()
+
+        request_url = self._url(url, file_upload=kwargs.pop("file_upload", False))
+        response = request(method, request_url, **kwargs)
+
+        if response.status_code == 429:
+            raise RateLimitExceededError(response)
+        return response
+
+
+def get_client(access_token, default_locale=None):
+    """Return the shared CMA client for given access token"""
+
+    with _lock:
+        client = _clients.get(access_token)
+        if client is None:
+            client = Client(access_token)
+            _clients[access_token] = client
+    if default_locale is not None:
+        client.default_locale = default_locale
+    return client
+
+
+def headers(access_token):
+    """Headers for CMA requests that don't go through a client, see request()"""
+
+    return {
+        "Authorization": "Bearer %s" % access_token,
+        "Content-Type": "application/vnd.contentful.management.v1+json",
+        "Accept-Encoding": "gzip",
+    }
+
+
+def usage():
+    """Live request rate and remaining quota, for monitoring"""
+
+    with _lock:
+        now = time.monotonic()
+        while _recent and _recent[0] < now - USAGE_WINDOW:
+            _recent.popleft()
+        state = dict(_stats)
+        state.update(_quota)
+        state["rate_limit"] = _bucket.rate
+        state["current_rate"] = len(_recent) / USAGE_WINDOW
+        state["paused_for"] = max(0.0, _paused_until - now)
+    return state
+
+
+def reset_stats():
+    global _stats
+    with _lock:
+        _stats = _new_stats()
+
+
+def log_stats():
+    state = usage()
+    logging.info(
+        "Contentful: %(requests)s requests (%(throttled)s throttled, %(retries)s retries), "
+        "%(waited).1fs waited for rate limit of %(rate_limit)s/s, "
+        "%(hour_remaining)s of %(hour_limit)s requests left this hour" % state
+    )
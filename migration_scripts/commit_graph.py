@@ -0,0 +1,255 @@
+"""
+
+Dependency graph for writing nested Contentful content.
+
+A voyage links image wrappers, which link assets, a gallery linking image
+wrappers, itinerary days, and so on. Instead of writing all of them one by
+one, depth first, a sync declares every asset and entry as a node of a
+CommitGraph and commits the graph:
+
+    graph = CommitGraph("Voyage 123")
+    asset = graph.add("asset", helpers.add_or_reuse_asset, environment=env, id="pic", ...)
+    wrapper = graph.add(
+        "entry", helpers.add_entry, optional=True, environment=env, id="pic",
+        content_type_id="imageWrapper", market=None, fields={"image": {"en": asset}},
+    )
+    graph.add("entry", helpers.add_entry, environment=env, id="123", ..., fields={"media": {"en": [wrapper]}})
+    graph.commit()
+
+Nodes used in the arguments of another node are its dependencies. Before a
+node is written they are replaced by their result, the link returned by the
+add function. commit() writes every node whose dependencies are written, on
+a thread pool shared by all graphs, so independent assets and entries are
+written at the same time and a parent only after its children. The ids
+of existing assets and entries are primed in cf_loader first, so they are
+read together with a few batched requests.
+
+A node fails when its function raises or returns None or an exception (as
+add_entry does). Nodes depending on a failed node are skipped. A failed or
+skipped optional node is left out of the lists it's in (or is None)
+instead, and the nodes depending on it are written without it. commit()
+raises when one of the nodes nothing depends on, the items the graph was
+built for, isn't written. Declaring the same key twice writes both, in the
+order they were declared.
+
+SYNC_COMMIT_WORKERS     nodes written at the same time, across all graphs (default 4)
+
+"""
+import logging
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import cf_index
+import cf_loader
+
+WORKERS = int(os.environ.get("SYNC_COMMIT_WORKERS", 4))
+
+_lock = threading.Lock()
+_executor = None
+_MISSING = object()
+
+
+class CommitError(Exception):
+    """Raised by commit() when required nodes could not be written"""
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=max(1, WORKERS), thread_name_prefix="commit"
+            )
+        return _executor
+
+
+class Node:
+    """One asset or entry to write, see CommitGraph.add"""
+
+    def __init__(self, kind, key, function, args, kwargs, optional):
+        self.kind = kind
+        self.key = key
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.optional = optional
+        self.dependencies = []
+        self.state = "pending"
+        self.result = None
+        self.error = None
+
+    def __repr__(self):
+        return "<%s %s>" % (self.kind, self.key)
+
+    @property
+    def blocks_dependents(self):
+        return self.state in ("failed", "skipped") and not self.optional
+
+
+def _find_nodes(value, found):
+    if isinstance(value, Node):
+        found.append(value)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _find_nodes(item, found)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            _find_nodes(item, found)
+    return found
+
+
+def _resolve(value):
+    """Replace nodes by their result, failed optional nodes by _MISSING"""
+
+    if isinstance(value, Node):
+        return value.result if value.state == "done" else _MISSING
+    if isinstance(value, dict):
+        result = {}
+        for key, item in value.items():
+            item = _resolve(item)
+            result[key] = None if item is _MISSING else item
+        return result
+    if isinstance(value, (list, tuple)):
+        items = [_resolve(item) for item in value]
+        return type(value)(item for item in items if item is not _MISSING)
+    return value
+
+
+def _write(node):
+    args = [None if arg is _MISSING else arg for arg in _resolve(node.args)]
+    kwargs = _resolve(node.kwargs)
+    result = node.function(*args, **kwargs)
+    if result is None or isinstance(result, Exception):
+        raise CommitError("%s could not be written: %s" % (node, result))
+    return result
+
+
+class CommitGraph:
+    """Assets and entries of one item to sync, with their link dependencies"""
+
+    def __init__(self, name):
+        self.name = name
+        self.nodes = []
+        self._latest = {}
+
+    def add(self, kind, function, *args, optional=False, after=(), key=None, **kwargs):
+        """
+        Declare a node that calls function(*args, **kwargs) when committed and
+        return it, to be used as link in the fields of other nodes
+
+        kind is "asset" or "entry", key defaults to the id argument. Nodes in
+        args and kwargs and the nodes in after are written before this one.
+        """
+
+        key = key if key is not None else kwargs.get("id")
+        node = Node(kind, key, function, args, kwargs, optional)
+        dependencies = _find_nodes([args, kwargs], []) + list(after)
+        previous = self._latest.get((kind, key))
+        if previous is not None:
+            dependencies.append(previous)
+        for dependency in dependencies:
+            if dependency not in node.dependencies:
+                node.dependencies.append(dependency)
+        self._latest[(kind, key)] = node
+        self.nodes.append(node)
+        return node
+
+    def commit(self):
+        """
+        Write all nodes, independent ones concurrently, and return the graph.
+        Raises CommitError when a node nothing depends on isn't written.
+        """
+
+        started = time.perf_counter()
+        self._prime()
+        dependents = {node: [] for node in self.nodes}
+        waiting = {}
+        for node in self.nodes:
+            waiting[node] = len(node.dependencies)
+            for dependency in node.dependencies:
+                dependents[dependency].append(node)
+
+        executor = get_executor()
+        running = {}
+        ready = [node for node in self.nodes if waiting[node] == 0]
+        max_running = 0
+        while ready or running:
+            while ready:
+                node = ready.pop(0)
+                if any(dependency.blocks_dependents for dependency in node.dependencies):
+                    node.state = "skipped"
+                    logging.info("%s: %s skipped, a dependency failed" % (self.name, node))
+                    ready += self._release(node, dependents, waiting)
+                    continue
+                running[executor.submit(_write, node)] = node
+            max_running = max(max_running, len(running))
+            if not running:
+                break
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                node = running.pop(future)
+                try:
+                    node.result = future.result()
+                    node.state = "done"
+                except Exception as e:
+                    node.state = "failed"
+                    node.error = e
+                    logging.error("%s: %s failed, error: %s" % (self.name, node, e))
+                ready += self._release(node, dependents, waiting)
+
+        counts = {}
+        for node in self.nodes:
+            counts[node.state] = counts.get(node.state, 0) + 1
+        logging.info(
+            "%s: %s nodes written, %s failed, %s skipped in %.1fs, up to %s in flight"
+            % (
+                self.name,
+                counts.get("done", 0),
+                counts.get("failed", 0),
+                counts.get("skipped", 0),
+                time.perf_counter() - started,
+                max_running,
+            )
+        )
+
+        failed = [
+            node
+            for node in self.nodes
+            if node.state != "done" and not node.optional and not dependents[node]
+        ]
+        if failed:
+            raise CommitError(
+                "%s: %s not written" % (self.name, ", ".join(map(repr, failed)))
+            )
+        return self
+
+    def _prime(self):
+        """Announce the existing assets and entries the nodes will read to cf_loader"""
+
+        for node in self.nodes:
+            environment = node.kwargs.get("environment")
+            resource_id = node.kwargs.get("id")
+            if environment is None or not isinstance(resource_id, str):
+                continue
+            resource_id = resource_id.replace("/", "")
+            if cf_index.exists(environment, node.kind, resource_id) is False:
+                continue
+            if node.kind == "entry":
+                if cf_index.written_entry(environment, resource_id) is None:
+                    cf_loader.entries(environment).prime([resource_id])
+            else:
+                cf_loader.assets(environment).prime([resource_id])
+
+    @staticmethod
+    def _release(node, dependents, waiting):
+        """Return the dependents of a finished node that can run now"""
+
+        ready = []
+        for dependent in dependents[node]:
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+        return ready
@@ -9,3 +9,12 @@ CTFL_MGMT_API_KEY = os.environ["SYNC_CONTENTFUL_API_KEY"]
 CTFL_SPACE_ID = os.environ["SYNC_CONTENTFUL_SPACE_ID"]
 CTFL_ENV_ID = os.environ["SYNC_CONTENTFUL_ENVIRONMENT"]
 DEFAULT_LOCALE = os.environ["SYNC_CONTENTFUL_DEFAULT_LOCALE"]
+
+# Number of EPI market sites read at the same time for a single voyage
+EPI_MARKET_CONCURRENCY = int(os.environ.get("SYNC_EPI_MARKET_CONCURRENCY", 10))
+
+# Number of items read from EPI ahead of the one being written to Contentful
+PIPELINE_QUEUE_SIZE = int(os.environ.get("SYNC_PIPELINE_QUEUE_SIZE", 4))
+
+# Number of voyages written to Contentful at the same time
+VOYAGE_WORKERS = int(os.environ.get("SYNC_VOYAGE_WORKERS", 1))
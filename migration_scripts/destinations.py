@@ -0,0 +1,119 @@
+"""
+
+Destination lookups for the sync scripts.
+
+Voyages reference their destination by EPI id, excursions and programs by
+name. The resolver reads all Contentful destination entries once per run,
+and the EPI destination list once when the first EPI id is resolved.
+Afterwards resolving a destination doesn't need any request.
+
+"""
+import logging
+import threading
+from typing import Dict, Iterable, List, Optional
+
+import config
+import epi_client
+import epi_markets
+
+# EPI destination names that differ from the internal name in Contentful
+NAME_ALIASES = {
+    "West Africa & Cape Verde": "West Africa and Cape Verde",
+}
+
+PAGE_SIZE = 1000
+
+
+def fetch_epi_names() -> Dict[str, str]:
+    """
+    Return {EPI id: destination name} of all EPI destinations. Raises when
+    the list can't be read, voyage destinations can't be resolved without it.
+    """
+
+    return {
+        str(destination["id"]): destination["heading"].strip()
+        for destination in epi_client.iter_json_items(
+            epi_markets.destinations_url(), ["id", "heading"]
+        )
+    }
+
+
+def fetch_cf_ids(environment) -> Dict[str, str]:
+    """Return {internal name: entry id} of all Contentful destinations"""
+
+    entries = []
+    while True:
+        page = environment.entries().all(
+            query={
+                "content_type": "destination",
+                "select": "sys.id,fields.internalName",
+                "limit": PAGE_SIZE,
+                "skip": len(entries),
+            }
+        )
+        entries += list(page)
+        if len(page) < PAGE_SIZE:
+            break
+
+    cf_ids = {}
+    # names in the default locale win over translated ones
+    for default_only in (True, False):
+        for entry in entries:
+            names = entry.raw.get("fields", {}).get("internalName", {})
+            for locale, name in names.items():
+                if name and (locale == config.DEFAULT_LOCALE) == default_only:
+                    cf_ids.setdefault(name.strip(), entry.id)
+    return cf_ids
+
+
+class DestinationResolver:
+    """
+    Maps EPI destination ids and names to Contentful destination entry ids
+
+    The EPI destination list is only read by the first epi_id_to_cf_id(),
+    excursions and programs resolve names and don't need it.
+    """
+
+    def __init__(self, cf_ids: Dict[str, str], epi_names: Optional[Dict[str, str]] = None):
+        self._cf_ids = cf_ids
+        self._epi_names = epi_names
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, environment) -> "DestinationResolver":
+        resolver = cls(fetch_cf_ids(environment))
+        logging.info("Loaded %s Contentful destinations" % len(resolver._cf_ids))
+        return resolver
+
+    def _get_epi_names(self) -> Dict[str, str]:
+        # a failed read raises and is tried again by the next voyage
+        with self._lock:
+            if self._epi_names is None:
+                self._epi_names = fetch_epi_names()
+                logging.info("Loaded %s EPI destinations" % len(self._epi_names))
+            return self._epi_names
+
+    def name_to_cf_id(self, name: str) -> Optional[str]:
+        if not name:
+            return None
+        name = name.strip()
+        if name in self._cf_ids:
+            return self._cf_ids[name]
+        return self._cf_ids.get(NAME_ALIASES.get(name))
+
+    def names_to_cf_ids(self, names: Iterable[str]) -> List[str]:
+        """Contentful ids of given names, names without a destination are left out"""
+
+        return list(filter(None, [self.name_to_cf_id(name) for name in names or []]))
+
+    def epi_id_to_cf_id(self, epi_id) -> Optional[str]:
+        """
+        Contentful id of the destination with given EPI id, None when it has
+        no Contentful destination. Raises KeyError for ids EPI doesn't list,
+        failing the voyage instead of saving it without its destination.
+        """
+
+        name = self._get_epi_names().get(str(epi_id))
+        if name is None:
+            raise KeyError("EPI destination not found: %s" % epi_id)
+        return self.name_to_cf_id(name)
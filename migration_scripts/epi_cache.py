@@ -0,0 +1,208 @@
+"""
+
+Persistent on-disk cache for EPI list responses, keyed by URL.
+
+A cached response is revalidated with If-None-Match / If-Modified-Since when
+EPI sent an ETag or Last-Modified header for it, so unchanged content costs a
+304 instead of the whole list. Responses without validators are reused until
+they are older than the TTL.
+
+SYNC_EPI_CACHE_DIR     cache directory, empty to disable (default .epi_cache)
+SYNC_EPI_CACHE_TTL     seconds to reuse responses without validators (default 3600)
+
+"""
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+CACHE_DIR = os.environ.get(
+    "SYNC_EPI_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), ".epi_cache"),
+)
+CACHE_TTL = float(os.environ.get("SYNC_EPI_CACHE_TTL", 3600))
+
+CACHEABLE_PATHS = [
+    re.compile(r"/rest/b2b/(voyages|excursions|programs|destinations)/?$"),
+    re.compile(r"/rest/b2b/ships/[^/]+/?$"),
+]
+
+_lock = threading.Lock()
+_stats = {"hits": 0, "revalidated": 0, "misses": 0, "bytes_saved": 0}
+
+
+def is_enabled():
+    return bool(CACHE_DIR)
+
+
+def is_cacheable(url):
+    if not is_enabled():
+        return False
+    path = url.split("?")[0]
+    return any(pattern.search(path) for pattern in CACHEABLE_PATHS)
+
+
+def _paths(url):
+    key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+    return (
+        os.path.join(CACHE_DIR, key + ".json"),
+        os.path.join(CACHE_DIR, key + ".body"),
+    )
+
+
+def _write_atomic(path, data):
+    tmp_path = "%s.%s.tmp" % (path, threading.get_ident())
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def lookup(url):
+    """Return cached metadata for given URL or None"""
+
+    meta_path, body_path = _paths(url)
+    try:
+        with open(meta_path, "r") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("url") != url or not os.path.exists(body_path):
+        return None
+    meta["body_path"] = body_path
+    return meta
+
+
+def read_body(entry):
+    with open(entry["body_path"], "rb") as f:
+        return f.read()
+
+
+def iter_body(entry, chunk_size):
+    with open(entry["body_path"], "rb") as f:
+        chunk = f.read(chunk_size)
+        while chunk:
+            yield chunk
+            chunk = f.read(chunk_size)
+
+
+def has_validators(entry):
+    return bool(entry.get("etag") or entry.get("last_modified"))
+
+
+def is_fresh(entry):
+    """Responses without validators are reused until they reach the TTL"""
+
+    return (
+        not has_validators(entry)
+        and time.time() - entry.get("fetched_at", 0) < CACHE_TTL
+    )
+
+
+def conditional_headers(entry):
+    headers = {}
+    if entry is None:
+        return headers
+    if entry.get("etag"):
+        headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        headers["If-Modified-Since"] = entry["last_modified"]
+    return headers
+
+
+def _meta(url, response):
+    return {
+        "url": url,
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "fetched_at": time.time(),
+    }
+
+
+def store(url, response):
+    """Store response body and its validators for given URL"""
+
+    meta_path, body_path = _paths(url)
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        _write_atomic(body_path, response.content)
+        _write_atomic(meta_path, json.dumps(_meta(url, response)).encode("utf-8"))
+    except OSError as e:
+        logging.error("Could not cache EPI response for %s, error: %s" % (url, e))
+
+
+def store_stream(url, response, chunks):
+    """
+    Pass the body chunks of a streamed response through while writing them to
+    the cache, the entry is only stored once the whole body has been read
+    """
+
+    meta_path, body_path = _paths(url)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    tmp_path = "%s.%s.tmp" % (body_path, threading.get_ident())
+    complete = False
+    try:
+        with open(tmp_path, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+                yield chunk
+        complete = True
+    finally:
+        if complete:
+            os.replace(tmp_path, body_path)
+            _write_atomic(meta_path, json.dumps(_meta(url, response)).encode("utf-8"))
+        elif os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def touch(url, entry):
+    """Mark a revalidated entry as fetched now"""
+
+    meta_path, _ = _paths(url)
+    meta = {key: value for key, value in entry.items() if key != "body_path"}
+    meta["fetched_at"] = time.time()
+    try:
+        _write_atomic(meta_path, json.dumps(meta).encode("utf-8"))
+    except OSError as e:
+        logging.error("Could not update EPI cache for %s, error: %s" % (url, e))
+
+
+def record(outcome, size=0):
+    with _lock:
+        _stats[outcome] += 1
+        if outcome != "misses":
+            _stats["bytes_saved"] += size
+
+
+def stats():
+    with _lock:
+        result = dict(_stats)
+    total = result["hits"] + result["revalidated"] + result["misses"]
+    result["hit_rate"] = (
+        (result["hits"] + result["revalidated"]) / total if total else 0
+    )
+    return result
+
+
+def reset_stats():
+    with _lock:
+        for key in _stats:
+            _stats[key] = 0
+
+
+def log_stats():
+    if not is_enabled():
+        return
+    cache_stats = stats()
+    logging.info(
+        "EPI cache: %s hits, %s revalidated, %s misses (hit rate %.0f%%), %.1f kB not downloaded"
+        % (
+            cache_stats["hits"],
+            cache_stats["revalidated"],
+            cache_stats["misses"],
+            cache_stats["hit_rate"] * 100,
+            cache_stats["bytes_saved"] / 1024,
+        )
+    )
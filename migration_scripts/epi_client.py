@@ -0,0 +1,461 @@
+"""
+
+Shared HTTP client for reading content from the EPI market sites.
+
+All EPI reads go through one pooled requests session per host, so connections
+(and their TLS handshakes) are reused between calls, responses are transferred
+gzip compressed and every request has a connect and read timeout.
+Requests, bytes, latency and opened connections are counted per host so a run
+can log how much time was spent waiting for EPI. List endpoints go through the
+on-disk cache in epi_cache and can be read item by item with iter_json_items,
+which parses the response while it is downloaded and keeps only the fields a
+sync needs.
+
+Every host has an adaptive limiter (see rate_limit) that grows the number of
+parallel requests while the site answers quickly and backs off with jitter
+when it returns 5xx or 429 or times out. Such requests are retried.
+
+Settings are read from the environment so the scripts under tools/ can use the
+client without the sync configuration:
+
+SYNC_EPI_CONNECT_TIMEOUT    connect timeout in seconds (default 10)
+SYNC_EPI_READ_TIMEOUT       read timeout in seconds (default 60)
+SYNC_EPI_POOL_SIZE          keep-alive connections per host (default 10)
+SYNC_EPI_RATE_LIMIT         requests per second per host (default 20)
+SYNC_EPI_TARGET_LATENCY     latency in seconds up to which concurrency grows (default 2)
+SYNC_EPI_MAX_RETRIES        retries of overloaded or timed out requests (default 3)
+
+"""
+import codecs
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import epi_cache
+import epi_markets
+from rate_limit import AdaptiveLimiter, parse_retry_after
+
+CONNECT_TIMEOUT = float(os.environ.get("SYNC_EPI_CONNECT_TIMEOUT", 10))
+READ_TIMEOUT = float(os.environ.get("SYNC_EPI_READ_TIMEOUT", 60))
+POOL_SIZE = int(os.environ.get("SYNC_EPI_POOL_SIZE", 10))
+RATE_LIMIT = float(os.environ.get("SYNC_EPI_RATE_LIMIT", 20))
+TARGET_LATENCY = float(os.environ.get("SYNC_EPI_TARGET_LATENCY", 2))
+MAX_RETRIES = int(os.environ.get("SYNC_EPI_MAX_RETRIES", 3))
+CHUNK_SIZE = 64 * 1024
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0",
+    "Accept": "application/json",
+    "Accept-Encoding": "gzip, deflate",
+}
+
+_lock = threading.Lock()
+_sessions = {}
+_limiters = {}
+_stats = {}
+_snapshot = None
+
+
+class SnapshotMissError(KeyError):
+    """Raised when a URL is read in snapshot mode that the snapshot doesn't contain"""
+
+
+def _host(url):
+    return urlparse(url).netloc
+
+
+def _new_stats():
+    return {"requests": 0, "errors": 0, "retries": 0, "bytes": 0, "seconds": 0.0}
+
+
+def get_session(url):
+    """Return the keep-alive session for the host of given URL"""
+
+    host = _host(url)
+    with _lock:
+        session = _sessions.get(host)
+        if session is None:
+            session = requests.Session()
+            session.headers.update(DEFAULT_HEADERS)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[host] = session
+        return session
+
+
+def get_limiter(url):
+    """Return the adaptive limiter for the host of given URL"""
+
+    host = _host(url)
+    with _lock:
+        limiter = _limiters.get(host)
+        if limiter is None:
+            limiter = AdaptiveLimiter(
+                "EPI %s" % host,
+                rate=RATE_LIMIT,
+                max_concurrency=POOL_SIZE,
+                target_latency=TARGET_LATENCY,
+            )
+            _limiters[host] = limiter
+        return limiter
+
+
+def _record(url, seconds, size, failed, retried=False):
+    host = _host(url)
+    with _lock:
+        stats = _stats.setdefault(host, _new_stats())
+        stats["requests"] += 1
+        stats["seconds"] += seconds
+        stats["bytes"] += size
+        if failed:
+            stats["errors"] += 1
+        if retried:
+            stats["retries"] += 1
+
+
+def _record_bytes(url, size):
+    with _lock:
+        _stats.setdefault(_host(url), _new_stats())["bytes"] += size
+
+
+def _wire_size(response):
+    """Number of bytes received for the body, before decompression"""
+
+    try:
+        return response.raw.tell() or len(response.content)
+    except Exception:
+        return len(response.content)
+
+
+def _is_overloaded(response):
+    return response.status_code == 429 or response.status_code >= 500
+
+
+def get(url, headers=None, stream=False, timeout=None):
+    """
+    GET given URL through the pooled session and limiter of its host
+
+    Requests the host answers with 5xx or 429, or that time out, are retried
+    up to MAX_RETRIES times after the backoff of the limiter. Raises
+    requests.HTTPError for error status codes, the same way urlopen did for
+    the previous implementation.
+    """
+
+    session = get_session(url)
+    limiter = get_limiter(url)
+    attempt = 0
+    while True:
+        retry = attempt < MAX_RETRIES
+        limiter.acquire()
+        started = time.perf_counter()
+        try:
+            response = session.get(
+                url,
+                headers=headers,
+                stream=stream,
+                timeout=timeout or (CONNECT_TIMEOUT, READ_TIMEOUT),
+            )
+            if not stream:
+                # make sure the body is read before the request is timed
+                response.content
+        except (requests.Timeout, requests.ConnectionError):
+            seconds = time.perf_counter() - started
+            delay = limiter.release(seconds, overloaded=True)
+            _record(url, seconds, 0, True, retry)
+            if not retry:
+                raise
+        except Exception:
+            seconds = time.perf_counter() - started
+            limiter.release(seconds)
+            _record(url, seconds, 0, True)
+            raise
+        else:
+            seconds = time.perf_counter() - started
+            overloaded = _is_overloaded(response)
+            delay = limiter.release(
+                seconds,
+                overloaded=overloaded,
+                retry_after=parse_retry_after(response.headers.get("Retry-After")),
+            )
+            _record(
+                url,
+                seconds,
+                0 if stream else _wire_size(response),
+                response.status_code >= 400,
+                overloaded and retry,
+            )
+            if not (overloaded and retry):
+                break
+            response.close()
+
+        attempt += 1
+        logging.info(
+            "Retrying %s in %.1fs (attempt %s/%s)" % (url, delay, attempt, MAX_RETRIES)
+        )
+        time.sleep(delay)
+
+    if stream and response.status_code >= 400:
+        response.close()
+    response.raise_for_status()
+    return response
+
+
+def get_content(url):
+    """
+    Return the body of given URL
+
+    List endpoints are served from the on-disk cache when it is still valid,
+    see epi_cache.
+    """
+
+    if not epi_cache.is_cacheable(url):
+        return get(url).content
+
+    entry = epi_cache.lookup(url)
+    if entry is not None and epi_cache.is_fresh(entry):
+        body = epi_cache.read_body(entry)
+        epi_cache.record("hits", len(body))
+        return body
+
+    response = get(url, headers=epi_cache.conditional_headers(entry))
+    if response.status_code == 304 and entry is not None:
+        epi_cache.touch(url, entry)
+        body = epi_cache.read_body(entry)
+        epi_cache.record("revalidated", len(body))
+        return body
+
+    epi_cache.store(url, response)
+    epi_cache.record("misses")
+    return response.content
+
+
+def get_json(url):
+    """Read JSON data from URL, or from the active snapshot"""
+
+    if _snapshot is not None:
+        key = epi_markets.canonical_url(url)
+        if key not in _snapshot:
+            raise SnapshotMissError("URL not in EPI snapshot: %s" % url)
+        return _snapshot[key]
+
+    return json.loads(get_content(url))
+
+
+def _iter_response(url, response):
+    try:
+        for chunk in response.iter_content(CHUNK_SIZE):
+            _record_bytes(url, len(chunk))
+            yield chunk
+    finally:
+        response.close()
+
+
+def iter_content(url):
+    """
+    Yield the body of given URL in chunks without holding all of it in memory,
+    served from the on-disk cache the same way as get_content
+    """
+
+    if not epi_cache.is_cacheable(url):
+        yield from _iter_response(url, get(url, stream=True))
+        return
+
+    entry = epi_cache.lookup(url)
+    if entry is not None and epi_cache.is_fresh(entry):
+        epi_cache.record("hits", os.path.getsize(entry["body_path"]))
+        yield from epi_cache.iter_body(entry, CHUNK_SIZE)
+        return
+
+    response = get(url, headers=epi_cache.conditional_headers(entry), stream=True)
+    if response.status_code == 304 and entry is not None:
+        response.close()
+        epi_cache.touch(url, entry)
+        epi_cache.record("revalidated", os.path.getsize(entry["body_path"]))
+        yield from epi_cache.iter_body(entry, CHUNK_SIZE)
+        return
+
+    epi_cache.record("misses")
+    yield from epi_cache.store_stream(url, response, _iter_response(url, response))
+
+
+def _iter_json_array(chunks):
+    """Parse a JSON array from byte chunks, yielding one element at a time"""
+
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = False
+    for chunk in chunks:
+        buffer += text_decoder.decode(chunk)
+        while True:
+            buffer = buffer.lstrip(" \t\r\n\ufeff")
+            if not started:
+                if not buffer:
+                    break
+                if buffer[0] != "[":
+                    raise ValueError("Expected a JSON list")
+                buffer = buffer[1:]
+                started = True
+                continue
+            buffer = buffer.lstrip(" \t\r\n,")
+            if buffer.startswith("]"):
+                # read to the end so a cached body is stored completely
+                for _ in chunks:
+                    pass
+                return
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # element is not complete yet, read the next chunk
+                break
+            if end == len(buffer):
+                # a number could continue in the next chunk
+                break
+            buffer = buffer[end:]
+            yield item
+    raise ValueError("Unexpected end of JSON list")
+
+
+def project(item, fields):
+    """Keep only given fields of an item, all of them if fields is None"""
+
+    if fields is None or not isinstance(item, dict):
+        return item
+    return {field: item[field] for field in fields if field in item}
+
+
+def iter_json_items(url, fields=None):
+    """
+    Yield the items of a JSON list endpoint one by one, as they are parsed
+    from the response, keeping only given fields of every item
+    """
+
+    if _snapshot is not None:
+        items = get_json(url)
+    else:
+        items = _iter_json_array(iter_content(url))
+    for item in items:
+        yield project(item, fields)
+
+
+def use_snapshot(responses):
+    """
+    Serve get_json from given {url: payload} dictionary instead of EPI,
+    None switches back to live requests
+    """
+
+    global _snapshot
+    _snapshot = responses
+
+
+def _connections(host):
+    """Number of connections opened so far to given host"""
+
+    session = _sessions.get(host)
+    if session is None:
+        return 0
+    try:
+        pools = session.get_adapter("https://%s" % host).poolmanager.pools
+        return sum(
+            getattr(pools[key], "num_connections", 0) for key in pools.keys()
+        )
+    except Exception:
+        return 0
+
+
+def stats():
+    """Return request counters per host"""
+
+    with _lock:
+        result = {}
+        for host, host_stats in _stats.items():
+            result[host] = dict(host_stats)
+            result[host]["connections"] = _connections(host)
+            result[host]["avg_latency"] = (
+                host_stats["seconds"] / host_stats["requests"]
+                if host_stats["requests"]
+                else 0
+            )
+        return result
+
+
+def limiter_state():
+    """Return the current limits of every host, for monitoring"""
+
+    with _lock:
+        limiters = dict(_limiters)
+    return {host: limiter.state() for host, limiter in limiters.items()}
+
+
+def reset_stats():
+    with _lock:
+        _stats.clear()
+    epi_cache.reset_stats()
+
+
+def log_stats():
+    limits = limiter_state()
+    for host, host_stats in sorted(stats().items()):
+        logging.info(
+            "EPI %s: %s requests (%s errors, %s retries), %s connections, %.1f kB, avg latency %.3fs"
+            % (
+                host,
+                host_stats["requests"],
+                host_stats["errors"],
+                host_stats["retries"],
+                host_stats["connections"],
+                host_stats["bytes"] / 1024,
+                host_stats["avg_latency"],
+            )
+        )
+        if host in limits:
+            logging.info(
+                "EPI %s limiter: concurrency %s, %.1f requests/s, %s backoffs, %.1fs waited"
+                % (
+                    host,
+                    limits[host]["concurrency"],
+                    limits[host]["rate"],
+                    limits[host]["backoffs"],
+                    limits[host]["waited"],
+                )
+            )
+    epi_cache.log_stats()
+
+
+def get_json_many(urls_by_key, max_workers=None, reader=None):
+    """
+    Read JSON from several URLs at once, keyed like the given dictionary,
+    with get_json or the given reader function
+
+    Returns a dictionary with the same keys in the same order. Keys whose
+    request failed are left out and logged, so one unavailable market
+    doesn't fail the others.
+    """
+
+    if not urls_by_key:
+        return {}
+
+    workers = max(1, min(max_workers or len(urls_by_key), len(urls_by_key)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            key: executor.submit(reader or get_json, url)
+            for key, url in urls_by_key.items()
+        }
+
+    results = {}
+    for key, future in futures.items():
+        try:
+            results[key] = future.result()
+        except Exception as e:
+            logging.error(
+                "Could not read %s from EPI, error: %s" % (urls_by_key[key], e)
+            )
+    return results
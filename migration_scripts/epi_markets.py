@@ -0,0 +1,86 @@
+"""
+
+EPI market sites by Contentful locale.
+
+Every EPI market has its own site with the same REST endpoints, the sync
+modules build their per-locale endpoint URLs from this list.
+
+SYNC_EPI_BASE_URL redirects all market sites to one server, e.g. the local
+stand-in started by epi_stub_server.py. Every market is then served under its
+locale, e.g. http://localhost:8080/de-DE/rest/b2b/voyages.
+
+"""
+import os
+
+EPI_BASE_URL = os.environ.get("SYNC_EPI_BASE_URL", "").rstrip("/")
+
+MARKET_BASE_URLS = {
+    "en": "https://global.hurtigruten.com",
+    "en-US": "https://www.hurtigruten.com",
+    "en-AU": "https://www.hurtigruten.com.au",
+    "en-GB": "https://www.hurtigruten.co.uk",
+    "de-DE": "https://www.hurtigruten.de",
+    "gsw-CH": "https://www.hurtigruten.ch",
+    "sv-SE": "https://www.hurtigrutenresan.se",
+    "nb-NO": "https://www.hurtigruten.no",
+    "da-DK": "https://www.hurtigruten.dk",
+    "fr-FR": "https://www.hurtigruten.fr",
+}
+
+
+def base_url(locale):
+    """Return base URL of the EPI site of given locale, or of its stand-in"""
+
+    if EPI_BASE_URL:
+        return "%s/%s" % (EPI_BASE_URL, locale)
+    return MARKET_BASE_URLS[locale]
+
+
+def market_url(locale, path):
+    """Return URL of given path on the EPI site of given locale"""
+
+    return base_url(locale) + path
+
+
+def split_stand_in_path(path):
+    """Split a stand-in path like /de-DE/rest/b2b/voyages into locale and path"""
+
+    locale, _, rest = path.lstrip("/").partition("/")
+    if locale not in MARKET_BASE_URLS:
+        return None, path
+    return locale, "/" + rest
+
+
+def canonical_url(url):
+    """
+    Return the URL on the real EPI market site for a URL on the stand-in,
+    snapshots are always keyed by the real URLs
+    """
+
+    if EPI_BASE_URL and url.startswith(EPI_BASE_URL + "/"):
+        locale, path = split_stand_in_path(url[len(EPI_BASE_URL) :])
+        if locale is not None:
+            return MARKET_BASE_URLS[locale] + path
+    return url
+
+
+def market_urls(path):
+    """Return {locale: URL} of given path for every EPI market"""
+
+    return {locale: market_url(locale, path) for locale in MARKET_BASE_URLS}
+
+
+def voyage_excursions_url(voyage_id):
+    return market_url("en-US", "/rest/excursion/voyages/%s/excursions" % voyage_id)
+
+
+def voyage_programs_url(voyage_id):
+    return market_url("en-US", "/rest/program/voyages/%s/excursions" % voyage_id)
+
+
+def ship_url(ship_code):
+    return market_url("en-US", "/rest/b2b/ships/%s" % ship_code)
+
+
+def destinations_url():
+    return market_url("en-GB", "/rest/b2b/destinations")
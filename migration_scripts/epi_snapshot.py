@@ -0,0 +1,215 @@
+"""
+
+This script captures the whole EPI catalog into one gzip compressed, versioned
+snapshot file: voyages with their details for every market and their
+excursion / program relations, excursions, programs, ships and destinations.
+
+The sync scripts can run against a snapshot instead of the EPI market sites
+(run_sync(snapshot=path) or --snapshot path on the command line). That makes
+runs reproducible and lets the transform and Contentful write stages be timed
+without waiting for EPI.
+
+    python epi_snapshot.py capture -o catalog.json.gz
+    python voyages.py --snapshot catalog.json.gz
+
+"""
+import gzip
+import json
+import logging
+from argparse import ArgumentParser
+from datetime import datetime
+
+import epi_client
+import epi_markets
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+SNAPSHOT_FORMAT = "epi-catalog-snapshot"
+SNAPSHOT_VERSION = 1
+
+LIST_PATHS = {
+    "voyages": "/rest/b2b/voyages",
+    "excursions": "/rest/b2b/excursions",
+    "programs": "/rest/b2b/programs",
+}
+
+
+def _ids_from_lists(responses, path):
+    ids = []
+    for url in epi_markets.market_urls(path).values():
+        for item in responses.get(epi_markets.canonical_url(url)) or []:
+            if item["id"] not in ids:
+                ids.append(item["id"])
+    return ids
+
+
+def _ship_codes_from_voyages(responses, voyage_ids):
+    codes = []
+    for voyage_id in voyage_ids:
+        for url in epi_markets.market_urls("/rest/b2b/voyages/%s" % voyage_id).values():
+            ship_codes = (
+                responses.get(epi_markets.canonical_url(url)) or {}
+            ).get("shipCodes") or []
+            if isinstance(ship_codes, str):
+                ship_codes = [ship_codes]
+            codes += [code for code in ship_codes if code and code not in codes]
+    return codes
+
+
+def capture(voyage_ids=None, ship_codes=None, concurrency=10):
+    """
+    Download the EPI catalog and return it as snapshot dictionary
+
+    voyage_ids :
+        Voyages to capture, all voyages listed by any market if None
+
+    ship_codes :
+        Ships to capture, all ships of the captured voyages if None
+    """
+
+    responses = {}
+
+    def fetch(urls):
+        logging.info("Capturing %s EPI responses" % len(urls))
+        responses.update(
+            epi_client.get_json_many(
+                {epi_markets.canonical_url(url): url for url in urls},
+                max_workers=concurrency,
+            )
+        )
+
+    fetch(
+        [
+            url
+            for path in LIST_PATHS.values()
+            for url in epi_markets.market_urls(path).values()
+        ]
+        + [epi_markets.destinations_url()]
+    )
+
+    if voyage_ids is None:
+        voyage_ids = _ids_from_lists(responses, LIST_PATHS["voyages"])
+
+    voyage_urls = []
+    for voyage_id in voyage_ids:
+        voyage_urls += list(
+            epi_markets.market_urls("/rest/b2b/voyages/%s" % voyage_id).values()
+        )
+        voyage_urls.append(epi_markets.voyage_excursions_url(voyage_id))
+        voyage_urls.append(epi_markets.voyage_programs_url(voyage_id))
+    fetch(voyage_urls)
+
+    if ship_codes is None:
+        ship_codes = _ship_codes_from_voyages(responses, voyage_ids)
+    fetch([epi_markets.ship_url(ship_code) for ship_code in ship_codes])
+
+    return build(responses, voyage_ids, ship_codes)
+
+
+def build(responses, voyage_ids=None, ship_codes=None):
+    """
+    Return snapshot dictionary of given {url: payload} responses
+
+    Voyages and ships default to the ones found in the responses.
+    """
+
+    if voyage_ids is None:
+        voyage_ids = _ids_from_lists(responses, LIST_PATHS["voyages"])
+    if ship_codes is None:
+        ship_codes = _ship_codes_from_voyages(responses, voyage_ids)
+
+    return {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "created_at": datetime.utcnow().isoformat() + "Z",
+        "ids": {
+            "voyages": voyage_ids,
+            "excursions": _ids_from_lists(responses, LIST_PATHS["excursions"]),
+            "programs": _ids_from_lists(responses, LIST_PATHS["programs"]),
+            "ships": ship_codes,
+        },
+        "responses": responses,
+    }
+
+
+def save(snapshot, path):
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        json.dump(snapshot, f)
+
+
+def load(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        snapshot = json.load(f)
+
+    if snapshot.get("format") != SNAPSHOT_FORMAT:
+        raise ValueError("%s is not an EPI catalog snapshot" % path)
+    if snapshot.get("version") != SNAPSHOT_VERSION:
+        raise ValueError(
+            "Unsupported EPI snapshot version %s in %s, expected %s"
+            % (snapshot.get("version"), path, SNAPSHOT_VERSION)
+        )
+    return snapshot
+
+
+def use(path):
+    """
+    Read EPI content from the snapshot at given path for the current run,
+    None switches back to the live EPI market sites
+    """
+
+    if not path:
+        epi_client.use_snapshot(None)
+        return
+
+    snapshot = load(path)
+    logging.info(
+        "Using EPI snapshot %s created at %s (%s responses)"
+        % (path, snapshot["created_at"], len(snapshot["responses"]))
+    )
+    epi_client.use_snapshot(snapshot["responses"])
+
+
+def log_summary(snapshot):
+    logging.info("Snapshot created at: %s" % snapshot["created_at"])
+    for kind, ids in snapshot["ids"].items():
+        logging.info("Number of %s: %s" % (kind, len(ids)))
+    logging.info("Number of EPI responses: %s" % len(snapshot["responses"]))
+
+
+parser = ArgumentParser(
+    prog="epi_snapshot.py", description="Capture or inspect an EPI catalog snapshot"
+)
+subparsers = parser.add_subparsers(dest="command")
+capture_parser = subparsers.add_parser("capture", help="Capture the EPI catalog")
+capture_parser.add_argument(
+    "-o", "--output", required=True, help="Snapshot file to write, e.g. catalog.json.gz"
+)
+capture_parser.add_argument(
+    "-ids", "--voyage_ids", nargs="+", type=int, help="Only capture these voyage IDs"
+)
+capture_parser.add_argument(
+    "-ships", "--ship_codes", nargs="+", type=str, help="Only capture these ship codes"
+)
+capture_parser.add_argument(
+    "-c", "--concurrency", type=int, default=10, help="Parallel EPI requests"
+)
+info_parser = subparsers.add_parser("info", help="Show what a snapshot contains")
+info_parser.add_argument("path", help="Snapshot file")
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.command == "capture":
+        snapshot = capture(args.voyage_ids, args.ship_codes, args.concurrency)
+        save(snapshot, args.output)
+        log_summary(snapshot)
+        epi_client.log_stats()
+        logging.info("Snapshot saved: %s" % args.output)
+    elif args.command == "info":
+        log_summary(load(args.path))
+    else:
+        parser.print_help()
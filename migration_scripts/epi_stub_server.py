@@ -0,0 +1,291 @@
+"""
+
+Local stand-in for the EPI market sites, for measuring sync performance
+without sending requests to the production sites.
+
+The server replays the responses of a snapshot captured with epi_snapshot.py.
+Every market is served under its locale, point the sync scripts to the server
+with SYNC_EPI_BASE_URL:
+
+    python epi_snapshot.py capture -ids 12345 23456 -o catalog.json.gz
+    python epi_stub_server.py catalog.json.gz --port 8080 --latency 0.2 --error-rate 0.01
+    SYNC_EPI_BASE_URL=http://localhost:8080 python voyages.py
+
+--record forwards requests the snapshot doesn't contain to the real market
+site and saves the extended snapshot when the server stops. --voyages,
+--excursions and --programs add synthetic copies of the captured items to
+test with a larger catalog. Synthetic voyages only exist in EPI, sync them
+with voyages.py --epi_voyage_ids into an environment other than master:
+
+    SYNC_EPI_BASE_URL=http://localhost:8080 SYNC_CONTENTFUL_ENVIRONMENT=bench \
+        python voyages.py --epi_voyage_ids
+
+"""
+import copy
+import gzip
+import hashlib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import epi_client
+import epi_markets
+import epi_snapshot
+
+logging.basicConfig(
+    format="%(asctime)s %(levelname)-8s %(message)s",
+    level=logging.INFO,
+    datefmt="%Y-%m-%d %H:%M:%S",
+)
+
+
+def _real_urls(path):
+    return {
+        locale: base_url + path
+        for locale, base_url in epi_markets.MARKET_BASE_URLS.items()
+    }
+
+
+def _next_id(responses, path):
+    ids = [
+        item["id"]
+        for url in _real_urls(path).values()
+        for item in responses.get(url) or []
+        if isinstance(item.get("id"), int)
+    ]
+    return max(ids, default=0) + 1
+
+
+def scale_list(responses, path, count):
+    """
+    Add `count` synthetic items to the list endpoint of given path in every
+    market, copied from the captured items. Returns [(template id, new id)].
+    The lists are replaced, not changed, so a shallow copy of the responses
+    can be scaled without touching the captured ones.
+    """
+
+    lists = {
+        url: list(responses[url]) for url in _real_urls(path).values() if responses.get(url)
+    }
+    templates = []
+    for items in lists.values():
+        templates += [item["id"] for item in items if item["id"] not in templates]
+    if not templates:
+        logging.warning("No items captured for %s, nothing to scale" % path)
+        return []
+
+    first_id = _next_id(responses, path)
+    copies = [(templates[i % len(templates)], first_id + i) for i in range(count)]
+    for url, items in lists.items():
+        by_id = {item["id"]: item for item in items}
+        for template_id, new_id in copies:
+            if template_id in by_id:
+                item = copy.deepcopy(by_id[template_id])
+                item["id"] = new_id
+                items.append(item)
+        responses[url] = items
+    return copies
+
+
+def scale_voyages(responses, count):
+    """Add synthetic voyages with their details and relations"""
+
+    copies = scale_list(responses, epi_snapshot.LIST_PATHS["voyages"], count)
+    for template_id, new_id in copies:
+        for locale, base_url in epi_markets.MARKET_BASE_URLS.items():
+            detail = responses.get("%s/rest/b2b/voyages/%s" % (base_url, template_id))
+            if detail is not None:
+                detail = copy.deepcopy(detail)
+                detail["id"] = new_id
+                responses["%s/rest/b2b/voyages/%s" % (base_url, new_id)] = detail
+        base_url = epi_markets.MARKET_BASE_URLS["en-US"]
+        for relation in ("excursion", "program"):
+            url = "%s/rest/%s/voyages/%%s/excursions" % (base_url, relation)
+            if url % template_id in responses:
+                responses[url % new_id] = responses[url % template_id]
+    return copies
+
+
+class StubServer(ThreadingHTTPServer):
+    """Serves a snapshot with injected latency and errors"""
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        responses,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        error_status=503,
+        record=False,
+    ):
+        super().__init__(address, StubHandler)
+        self.responses = responses
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.record = record
+        self.recorded = {}
+        self.lock = threading.Lock()
+        self.counters = {"requests": 0, "errors": 0, "misses": 0, "recorded": 0}
+
+    def count(self, counter):
+        with self.lock:
+            self.counters[counter] += 1
+
+    def payload(self, url):
+        """Return the response for given real market URL, None if there is none"""
+
+        with self.lock:
+            if url in self.responses:
+                return self.responses[url]
+        if not self.record:
+            return None
+
+        payload = epi_client.get_json(url)
+        with self.lock:
+            self.responses[url] = payload
+            self.recorded[url] = payload
+        self.count("recorded")
+        return payload
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        time.sleep(server.latency + random.uniform(0, server.jitter))
+
+        if random.random() < server.error_rate:
+            server.count("errors")
+            headers = {"Retry-After": "1"} if server.error_status == 429 else {}
+            return self._send(server.error_status, b"", headers)
+
+        locale, path = epi_markets.split_stand_in_path(self.path)
+        if locale is None:
+            return self._send(404, b"")
+        url = epi_markets.MARKET_BASE_URLS[locale] + path
+        try:
+            payload = server.payload(url)
+        except Exception as e:
+            logging.error("Could not record %s, error: %s" % (url, e))
+            return self._send(502, b"")
+        if payload is None:
+            server.count("misses")
+            logging.warning("Not in snapshot: %s" % url)
+            return self._send(404, b"")
+
+        body = json.dumps(payload).encode("utf-8")
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        if self.headers.get("If-None-Match") == etag:
+            return self._send(304, b"", {"ETag": etag})
+        headers = {"ETag": etag, "Content-Type": "application/json; charset=utf-8"}
+        if "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        self._send(200, body, headers)
+
+    def _send(self, status, body, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def serve(args):
+    if os.path.exists(args.snapshot):
+        responses = epi_snapshot.load(args.snapshot)["responses"]
+    elif args.record:
+        responses = {}
+    else:
+        raise SystemExit("Snapshot not found: %s" % args.snapshot)
+
+    # synthetic items are served but never saved with --record
+    captured = responses
+    responses = dict(captured)
+    for kind, count in (
+        ("voyages", args.voyages),
+        ("excursions", args.excursions),
+        ("programs", args.programs),
+    ):
+        if count:
+            if kind == "voyages":
+                copies = scale_voyages(responses, count)
+            else:
+                copies = scale_list(responses, epi_snapshot.LIST_PATHS[kind], count)
+            logging.info("Added %s synthetic %s" % (len(copies), kind))
+
+    server = StubServer(
+        (args.host, args.port),
+        responses,
+        latency=args.latency,
+        jitter=args.jitter,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        record=args.record,
+    )
+    logging.info(
+        "Serving %s EPI responses on http://%s:%s, set SYNC_EPI_BASE_URL to use it"
+        % (len(responses), args.host, args.port)
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logging.info(
+            "Served %(requests)s requests, %(errors)s injected errors, %(misses)s misses, %(recorded)s recorded"
+            % server.counters
+        )
+        if args.record and server.counters["recorded"]:
+            captured.update(server.recorded)
+            epi_snapshot.save(epi_snapshot.build(captured), args.snapshot)
+            logging.info("Snapshot saved: %s" % args.snapshot)
+
+
+parser = ArgumentParser(
+    prog="epi_stub_server.py", description="Serve an EPI snapshot as local stand-in"
+)
+parser.add_argument("snapshot", help="Snapshot file created by epi_snapshot.py")
+parser.add_argument("--host", default="localhost")
+parser.add_argument("--port", type=int, default=8080)
+parser.add_argument(
+    "--latency", type=float, default=0.0, help="Seconds added to every response"
+)
+parser.add_argument(
+    "--jitter", type=float, default=0.0, help="Random extra seconds up to this value"
+)
+parser.add_argument(
+    "--error-rate", type=float, default=0.0, help="Share of requests that fail, 0-1"
+)
+parser.add_argument(
+    "--error-status", type=int, default=503, help="Status code of injected errors"
+)
+parser.add_argument(
+    "--record",
+    action="store_true",
+    help="Fetch responses missing from the snapshot from EPI and save them",
+)
+parser.add_argument("--voyages", type=int, help="Add this many synthetic voyages")
+parser.add_argument("--excursions", type=int, help="Add this many synthetic excursions")
+parser.add_argument("--programs", type=int, help="Add this many synthetic programs")
+
+
+if __name__ == "__main__":
+    serve(parser.parse_args())
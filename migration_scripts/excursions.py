@@ -6,12 +6,22 @@ same as entry id in Epi. To update excursions they first need to be deleted from
 and then imported from Episerver by this script.
 
 """
+import asset_processing
 import config
+import cf_index
 import helpers
+from commit_graph import CommitGraph
+import epi_client
+import epi_markets
+import epi_snapshot
+import pipeline
+import plan
 import logging
 import re
 import unicodedata
 from argparse import ArgumentParser
+from catalog import LocalizedCatalog
+from destinations import DestinationResolver
 
 logging.basicConfig(
     format="%(asctime)s %(levelname)-8s %(message)s",
@@ -19,19 +29,38 @@ logging.basicConfig(
     datefmt="%Y-%m-%d %H:%M:%S",
 )
 
-CMS_API_URLS = {
-    "en": "https://global.hurtigruten.com/rest/b2b/excursions",
-    "en-US": "https://www.hurtigruten.com/rest/b2b/excursions",
-    "en-AU": "https://www.hurtigruten.com.au/rest/b2b/excursions",
-    "de-DE": "https://www.hurtigruten.de/rest/b2b/excursions",
-    "en-GB": "https://www.hurtigruten.co.uk/rest/b2b/excursions",
-    "gsw-CH": "https://www.hurtigruten.ch/rest/b2b/excursions",
-    "sv-SE": "https://www.hurtigrutenresan.se/rest/b2b/excursions",
-    "nb-NO": "https://www.hurtigruten.no/rest/b2b/excursions",
-    "da-DK": "https://www.hurtigruten.dk/rest/b2b/excursions",
-    "fr-FR": "https://www.hurtigruten.fr/rest/b2b/excursions",
-}
-excursions_by_locale = {}
+CMS_API_URLS = epi_markets.market_urls("/rest/b2b/excursions")
+
+# Fields of the EPI excursions used by the sync, everything else is dropped while reading
+EXCURSION_FIELDS = [
+    "id",
+    "url",
+    "heading",
+    "title",
+    "intro",
+    "body",
+    "summary",
+    "secondaryBody",
+    "image",
+    "isFallbackContent",
+    "isOnlyBookableOnboard",
+    "duration",
+    "durationText",
+    "requirements",
+    "physicalLevel",
+    "bookingCode",
+    "code",
+    "sellingPoints",
+    "price",
+    "priceValue",
+    "currency",
+    "activityCategory",
+    "years",
+    "seasons",
+    "destinations",
+    "minimumNumberOfGuests",
+    "maximumNumberOfGuests",
+]
 
 difficulty_dict = {
     "1": "Level 1 - For everyone",
@@ -60,6 +89,7 @@ def prepare_environment():
     )
 
     logging.info("Using Contentful environment: %s" % config.CTFL_ENV_ID)
+    cf_index.load(contentful_environment)
     logging.info(
         "Get all excursions for locales: %s"
         % (", ".join([key for key, _ in CMS_API_URLS.items()]))
@@ -73,42 +103,14 @@ def prepare_environment():
         raise Exception('gggggg')
     # return cf_eids, contentful_environment
 
-    excursion_ids = []
-    epi_excursion_ids = []
-
-    for locale, url in CMS_API_URLS.items():
-        excursions_by_locale[locale] = helpers.read_json_data(url)
-        excursion_ids += [
-            excursion["id"]
-            for excursion in excursions_by_locale[locale]
-            #if helpers.skip_entry_if_not_updated(excursion, locale, excursion["id"])
-        ]
-        epi_excursion_ids += [
-            str(excursion["id"]) for excursion in excursions_by_locale[locale]
-        ]
-        # logging.info(
-        #     "Number of excursions in EPI: %s for locale: %s"
-        #     % (len(excursions_by_locale[locale]), locale)
-        # )
-
-    # logging.info("-----------------------------------------------------")
-    # logging.info("")
-
-    # # Create distinct list
-    # excursion_ids = set(excursion_ids)
-    # epi_excursion_ids = set(epi_excursion_ids)
-
-    # logging.info("Number of migrating excursions: %s" % len(epi_excursion_ids))
-    # # logging.info("")
-
-    # # logging.info("Excursion IDs to migrate: ")
-    # # for excursion_id in epi_excursion_ids:
-    # #     logging.info(excursion_id)
+    excursion_catalog = LocalizedCatalog.from_urls(
+        CMS_API_URLS, max_workers=config.EPI_MARKET_CONCURRENCY, fields=EXCURSION_FIELDS
+    )
+    logging.info("Number of excursions in EPI: %s" % len(excursion_catalog))
 
-    # logging.info("-----------------------------------------------------")
-    # logging.info("")
+    destination_resolver = DestinationResolver.load(contentful_environment)
 
-    return cf_eids, contentful_environment
+    return cf_eids, contentful_environment, excursion_catalog, destination_resolver
 
 def remove_fields_if_fallback(dict, isFallback):
     if (not isFallback):
@@ -125,27 +127,13 @@ def remove_fields_if_fallback(dict, isFallback):
     return out
     
 
-def update_excursion(contentful_environment, excursion_id):
+def update_excursion(
+    contentful_environment, excursion_id, excursion_catalog, destination_resolver
+):
     logging.info("Excursion migration started with ID: %s" % excursion_id)
 
-    excursion_by_locale = {}
-
-    for locale, excursions in excursions_by_locale.items():
-        # # Dont overwrite en
-        # if locale == 'en':
-        #     continue
-        
-        # Filter down to the one excursion by locale from all the excursions
-        excursion = next(
-            (excursion for excursion in excursions if excursion["id"] == int(excursion_id)),
-            None,
-        )
-        if excursion is not None:
-            excursion_by_locale[locale] = excursion
-
-    default_excursion = excursion_by_locale.get(config.DEFAULT_LOCALE)
-    if (default_excursion is None and len(list(excursion_by_locale.values())) > 0):
-        default_excursion = list(excursion_by_locale.values())[0]
+    excursion_by_locale = excursion_catalog.by_locale(excursion_id)
+    default_excursion = excursion_catalog.default(excursion_id, config.DEFAULT_LOCALE)
 
     if default_excursion is None:
         logging.info(excursion_by_locale)
@@ -156,8 +144,13 @@ def update_excursion(contentful_environment, excursion_id):
         return
     
 
+    # the image, its wrapper and the excursion are written by graph.commit()
+    graph = CommitGraph("Excursion %s" % excursion_id)
+
     image_link = (
-        helpers.add_or_reuse_asset(
+        graph.add(
+            "asset",
+            helpers.add_or_reuse_asset,
             environment=contentful_environment,
             asset_uri= relative_url_to_absolute_url(default_excursion["image"]["imageUrl"]),
             id="excp-%s" % default_excursion["id"],
@@ -205,7 +198,10 @@ def update_excursion(contentful_environment, excursion_id):
     
 
     image_wrapper_link = (
-        helpers.add_entry(
+        graph.add(
+            "entry",
+            helpers.add_entry,
+            optional=True,
             environment=contentful_environment,
             id="excp-%s" % default_excursion["id"],
             content_type_id="imageWrapper",
@@ -217,14 +213,8 @@ def update_excursion(contentful_environment, excursion_id):
     )
     
     
-    destination_ids = list(
-        filter(
-            None,
-            [
-                helpers.destination_name_to_cf_id(contentful_environment, d)
-                for d in default_excursion.get("destinations")
-            ],
-        )
+    destination_ids = destination_resolver.names_to_cf_ids(
+        default_excursion.get("destinations")
     )
     destination_links = [helpers.entry_link(di) for di in destination_ids]
     
@@ -304,17 +294,21 @@ def update_excursion(contentful_environment, excursion_id):
         )
     )
 
-    helpers.add_entry(
+    graph.add(
+        "entry",
+        helpers.add_entry,
         environment=contentful_environment,
         id=str(excursion_id),
         content_type_id="excursion",
         market=None,
         fields=helpers.merge_localized_dictionaries(*localized_excursion_fields),
     )
+    graph.commit()
 
     logging.info("Excursion migration finished with ID: %s" % excursion_id)
 
 
+@plan.plannable("Excursions")
 def run_sync(**kwargs):
     parameter_excursion_ids = kwargs.get("content_ids")
     include = kwargs.get("include")
@@ -333,21 +327,36 @@ def run_sync(**kwargs):
             )
     else:
         logging.info("Running excursions sync")
-    epi_excursion_ids, contentful_environment = prepare_environment()
-    epi_excursion_ids = [str(i) for i in epi_excursion_ids]
-
-    for eei, excursion_id in enumerate(parameter_excursion_ids):
-        if parameter_excursion_ids is not None:
-            # run only included excursions
-            if include and excursion_id not in parameter_excursion_ids:
-                continue
-            # skip excluded excursions
-            if not include and excursion_id in parameter_excursion_ids:
-                continue
-        try:
-            update_excursion(contentful_environment, excursion_id)
-            logging.info("Updated %s/%s excursions" % (eei, len(parameter_excursion_ids)))
-        except Exception as e:
+    epi_client.reset_stats()
+    helpers.reset_write_stats()
+    epi_snapshot.use(kwargs.get("snapshot"))
+    with plan.timed("prepare"):
+        (
+            epi_excursion_ids,
+            contentful_environment,
+            excursion_catalog,
+            destination_resolver,
+        ) = prepare_environment()
+    asset_processing.start(contentful_environment)
+    try:
+        epi_excursion_ids = [str(i) for i in epi_excursion_ids]
+
+        # run only included excursions, skip excluded excursions
+        excursion_ids = [
+            excursion_id
+            for excursion_id in parameter_excursion_ids
+            if (excursion_id in parameter_excursion_ids) == bool(include)
+        ]
+
+        def write_excursion(excursion_id):
+            update_excursion(
+                contentful_environment,
+                excursion_id,
+                excursion_catalog,
+                destination_resolver,
+            )
+
+        def on_error(excursion_id, stage, e):
             logging.error(
                 "Excursion migration error with ID: %s, error: %s" % (excursion_id, e)
             )
@@ -356,6 +365,26 @@ def run_sync(**kwargs):
                 for locale, url in CMS_API_URLS.items()
             ]
 
+        def on_done(eei, excursion_id, result):
+            logging.info("Updated %s/%s excursions" % (eei, len(parameter_excursion_ids)))
+
+        # EPI content of all excursions is already in the catalog, so there is
+        # nothing to read ahead and the writes are the only stage
+        stats = pipeline.run(
+            excursion_ids,
+            [pipeline.Stage("write", write_excursion)],
+            queue_size=config.PIPELINE_QUEUE_SIZE,
+            on_error=on_error,
+            on_done=on_done,
+            name="Excursions",
+        )
+        pipeline.log_stats("Excursions", stats)
+        plan.add_stage_stats("Excursions", stats)
+    finally:
+        asset_processing.finish(contentful_environment)
+    epi_client.log_stats()
+    helpers.log_write_stats()
+
 
 parser = ArgumentParser(
     prog="excursions.py", description="Run excursion sync between Contentful and EPI"
@@ -372,9 +401,30 @@ parser.add_argument(
     default=True,
     help="Specify if you want to include or exclude " "excursion IDs",
 )
+parser.add_argument(
+    "-snapshot",
+    "--snapshot",
+    type=str,
+    help="Read EPI content from a snapshot created by epi_snapshot.py",
+)
+parser.add_argument(
+    "-plan",
+    "--plan",
+    nargs="?",
+    const=True,
+    help="Only plan the sync: log the writes it would make and save them to the given JSON file",
+)
 args = parser.parse_args()
 
 if __name__ == "__main__":
     ids = vars(args)["content_ids"]
     include = vars(args)["include"]
-    run_sync(**{"content_ids": ids, "include": include})
+    snapshot = vars(args)["snapshot"]
+    run_sync(
+        **{
+            "content_ids": ids,
+            "include": include,
+            "snapshot": snapshot,
+            "plan": vars(args)["plan"],
+        }
+    )
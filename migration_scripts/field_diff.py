@@ -0,0 +1,95 @@
+"""
+
+Field level comparison of Contentful entries.
+
+The sync computes the fields of every entry from EPI on every run, although
+almost none of them change between runs. canonical_fields() brings the
+fields of an entry into one comparable form, whether they were read from
+Contentful or set by the sync:
+
+- field ids are compared snake_cased, the client keeps fields read from
+  Contentful snake_cased and fields set by the sync camelCased
+- links are compared by link type and id, whether they are Link objects,
+  resources or plain link dicts
+- rich text nodes are compared without empty data, marks and content
+- empty values (None) are the same as a missing field or locale, Contentful
+  doesn't return them
+
+add_entry compares the fields before and after applying the computed fields
+and skips the save when they are the same.
+
+"""
+import re
+from datetime import date, datetime
+
+RICH_TEXT_OPTIONAL_KEYS = ("data", "marks", "content")
+
+
+def snake_case(field_id):
+    """Same conversion as contentful_management.utils.snake_case"""
+
+    partial = re.sub("(.)([A-Z][a-z]+)", r"\1_\2", field_id)
+    return re.sub("([a-z0-9])([A-Z])", r"\1_\2", partial).lower()
+
+
+def _link(link_type, link_id):
+    return {"link": [link_type, str(link_id)]}
+
+
+def normalize(value):
+    """Return given field value in its canonical form"""
+
+    sys = getattr(value, "sys", None)
+    if isinstance(sys, dict):
+        # Link object or resource of the client
+        if sys.get("type") == "Link":
+            return _link(sys.get("link_type") or sys.get("linkType"), sys.get("id"))
+        return _link(sys.get("type"), sys.get("id"))
+
+    if isinstance(value, dict):
+        sys = value.get("sys")
+        if isinstance(sys, dict) and sys.get("type") == "Link":
+            return _link(sys.get("linkType"), sys.get("id"))
+        result = {}
+        is_rich_text_node = "nodeType" in value
+        for key, item in value.items():
+            item = normalize(item)
+            if is_rich_text_node and key in RICH_TEXT_OPTIONAL_KEYS and not item:
+                continue
+            result[key] = item
+        return result
+
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+
+def canonical_fields(entry):
+    """
+    Return {field id: {locale: value}} of given entry in canonical form,
+    field ids snake_cased and empty values left out
+    """
+
+    result = {}
+    for locale, fields in entry._fields.items():
+        for field_id, value in fields.items():
+            # a camelCased key set by the sync overrides the snake_cased
+            # key read from Contentful, the same as when the entry is saved
+            field = result.setdefault(snake_case(field_id), {})
+            if value is None:
+                field.pop(locale, None)
+            else:
+                field[locale] = normalize(value)
+    return {field_id: locales for field_id, locales in result.items() if locales}
+
+
+def changed_fields(before, after):
+    """Return the sorted ids of the fields that differ between two canonical_fields()"""
+
+    return sorted(
+        field_id
+        for field_id in set(before) | set(after)
+        if before.get(field_id) != after.get(field_id)
+    )
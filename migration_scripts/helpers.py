@@ -1,14 +1,25 @@
 import argparse
+import functools
+import io
 import json
-import sys
+import time
 import contentful_management
 import requests
 import logging
 import logging.config
+import threading
 import os
 import config
+import cf_index
+import cf_loader
+import asset_hashes
+import asset_probe
+import asset_processing
+import cma_client
+import field_diff
+import image_resize
+import plan
 from re import split
-from PIL import Image
 from urllib.request import Request, urlopen
 from urllib.parse import urlparse
 from os.path import splitext, basename
@@ -36,22 +47,42 @@ logging.config.dictConfig({
     'disable_existing_loggers': True
 })
 
-def read_json_data(url):
-    """Read JSON data from URL"""
-
-    req = Request(url, headers={"User-Agent": "Mozilla/5.0"})
-    response = urlopen(req).read()
-    return json.loads(response)
-
-
 def create_contentful_environment(space_id, env_id, cma_key):
     """Create Contentful environment given space, environment and Content Management API key"""
-    client = contentful_management.Client(cma_key)
-    client.default_locale = config.DEFAULT_LOCALE
+    client = cma_client.get_client(cma_key, default_locale=config.DEFAULT_LOCALE)
 
     return client.environments(space_id).find(env_id)
 
 
+_id_locks = {}
+_id_locks_lock = threading.Lock()
+
+
+def id_lock(kind, resource_id):
+    """
+    Lock for writing the entry / asset with given id, so sync threads that
+    share an entry (e.g. a port used by several voyages) don't create or save
+    it at the same time
+    """
+
+    with _id_locks_lock:
+        return _id_locks.setdefault((kind, resource_id), threading.RLock())
+
+
+def locked_by_id(kind):
+    """Run the decorated add / create function under the id_lock of its id"""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(**kwargs):
+            with id_lock(kind, kwargs["id"]):
+                return function(**kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 def camelize(string):
     pascalized = "".join(
         a.capitalize()
@@ -69,6 +100,10 @@ def extract_first_letters(string):
 
 def get_entry(environment, entry_id):
     try:
+        entry = cf_loader.entries(environment).load(entry_id)
+        if entry is not None:
+            return entry
+        # read it on its own for the not found error
         entry = environment.entries().find(entry_id)
         return entry
     except contentful_management.errors.NotFoundError as e:
@@ -166,6 +201,9 @@ def create_lookup_id(id, region):
 
 
 def update_entry_database(id, region):
+    if plan.active():
+        # a planned item is still written by the next real run
+        return
     entry_id = create_lookup_id(id, region)
     crc = prev[entry_id]
     container.upsert_item(
@@ -201,12 +239,21 @@ def skip_entry_if_not_updated(entry, region, skip_id):
 def delete_entry_if_exists(environment, entry_id):
     """Unpublish and delete entry with given id"""
 
+    if cf_index.exists(environment, "entry", entry_id) is False:
+        logging.info("Entry not found: %s, can't be deleted" % entry_id)
+        return
+
     try:
         entry = environment.entries().find(entry_id)
         logging.info("Entry exists: %s" % entry_id)
+        if plan.active():
+            plan.record("delete", "entry", entry_id)
+            return
         if entry.is_published:
             entry.unpublish()
         environment.entries().delete(entry_id)
+        cf_index.remove(environment, "entry", entry_id)
+        cf_loader.entries(environment).set(entry_id, None)
         logging.info("Entry deleted: %s" % entry_id)
     except contentful_management.errors.NotFoundError:
         logging.info("Entry not found: %s, can't be deleted" % entry_id)
@@ -222,12 +269,21 @@ def delete_entry_if_exists(environment, entry_id):
 def delete_asset_if_exists(environment, asset_id):
     """Unpublish and delete asset with given id"""
 
+    if cf_index.exists(environment, "asset", asset_id) is False:
+        logging.info("Asset not found: %s, can't be deleted" % asset_id)
+        return
+
     try:
         asset = environment.assets().find(asset_id)
         logging.info("Asset exists: %s" % asset_id)
+        if plan.active():
+            plan.record("delete", "asset", asset_id)
+            return
         if asset.is_published:
             asset.unpublish()
         environment.assets().delete(asset_id)
+        cf_index.remove(environment, "asset", asset_id)
+        cf_loader.assets(environment).set(asset_id, None)
         logging.info("Asset deleted: %s" % asset_id)
     except contentful_management.errors.NotFoundError:
         logging.info("Asset not found: %s, can't be deleted" % asset_id)
@@ -241,11 +297,17 @@ def delete_asset_if_exists(environment, asset_id):
 
 
 def is_entry_exists(environment, entry_id):
+    planned = plan.exists("entry", entry_id)
+    if planned is not None:
+        return planned
+
+    indexed = cf_index.exists(environment, "entry", entry_id)
+    if indexed is not None:
+        count_write("existence_checks_saved")
+        return indexed
+
     try:
-        environment.entries().find(entry_id)
-        return True
-    except contentful_management.errors.NotFoundError:
-        return False
+        return cf_loader.entries(environment).load(entry_id) is not None
     except Exception as e:
         logging.error(
             "Exception occurred while finding entry with ID: %s, error: %s "
@@ -255,11 +317,17 @@ def is_entry_exists(environment, entry_id):
 
 
 def is_asset_exists(environment, asset_id):
+    planned = plan.exists("asset", asset_id)
+    if planned is not None:
+        return planned
+
+    indexed = cf_index.exists(environment, "asset", asset_id)
+    if indexed is not None:
+        count_write("existence_checks_saved")
+        return indexed
+
     try:
-        environment.assets().find(asset_id)
-        return True
-    except contentful_management.errors.NotFoundError:
-        return False
+        return cf_loader.assets(environment).load(asset_id) is not None
     except Exception as e:
         logging.error(
             "Exception occurred while finding asset with ID: %s, error: %s "
@@ -284,7 +352,8 @@ def convert_to_contentful_rich_text(html_content):
     json_data = json.dumps({"from": "html", "to": "richtext", "html": html_content})
     json_data_as_bytes = json_data.encode("utf-8")
     req.add_header("Content-Length", str(len(json_data_as_bytes)))
-    response = urlopen(req, json_data_as_bytes).read()
+    with plan.timed("convert rich text"):
+        response = urlopen(req, json_data_as_bytes).read()
     return json.loads(response)
 
 
@@ -310,6 +379,7 @@ def clean_asset_name(name, asset_id):
     )
 
 
+@locked_by_id("asset")
 def add_or_reuse_asset(**kwargs):
     environment = kwargs["environment"]
     id = kwargs["id"]
@@ -326,6 +396,7 @@ def add_or_reuse_asset(**kwargs):
     return asset_link(id)
 
 
+@locked_by_id("asset")
 def create_asset(**kwargs):
     image_url = kwargs["asset_uri"].split("?")[0]
     id = kwargs["id"]
@@ -379,34 +450,32 @@ def create_asset(**kwargs):
             },
         }
     }
+    if plan.active():
+        return plan_upload(id, image_url, asset_type, asset_size)
     
     IMAGE_SIZE_LIMIT = 15000000
     if (int(asset_size) >= IMAGE_SIZE_LIMIT):
         logging.info('Maximum image size exceeded. Size: %s' % asset_size)
-        
-        image_local =  image_url.split('/')[-1]
-        
-        r = requests.get(image_url)
-        with open('/' + image_local, 'wb') as outfile:
-            outfile.write(r.content)
-            
-        img = Image.open('/' + image_local)
-        max_size = (4000, 4000)
-        img.thumbnail(max_size)
-        img.save('optimized_'+image_local)
-        
-        new_image_size = os.stat('optimized_'+image_local).st_size
-        if (new_image_size > IMAGE_SIZE_LIMIT):
-            logging.error('Image scaling unsuccessful, size limit still exceeded. Size: %s, URL: %s' % (sys.getsizeof(img.tobytes()), image_url))
+
+        try:
+            with image_resize.fetch(image_url) as download:
+                resized = image_resize.optimise(download.path, IMAGE_SIZE_LIMIT)
+        except Exception as e:
+            logging.error('Image scaling unsuccessful. URL: %s' % image_url)
+            logging.error(e)
             return
-        
-        logging.info('Image size after scaling: %s' % new_image_size)
-        
-        image_url = 'optimized_' + image_local
-        
+
+        if (len(resized.data) > IMAGE_SIZE_LIMIT):
+            logging.error('Image scaling unsuccessful, size limit still exceeded. Size: %s, URL: %s' % (len(resized.data), image_url))
+            return
+
+        logging.info('Image size after scaling: %s' % len(resized.data))
+
         try:
-            uclient = contentful_management.Client(config.CTFL_MGMT_API_KEY)
-            uploaded_img = uclient.uploads(config.CTFL_SPACE_ID).create(image_url)
+            uclient = cma_client.get_client(config.CTFL_MGMT_API_KEY)
+            upload_started = time.perf_counter()
+            uploaded_img = uclient.uploads(config.CTFL_SPACE_ID).create(io.BytesIO(resized.data))
+            image_resize.log_result(image_url, download, resized, time.perf_counter() - upload_started)
             asset_attributes = {
                 "fields": {
                     "title": {config.DEFAULT_LOCALE: clean_asset_name(name, id)},
@@ -420,7 +489,7 @@ def create_asset(**kwargs):
                                     "id": uploaded_img.id
                                 }
                             },
-                            "contentType": asset_type,
+                            "contentType": resized.content_type or asset_type,
                         }
                     },
                 }
@@ -432,21 +501,15 @@ def create_asset(**kwargs):
             return
 
     try:
-        kwargs["environment"].assets().create(id, asset_attributes)
+        asset = kwargs["environment"].assets().create(id, asset_attributes)
+        cf_index.record(kwargs["environment"], "asset", asset)
+        cf_loader.assets(kwargs["environment"]).set(id, asset)
     except Exception as e:
         logging.error(
             "Exception occurred while creating asset with ID: %s, error: %s" % (id, e)
         )
         return e
 
-    try:
-        asset = kwargs["environment"].assets().find(id)
-    except Exception as e:
-        logging.error(
-            "Exception occurred while finding asset with ID: %s, error: %s" % (id, e)
-        )
-        return e
-
     try:
         asset.process()
     except Exception as e:
@@ -454,6 +517,7 @@ def create_asset(**kwargs):
             "Exception occurred while processing asset with ID: %s, error: %s" % (id, e)
         )
         return e
+    asset_processing.track(kwargs["environment"], asset)
     
     # try:
     #     asset.publish()
@@ -465,6 +529,7 @@ def create_asset(**kwargs):
     return asset_link(id)
 
 
+@locked_by_id("asset")
 def add_asset(**kwargs):
     """
     Add or override asset with given id, then initialize processing
@@ -552,7 +617,10 @@ def add_asset(**kwargs):
 
         logging.info("Epi image size: %s" % image_bytes)
 
-        asset_fields = kwargs["environment"].assets().find(id).fields()
+        asset = cf_loader.assets(kwargs["environment"]).load(id)
+        if asset is None:
+            asset = kwargs["environment"].assets().find(id)
+        asset_fields = asset.fields()
 
         asset_file = None
         try:
@@ -570,9 +638,7 @@ def add_asset(**kwargs):
 
         if asset_file is not None and asset_url is not None:
             try:
-                resp = requests.get("http:" + asset_url, stream=True)
-                contentful_image_bytes = resp.headers["Content-length"]
-                resp.close()
+                contentful_image_bytes = get_asset_size("https:" + asset_url)
             except:
                 logging.error('Unable to read image size, assuming different...')
                 contentful_image_bytes = -1
@@ -591,7 +657,6 @@ def add_asset(**kwargs):
 
     # 3. the image with a different file size might be already in contentful, so we have to reuse that one
 
-    # search for assets with the same exact size and link to existing image if byte content is exactly the same
     image_fetch_success = False
     while not image_fetch_success:
         try:
@@ -616,47 +681,22 @@ def add_asset(**kwargs):
             )
             return e
 
-    assets = (
-        kwargs["environment"]
-        .assets()
-        .all(query={"fields.file.details.size": asset_size})
-    )
-
-    for asset in assets:
-        resp = requests.get(image_url, stream=True)
-        image_bytes = resp.content
-        resp.close()
-
-        asset_file = None
+    # link to the existing asset with the same content hash, the image is
+    # downloaded once to hash it
+    digest = None
+    if asset_hashes.is_enabled():
         try:
-            asset_file = asset.fields()["file"]
+            digest, _ = asset_hashes.hash_url(image_url)
         except Exception as e:
-            logging.error("Asset file is not available: %s" % e)
+            logging.error("Could not hash image with url: %s, error: %s" % (image_url, e))
 
-        asset_url = None
-        try:
-            asset_url = asset_file["url"]
-        except Exception as e:
-            logging.error("Asset url is not available: %s" % e)
-            
-        if not asset_url:
-            continue
-
-        contentful_image_bytes = 0
-        if asset_file is not None and asset_url is not None:
-            resp = requests.get("http:" + asset_url, stream=True)
-            contentful_image_bytes = resp.content
-            resp.close()
-        else:
-            logging.error("Could not determine asset url")
-
-        if image_bytes == contentful_image_bytes:
-            logging.info(
-                "%s matches size to existing asset: %s" % (id, asset.sys["id"])
-            )
-            if is_asset_exists(kwargs["environment"], asset.sys["id"]):
-                logging.info("Linking %s to existing asset: %s" % (id, asset.sys["id"]))
-                return asset_link(asset.sys["id"])
+    existing_id = asset_hashes.lookup(digest) if digest else None
+    if existing_id is not None:
+        if is_asset_exists(kwargs["environment"], existing_id) is True:
+            logging.info("Linking %s to existing asset: %s" % (id, existing_id))
+            asset_hashes.count_reuse()
+            return asset_link(existing_id)
+        asset_hashes.remove(digest)
 
     name = "%s%s" % splitext(basename(urlparse(image_url).path))
     asset_attributes = {
@@ -671,23 +711,19 @@ def add_asset(**kwargs):
             },
         }
     }
+    if plan.active():
+        return plan_upload(id, image_url, asset_type, asset_size)
 
     try:
-        kwargs["environment"].assets().create(id, asset_attributes)
+        asset = kwargs["environment"].assets().create(id, asset_attributes)
+        cf_index.record(kwargs["environment"], "asset", asset)
+        cf_loader.assets(kwargs["environment"]).set(id, asset)
     except Exception as e:
         logging.error(
             "Exception occurred while creating asset with ID: %s, error: %s" % (id, e)
         )
         return e
 
-    try:
-        asset = kwargs["environment"].assets().find(id)
-    except Exception as e:
-        logging.error(
-            "Exception occurred while finding asset with ID: %s, error: %s" % (id, e)
-        )
-        return e
-
     try:
         asset.process()
     except Exception as e:
@@ -695,7 +731,10 @@ def add_asset(**kwargs):
             "Exception occurred while processing asset with ID: %s, error: %s" % (id, e)
         )
         return e
+    asset_processing.track(kwargs["environment"], asset)
 
+    if digest:
+        asset_hashes.add(digest, id)
     logging.info("Asset added: %s" % id)
 
     return asset_link(id)
@@ -704,27 +743,30 @@ def add_asset(**kwargs):
 def get_asset_size(uri):
     """Return asset size if possible to read by image URI, otherwise return 0"""
 
-    resp = requests.get(uri, stream=True)
-
-    img_to_add_content_type = resp.headers["Content-type"]
-    if "content-length" in resp.headers:
-        return resp.headers["Content-length"]
-    else:
-        return 0
-    resp.close()
+    _, size = asset_probe.probe(uri)
+    return size or 0
 
 
 def get_asset_type_and_size(uri):
     """Return asset type and size if possible to read by image URI, otherwise return 0"""
 
-    resp = requests.get(uri, stream=True)
+    content_type, size = asset_probe.probe(uri)
+    return content_type, size or 0
 
-    img_to_add_content_type = resp.headers["Content-type"]
-    if "content-length" in resp.headers:
-        return img_to_add_content_type, resp.headers["Content-length"]
-    else:
-        return img_to_add_content_type, 0
-    resp.close()
+
+def plan_upload(asset_id, image_url, asset_type, asset_size):
+    """Record the upload of an asset in plan mode instead of creating it"""
+
+    plan.record(
+        "upload",
+        "asset",
+        asset_id,
+        url=image_url,
+        content_type=asset_type,
+        size=int(asset_size),
+    )
+    logging.info("Asset planned: %s" % asset_id)
+    return asset_link(asset_id)
 
 
 def update_locale_voyage(**kwargs):
@@ -771,6 +813,56 @@ def remove_digits(value):
     return "".join(filter(lambda x: not x.isdigit(), value))
 
 
+write_stats = {
+    "created": 0,
+    "saved": 0,
+    "unchanged": 0,
+    "conflicts": 0,
+    "existence_checks_saved": 0,
+    "reads_saved": 0,
+}
+_write_stats_lock = threading.Lock()
+
+
+def count_write(counter):
+    with _write_stats_lock:
+        write_stats[counter] += 1
+
+
+def reset_write_stats():
+    with _write_stats_lock:
+        for counter in write_stats:
+            write_stats[counter] = 0
+    asset_hashes.reset_stats()
+    asset_probe.reset()
+    cma_client.reset_stats()
+
+
+def log_write_stats():
+    with _write_stats_lock:
+        stats = dict(write_stats)
+    logging.info(
+        "Contentful entries: %s created, %s saved, %s unchanged, %s version conflicts, "
+        "%s CMA calls saved (%s existence checks, %s reads, %s saves)"
+        % (
+            stats["created"],
+            stats["saved"],
+            stats["unchanged"],
+            stats["conflicts"],
+            stats["existence_checks_saved"]
+            + stats["reads_saved"]
+            + stats["unchanged"],
+            stats["existence_checks_saved"],
+            stats["reads_saved"],
+            stats["unchanged"],
+        )
+    )
+    cf_loader.log_stats()
+    asset_hashes.log_stats()
+    asset_probe.log_stats()
+    cma_client.log_stats()
+
+
 def update_image_wrapper(**kwargs):
     entry = kwargs["entry"]
     fields = kwargs["fields"]
@@ -782,6 +874,7 @@ def update_image_wrapper(**kwargs):
     return entry
 
 
+@locked_by_id("entry")
 def add_entry(**kwargs):
     """
     Add or override entry with given id
@@ -803,13 +896,6 @@ def add_entry(**kwargs):
     """
     id = kwargs["id"].replace("/", "")
     market = kwargs["market"]
-    # old_entry = kwargs['environment'].entries().find(id)
-
-    # if old_entry:
-    #     logging.info('Comparing entries with id: %s' % id)
-    #     if compare_entry(kwargs['fields'], old_entry._fields):
-    #         logging.info('Entries are the same')
-    #         return entry_link(id)
 
     # if entry with the same id already added, delete it
     # delete_entry_if_exists(kwargs['environment'], id)
@@ -840,30 +926,71 @@ def add_entry(**kwargs):
     was_published = False
     
 
+    def apply_fields(entry):
+        if market is not None:
+            if kwargs["content_type_id"] == "voyage":
+                update_locale_voyage(entry=entry, fields=fields, market=market)
+            if kwargs["content_type_id"] == "itineraryDay":
+                update_locale_itinerary(entry=entry, fields=fields, market=market)
+            if kwargs["content_type_id"] == "imageWrapper":
+                update_image_wrapper(
+                    entry=entry, fields=fields, market=config.DEFAULT_LOCALE
+                )
+        elif kwargs["content_type_id"]:
+            for field_name, field_value in fields.items():
+                for locale, locale_value in field_value.items():
+                    if (not locale in entry._fields):
+                        entry._fields[locale] = {}
+                    entry._fields[locale][field_name] = locale_value
+        else:
+            entry.update(entry_attributes)
+
+    if plan.active():
+        return plan_entry(
+            kwargs["environment"],
+            id,
+            kwargs["content_type_id"],
+            fields if market is None else field_localizer(market, fields, None),
+            entry_exist,
+            apply_fields,
+        )
+
     if entry_exist:
         try:
-            entry = kwargs["environment"].entries().find(id)
-            
-            was_published = entry.is_published
-            if market is not None:
-                if kwargs["content_type_id"] == "voyage":
-                    update_locale_voyage(entry=entry, fields=fields, market=market)
-                if kwargs["content_type_id"] == "itineraryDay":
-                    update_locale_itinerary(entry=entry, fields=fields, market=market)
-                if kwargs["content_type_id"] == "imageWrapper":
-                    update_image_wrapper(
-                        entry=entry, fields=fields, market=config.DEFAULT_LOCALE
-                    )
-            elif kwargs["content_type_id"]:
-                for field_name, field_value in fields.items():
-                    for locale, locale_value in field_value.items():
-                        if (not locale in entry._fields):
-                            entry._fields[locale] = {}
-                        entry._fields[locale][field_name] = locale_value
+            # an entry written earlier in this run is saved with its known
+            # version, it is only read again when someone else changed it
+            entry = cf_index.written_entry(kwargs["environment"], id)
+            if entry is not None:
+                count_write("reads_saved")
             else:
-                entry.update(entry_attributes)
-            entry.save()
+                entry = cf_loader.entries(kwargs["environment"]).load(id)
+            if entry is None:
+                entry = kwargs["environment"].entries().find(id)
+
+            was_published = entry.is_published
+            current_fields = field_diff.canonical_fields(entry)
+            apply_fields(entry)
+            if field_diff.canonical_fields(entry) == current_fields:
+                count_write("unchanged")
+                cf_index.remember(kwargs["environment"], entry)
+                logging.info("Entry %s unchanged, not saved" % id)
+                return entry_link(id)
+            try:
+                entry.save()
+            except contentful_management.errors.VersionMismatchError:
+                count_write("conflicts")
+                logging.info("Entry %s changed since it was read, reading it again" % id)
+                entry = kwargs["environment"].entries().find(id)
+                cf_loader.entries(kwargs["environment"]).set(id, entry)
+                apply_fields(entry)
+                entry.save()
+            count_write("saved")
+            cf_index.remember(kwargs["environment"], entry)
+            if kwargs["content_type_id"] == "ship":
+                invalidate_ship_codes()
         except Exception as e:
+            cf_index.forget(kwargs["environment"], id)
+            cf_loader.entries(kwargs["environment"]).forget(id)
             print(entry_attributes)
             logging.error(
                 "Exception occurred while trying to update entry with ID: %s, error: %s"
@@ -879,12 +1006,17 @@ def add_entry(**kwargs):
                     "fields": local_fields,
                 }
                 # print(entry_attributes)
-                kwargs["environment"].entries().create(id, entry_attributes)
+                entry = kwargs["environment"].entries().create(id, entry_attributes)
             else:
                 # print(entry_attributes)
                 # if (kwargs["content_type_id"] == "voyage"):
                 #     print(entry_attributes)
-                kwargs["environment"].entries().create(id, entry_attributes)
+                entry = kwargs["environment"].entries().create(id, entry_attributes)
+            count_write("created")
+            cf_index.remember(kwargs["environment"], entry)
+            cf_loader.entries(kwargs["environment"]).set(id, entry)
+            if kwargs["content_type_id"] == "ship":
+                invalidate_ship_codes()
             logging.info("Entry created: %s" % id)
         except Exception as e:
             print(entry_attributes)
@@ -894,42 +1026,106 @@ def add_entry(**kwargs):
             )
             return e
 
-    try:
-        entry = kwargs["environment"].entries().find(id)
-        if (entry):
-            pass
-            # entry.publish()
-            
-    except Exception as e:
-        logging.error(
-            "Exception occurred while publishing entry with ID: %s, error: %s" % (id, e)
-        )
-        
-        # if (kwargs["content_type_id"] == "program"):
-        #     entry = kwargs["environment"].entries().find(id)
-        #     oldslug = entry.slug
-        #     entry.slug = oldslug + '-2'
-        #     entry.save()
-        #     entry.publish()
-            
-        return e
+    return entry_link(id)
+
 
+def plan_entry(environment, id, content_type_id, fields, entry_exist, apply_fields):
+    """
+    Record the create or update add_entry would make in plan mode, with the
+    fields of a new entry or the changed fields of an existing one
+    """
+
+    with plan.timed("diff entries"):
+        entry = plan.planned_entry(id)
+        if entry is None and entry_exist:
+            entry = cf_loader.entries(environment).load(id)
+        if entry is None and entry_exist:
+            entry = environment.entries().find(id)
+        if entry is None:
+            entry = plan.PlannedEntry(
+                {"sys": {"id": id, "type": "Entry"}, "fields": fields},
+                default_locale=config.DEFAULT_LOCALE,
+            )
+            plan.keep_entry(entry)
+            plan.record(
+                "create",
+                "entry",
+                id,
+                content_type=content_type_id,
+                fields=field_diff.canonical_fields(entry),
+            )
+            return entry_link(id)
+
+        before = field_diff.canonical_fields(entry)
+        apply_fields(entry)
+        after = field_diff.canonical_fields(entry)
+        plan.keep_entry(entry)
+        changes = {
+            field_id: {"before": before.get(field_id), "after": after.get(field_id)}
+            for field_id in field_diff.changed_fields(before, after)
+        }
+        if changes:
+            plan.record(
+                "update", "entry", id, content_type=content_type_id, changes=changes
+            )
+        else:
+            plan.record("unchanged", "entry", id)
     return entry_link(id)
 
+
+# ship code -> entry ids of the ships with that code, per environment id
+_ship_ids_by_code = {}
+_ship_ids_lock = threading.Lock()
+
+
+def load_ship_ids_by_code(environment):
+    """Read the code of every ship entry with one paged query"""
+
+    ship_ids = {}
+    skip = 0
+    while True:
+        ship_entries = environment.entries().all(
+            query={
+                "content_type": "ship",
+                "select": "sys.id,fields.code",
+                "limit": 1000,
+                "skip": skip,
+            }
+        )
+        for ship_entry in ship_entries:
+            code = ship_entry.fields(config.DEFAULT_LOCALE).get("code")
+            ship_ids.setdefault(code, []).append(ship_entry.id)
+        skip += len(ship_entries)
+        if len(ship_entries) < 1000:
+            break
+    logging.info("Loaded codes of %s ships" % skip)
+    return ship_ids
+
+
+def invalidate_ship_codes():
+    """Read the ship codes again on the next lookup, after ships were created or changed"""
+
+    with _ship_ids_lock:
+        _ship_ids_by_code.clear()
+
+
 def get_cf_ship_link_from_ship_code(environment, ship_code):
     if ship_code == None:
         return None
-    
-    ship_entries = environment.entries().all(
-        query={
-            "content_type": "ship",
-            "fields.code": ship_code,
-        }
-    )
 
-    if len(ship_entries) == 0:
+    with _ship_ids_lock:
+        ship_ids = _ship_ids_by_code.get(environment.id)
+        if ship_ids is None:
+            ship_ids = load_ship_ids_by_code(environment)
+            _ship_ids_by_code[environment.id] = ship_ids
+
+    # same match as the former fields.code query, which joined a list of
+    # codes with commas
+    if isinstance(ship_code, list):
+        ship_code = ",".join(ship_code)
+    if not ship_ids.get(ship_code):
         return None
-    return [entry_link(ship_entry.id) for ship_entry in ship_entries]
+    return [entry_link(ship_id) for ship_id in ship_ids[ship_code]]
 
 def field_localizer(locale, field_dict, market):
     """Localize field dictionary for a given locale"""
@@ -1019,49 +1215,3 @@ class IntListConverter(BaseConverter):
 
     def to_url(self, value):
         return ",".join(str(x) for x in value)
-
-
-# def compare_entry(new_fields, old_fields):
-#     """Compares the old and new fields in contentful"""
-
-#     result = True
-#     for key in old_fields:
-#         newKeys = key.split('_')
-#         newKey = '%s%s' % (newKeys[0], newKeys[1].title())
-#         if new_fields[newKey]["en-US"] is None:
-#             continue
-#         if isinstance(new_fields[newKey]["en-US"], dict):
-#             if "nodeType" in new_fields[newKey]["en-US"]:
-#                 continue
-#         if new_fields[newKey]["en-US"] != old_fields['en-US'][key]:
-#             result = False
-
-#     return result
-
-
-def destination_name_to_cf_id(environment, destination_name):
-    destination_entries = environment.entries().all(
-        query={
-            "content_type": "destination",
-            "fields.internalName[in]": destination_name,
-        }
-    )
-
-    if len(destination_entries) == 0:
-        return None
-    return destination_entries[0].id
-
-
-def destination_epi_id_to_cf_id(environment, epi_id):
-    respone = requests.get("https://www.hurtigruten.co.uk/rest/b2b/destinations")
-    if not respone.ok:
-        return
-    destinations = respone.json()
-    target_destinations_name = [
-        destination["heading"].strip()
-        for destination in destinations
-        if destination["id"] == epi_id
-    ][0]
-    if target_destinations_name == "West Africa & Cape Verde":
-        target_destinations_name = "West Africa and Cape Verde"
-    return destination_name_to_cf_id(environment, target_destinations_name)
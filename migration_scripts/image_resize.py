@@ -0,0 +1,289 @@
+"""
+
+Resizing of images too large to be uploaded to Contentful.
+
+fetch() streams an EPI image into a temporary file, hashing it on the way
+so the asset hash index doesn't download it again. optimise() decodes and
+encodes it in a separate process, so the CPU work of large images doesn't
+hold up the threads writing to Contentful, and returns the encoded result
+in memory, ready to be uploaded without another file:
+
+    with image_resize.fetch(image_url) as download:
+        result = image_resize.optimise(download.path, IMAGE_SIZE_LIMIT)
+    uclient.uploads(space_id).create(io.BytesIO(result.data))
+
+JPEGs are decoded at 1/2, 1/4 or 1/8 of their size right away (draft),
+other formats are reduced by an integer factor before they're resampled,
+so an image is never fully decoded at its original size when it doesn't
+have to be. The temporary file is removed when the with block ends.
+
+The image is scaled to MAX_DIMENSIONS once and then encoded until it fits
+the target size: JPEG and WebP images get a binary search of the highest
+quality between MIN_QUALITY and MAX_QUALITY that fits, and when not even
+MIN_QUALITY does, a binary search of the largest dimensions fitting at
+DIMENSION_QUALITY. Other formats only get the search of dimensions. Every
+attempt starts from the same decoded image and an image is encoded at
+most MAX_ATTEMPTS times.
+
+SYNC_RESIZE_WORKERS     processes resizing images (default 2)
+
+"""
+import hashlib
+import io
+import logging
+import multiprocessing
+import os
+import resource
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+import asset_hashes
+import asset_probe
+
+WORKERS = int(os.environ.get("SYNC_RESIZE_WORKERS", 2))
+CHUNK_SIZE = 256 * 1024
+TIMEOUT = (10, 300)
+
+MAX_DIMENSIONS = (4000, 4000)
+SAVE_FORMATS = ("JPEG", "WEBP", "PNG", "GIF", "TIFF")
+LOSSY_FORMATS = ("JPEG", "WEBP")
+MAX_QUALITY = 90
+MIN_QUALITY = 50
+QUALITY_STEP = 5
+# quality of the attempts at smaller dimensions
+DIMENSION_QUALITY = 75
+MIN_SCALE = 0.25
+SCALE_STEP = 0.05
+MAX_ATTEMPTS = 10
+
+_lock = threading.Lock()
+_executor = None
+
+
+def get_executor():
+    global _executor
+    with _lock:
+        if _executor is None:
+            # spawned, not forked, the sync holds locks in other threads.
+            # Workers import the main script without running its __main__ block
+            _executor = ProcessPoolExecutor(
+                max_workers=max(1, WORKERS),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _executor
+
+
+class Download:
+    """Image streamed into a temporary file, removed when the with block ends"""
+
+    def __init__(self, url):
+        self.url = url
+        self.path = None
+        self.size = 0
+        self.seconds = 0.0
+
+    def __enter__(self):
+        started = time.perf_counter()
+        digest = hashlib.sha256()
+        suffix = os.path.splitext(self.url)[1]
+        with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as f:
+            self.path = f.name
+            try:
+                with asset_probe.get_session().get(
+                    self.url, stream=True, timeout=TIMEOUT
+                ) as resp:
+                    resp.raise_for_status()
+                    for chunk in resp.iter_content(CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+                        self.size += len(chunk)
+            except BaseException:
+                self._remove()
+                raise
+        asset_hashes.remember(self.url, digest.hexdigest(), self.size)
+        self.seconds = time.perf_counter() - started
+        return self
+
+    def __exit__(self, *exc):
+        self._remove()
+        return False
+
+    def _remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def fetch(url):
+    return Download(url)
+
+
+class Result:
+    """Encoded image returned by a resize worker"""
+
+    def __init__(
+        self,
+        data,
+        image_format,
+        original_dimensions,
+        dimensions,
+        quality,
+        attempts,
+        seconds,
+        peak_memory,
+    ):
+        self.data = data
+        self.format = image_format
+        self.content_type = Image.MIME.get(image_format)
+        self.original_dimensions = original_dimensions
+        self.dimensions = dimensions
+        self.quality = quality
+        self.attempts = attempts
+        self.seconds = seconds
+        self.peak_memory = peak_memory
+
+
+class _Ladder:
+    """Encodes one decoded image at different qualities and sizes"""
+
+    def __init__(self, img, image_format, target_size):
+        self.img = img
+        self.format = image_format
+        self.target_size = target_size
+        self.attempts = 0
+        self.best = None
+        self.smallest = None
+
+    def is_exhausted(self):
+        return self.attempts >= MAX_ATTEMPTS
+
+    def encode(self, scale, quality):
+        """Encode at scale of the decoded image, True if it fits the target"""
+
+        self.attempts += 1
+        img = self.img
+        if scale < 1:
+            dimensions = (
+                max(1, round(img.size[0] * scale)),
+                max(1, round(img.size[1] * scale)),
+            )
+            # resized from the decoded image, which is kept for the next attempt
+            img = img.resize(dimensions, Image.LANCZOS, reducing_gap=2.0)
+        buffer = io.BytesIO()
+        if quality is None:
+            img.save(buffer, format=self.format, optimize=True)
+        else:
+            img.save(buffer, format=self.format, quality=quality, optimize=True)
+        attempt = (buffer.getvalue(), img.size, quality)
+        size = len(attempt[0])
+        if self.smallest is None or size < len(self.smallest[0]):
+            self.smallest = attempt
+        fits = size <= self.target_size
+        # the best fit is the largest image, then the highest quality
+        if fits and (
+            self.best is None or (img.size, quality or 0) > (self.best[1], self.best[2] or 0)
+        ):
+            self.best = attempt
+        return fits
+
+    def search_quality(self, scale):
+        """Binary search the highest quality fitting at scale, False if none does"""
+
+        if self.encode(scale, MAX_QUALITY):
+            return True
+        low, high = MIN_QUALITY, MAX_QUALITY
+        if not self.encode(scale, low):
+            return False
+        while high - low > QUALITY_STEP and not self.is_exhausted():
+            quality = (low + high) // 2
+            if self.encode(scale, quality):
+                low = quality
+            else:
+                high = quality
+        return True
+
+    def search_scale(self, quality):
+        """Binary search the largest scale fitting at quality"""
+
+        low, high = MIN_SCALE, 1.0
+        while high - low > SCALE_STEP and not self.is_exhausted():
+            scale = (low + high) / 2
+            if self.encode(scale, quality):
+                low = scale
+            else:
+                high = scale
+        if self.best is None and not self.is_exhausted():
+            self.encode(MIN_SCALE, quality)
+
+
+def _optimise_file(path, target_size, max_dimensions):
+    """Runs in a worker process"""
+
+    started = time.perf_counter()
+    with Image.open(path) as img:
+        image_format = img.format if img.format in SAVE_FORMATS else "PNG"
+        original_dimensions = img.size
+        # decode JPEGs scaled down, at least twice the target size
+        img.draft(img.mode, (max_dimensions[0] * 2, max_dimensions[1] * 2))
+        img.thumbnail(max_dimensions, reducing_gap=2.0)
+        if image_format == "JPEG" and img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+
+        ladder = _Ladder(img, image_format, target_size)
+        if image_format in LOSSY_FORMATS:
+            if not ladder.search_quality(1.0):
+                ladder.search_scale(DIMENSION_QUALITY)
+        elif not ladder.encode(1.0, None):
+            ladder.search_scale(None)
+
+    data, dimensions, quality = ladder.best or ladder.smallest
+    return Result(
+        data,
+        image_format,
+        original_dimensions,
+        dimensions,
+        quality,
+        ladder.attempts,
+        time.perf_counter() - started,
+        # kB on Linux, the peak of the worker over all images it resized
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    )
+
+
+def optimise(path, target_size, max_dimensions=MAX_DIMENSIONS):
+    """
+    Encode the image at given path to fit target_size bytes and
+    max_dimensions, in a worker process. The result is the smallest attempt
+    when nothing fits within MAX_ATTEMPTS encodings.
+    """
+
+    return (
+        get_executor()
+        .submit(_optimise_file, path, target_size, max_dimensions)
+        .result()
+    )
+
+
+def log_result(url, download, result, upload_seconds):
+    logging.info(
+        "Resized %s from %sx%s (%.1f MB) to %sx%s (%.1f MB, quality %s, %s attempts): "
+        "download %.1fs, resize %.1fs, upload %.1fs, worker peak memory %.0f MB"
+        % (
+            url,
+            result.original_dimensions[0],
+            result.original_dimensions[1],
+            download.size / 1e6,
+            result.dimensions[0],
+            result.dimensions[1],
+            len(result.data) / 1e6,
+            result.quality or "-",
+            result.attempts,
+            download.seconds,
+            result.seconds,
+            upload_seconds,
+            result.peak_memory / 1e6,
+        )
+    )
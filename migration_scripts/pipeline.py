@@ -0,0 +1,182 @@
+"""
+
+Staged pipeline for the sync scripts.
+
+Every item runs through a list of stages, e.g. reading a voyage from EPI and
+writing it to Contentful. Each stage has its own worker threads and hands its
+results to the next stage through a bounded queue, so EPI content for the
+next items is read while the current item is written. A full queue blocks
+the stage in front of it (back-pressure), so a slow stage never lets more
+than `queue_size` items pile up in memory.
+
+    stages = [
+        Stage("fetch", fetch_voyage),
+        Stage("write", write_voyage),
+    ]
+    run(voyage_ids, stages, queue_size=4)
+
+"""
+import logging
+import queue
+import threading
+import time
+
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of the pipeline
+
+    function is called with the result of the previous stage (the item key
+    for the first stage), its result is passed on to the next stage.
+    """
+
+    def __init__(self, name, function, workers=1):
+        self.name = name
+        self.function = function
+        self.workers = max(1, workers)
+        self.processed = 0
+        self.failed = 0
+        self.busy = 0.0
+        self.idle = 0.0
+        self.blocked = 0.0
+        self._lock = threading.Lock()
+        self._running = 0
+
+    def _count(self, **counters):
+        with self._lock:
+            for counter, value in counters.items():
+                setattr(self, counter, getattr(self, counter) + value)
+
+    def stats(self, elapsed):
+        """
+        Counters of the stage: items processed and failed, items per second
+        over the whole run and seconds the workers spent working, waiting for
+        input and waiting for room in the next queue
+        """
+
+        with self._lock:
+            return {
+                "processed": self.processed,
+                "failed": self.failed,
+                "throughput": self.processed / elapsed if elapsed else 0,
+                "busy": self.busy,
+                "idle": self.idle,
+                "blocked": self.blocked,
+            }
+
+
+def _put(output, item, stage):
+    started = time.perf_counter()
+    output.put(item)
+    stage._count(blocked=time.perf_counter() - started)
+
+
+def _callback(name, function, stage, key, *args):
+    # a failing callback must not end the worker, run() would never finish
+    try:
+        function(*args)
+    except Exception as e:
+        logging.error(
+            "%s of %s failed for %s, error: %s" % (name, stage.name, key, e)
+        )
+
+
+def _worker(stage, inbox, outbox, on_error, on_done):
+    try:
+        _work(stage, inbox, outbox, on_error, on_done)
+    finally:
+        with stage._lock:
+            stage._running -= 1
+            last = stage._running == 0
+        if last and outbox is not None:
+            for _ in range(outbox.workers):
+                outbox.put(_DONE)
+
+
+def _work(stage, inbox, outbox, on_error, on_done):
+    while True:
+        started = time.perf_counter()
+        item = inbox.get()
+        stage._count(idle=time.perf_counter() - started)
+        if item is _DONE:
+            return
+
+        index, key, value = item
+        started = time.perf_counter()
+        try:
+            result = stage.function(value)
+        except Exception as e:
+            stage._count(busy=time.perf_counter() - started, failed=1)
+            if on_error is not None:
+                _callback("on_error", on_error, stage, key, key, stage.name, e)
+            else:
+                logging.error("%s failed for %s, error: %s" % (stage.name, key, e))
+            continue
+        stage._count(busy=time.perf_counter() - started, processed=1)
+
+        if outbox is not None:
+            _put(outbox, (index, key, result), stage)
+        elif on_done is not None:
+            _callback("on_done", on_done, stage, key, index, key, result)
+
+
+class _Queue(queue.Queue):
+    def __init__(self, maxsize, workers):
+        super().__init__(maxsize)
+        self.workers = workers
+
+
+def run(keys, stages, queue_size=4, on_error=None, on_done=None, name="Pipeline"):
+    """
+    Run all keys through the stages and return the stage counters
+
+    on_error(key, stage_name, exception) is called inside the except block of
+    the failing stage, the item is dropped. on_done(index, key, result) is
+    called when an item has passed the last stage.
+    """
+
+    inboxes = [_Queue(max(1, queue_size), stage.workers) for stage in stages]
+    threads = []
+    for i, stage in enumerate(stages):
+        stage._running = stage.workers
+        outbox = inboxes[i + 1] if i + 1 < len(stages) else None
+        for n in range(stage.workers):
+            thread = threading.Thread(
+                target=_worker,
+                args=(stage, inboxes[i], outbox, on_error, on_done),
+                name="%s-%s-%s" % (name, stage.name, n),
+                daemon=True,
+            )
+            thread.start()
+            threads.append(thread)
+
+    started = time.perf_counter()
+    for index, key in enumerate(keys):
+        # blocks while the first stage is busy
+        inboxes[0].put((index, key, key))
+    for _ in range(stages[0].workers):
+        inboxes[0].put(_DONE)
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - started
+    return {stage.name: stage.stats(elapsed) for stage in stages}
+
+
+def log_stats(name, stats):
+    for stage_name, stage_stats in stats.items():
+        logging.info(
+            "%s %s: %s processed, %s failed, %.2f items/s, %.1fs busy, %.1fs waiting for input, %.1fs waiting for next stage"
+            % (
+                name,
+                stage_name,
+                stage_stats["processed"],
+                stage_stats["failed"],
+                stage_stats["throughput"],
+                stage_stats["busy"],
+                stage_stats["idle"],
+                stage_stats["blocked"],
+            )
+        )
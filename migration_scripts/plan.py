@@ -0,0 +1,246 @@
+"""
+
+Plan mode: a sync run that reads and computes everything but writes nothing.
+
+While a plan is started, the helpers read EPI and Contentful and build every
+asset and entry as in a normal run, then record what they would write
+instead of calling the Contentful write endpoints:
+
+- create: an entry that doesn't exist yet, with all its fields
+- update: an existing entry with changed fields, with the value of every
+  changed field before and after
+- unchanged: an existing entry whose fields stay the same (counted only)
+- upload: an asset that would be created from an EPI file
+- publish: an entry or asset added to a publish queue
+- delete: an entry or asset that would be deleted
+
+Entries and assets planned earlier in the run are seen by the later writes
+of the same run, e.g. the market locales of a voyage are planned on top of
+the planned default locale. The change records of the Cosmos DB aren't
+updated, so the next real run still writes everything that was planned.
+
+    voyages.run_sync(plan="plan.json")       # or: python voyages.py --plan plan.json
+
+run_sync() of a plannable() sync starts the plan, logs it when the run is
+done and saves it as JSON. A plan is process wide, it's meant for runs from
+the command line and not for the API, which runs several syncs at once.
+
+The plan also keeps the time spent per stage (reading EPI, computing the
+entries), see timed() and add_stage_stats().
+
+"""
+import functools
+import json
+import logging
+import threading
+import time
+from contextlib import contextmanager
+
+import contentful_management
+
+# Actions listed in a saved plan, "unchanged" entries are only counted
+LISTED_ACTIONS = ("create", "update", "upload", "publish", "delete")
+
+_lock = threading.Lock()
+_plan = None
+
+
+class PlannedEntry(contentful_management.Entry):
+    """Local entry a plan creates, it has no content type to check fields against"""
+
+    def _is_missing_field(self, name):
+        return True
+
+
+class Plan:
+    """Writes a run would make, in the order they were computed"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.actions = []
+        self.counts = {}
+        self.entries = {}
+        self.exists = {}
+        self.timings = {}
+
+    def to_json(self):
+        return {
+            "name": self.name,
+            "counts": dict(self.counts),
+            "timings": {
+                stage: round(seconds, 3) for stage, seconds in self.timings.items()
+            },
+            "actions": self.actions,
+        }
+
+    def save(self, path):
+        with _lock:
+            content = self.to_json()
+        with open(path, "w") as file:
+            json.dump(content, file, indent=2, default=str)
+        logging.info("Plan saved to %s" % path)
+
+    def log_summary(self):
+        with _lock:
+            counts = dict(self.counts)
+            timings = dict(self.timings)
+            actions = list(self.actions)
+        logging.info(
+            "Plan %s: %s"
+            % (
+                self.name,
+                ", ".join(
+                    "%s %s" % (counts.get(action, 0), action)
+                    for action in LISTED_ACTIONS + ("unchanged",)
+                ),
+            )
+        )
+        for action in actions:
+            logging.info(
+                "Plan: %s %s %s%s"
+                % (
+                    action["action"],
+                    action["kind"],
+                    action["id"],
+                    " (%s)" % ", ".join(action["changes"]) if "changes" in action else "",
+                )
+            )
+        for stage, seconds in timings.items():
+            logging.info("Plan %s: %.1fs %s" % (self.name, seconds, stage))
+
+
+def start(name):
+    """Start planning instead of writing, for the rest of the run"""
+
+    global _plan
+    with _lock:
+        _plan = Plan(name)
+    logging.info("Plan mode: nothing is written to Contentful")
+    return _plan
+
+
+def stop():
+    """Stop planning and return the plan"""
+
+    global _plan
+    with _lock:
+        current, _plan = _plan, None
+    if current is not None:
+        current.timings["total"] = time.perf_counter() - current.started
+    return current
+
+
+def finish(path=None):
+    """Stop planning, log the plan and save it to given path if there is one"""
+
+    current = stop()
+    if current is None:
+        return None
+    current.log_summary()
+    if isinstance(path, str):
+        current.save(path)
+    return current
+
+
+def plannable(name):
+    """
+    Decorator for run_sync(**kwargs): called with plan=True the run is
+    planned and logged, with plan=path it's saved to path too
+    """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(**kwargs):
+            path = kwargs.get("plan")
+            if not path:
+                return function(**kwargs)
+            start(name)
+            try:
+                return function(**kwargs)
+            finally:
+                finish(path)
+
+        return wrapper
+
+    return decorator
+
+
+def active():
+    return _plan is not None
+
+
+def record(action, kind, resource_id, **details):
+    """Record a write the run would make, details are saved with it"""
+
+    current = _plan
+    if current is None:
+        return
+    with _lock:
+        current.counts[action] = current.counts.get(action, 0) + 1
+        if action == "create" or action == "upload":
+            current.exists[(kind, resource_id)] = True
+        elif action == "delete":
+            current.exists[(kind, resource_id)] = False
+            current.entries.pop(resource_id, None)
+        if action in LISTED_ACTIONS:
+            current.actions.append(
+                dict(action=action, kind=kind, id=resource_id, **details)
+            )
+
+
+def exists(kind, resource_id):
+    """
+    True or False if the plan creates or deletes the entry / asset, None if
+    it doesn't or no plan is running
+    """
+
+    current = _plan
+    if current is None:
+        return None
+    with _lock:
+        return current.exists.get((kind, resource_id))
+
+
+def keep_entry(entry):
+    """Keep a planned entry, later writes of the same id start from it"""
+
+    current = _plan
+    if current is None:
+        return
+    with _lock:
+        current.entries[entry.id] = entry
+
+
+def planned_entry(entry_id):
+    current = _plan
+    if current is None:
+        return None
+    with _lock:
+        return current.entries.get(entry_id)
+
+
+def add_timing(stage, seconds):
+    current = _plan
+    if current is None:
+        return
+    with _lock:
+        current.timings[stage] = current.timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed(stage):
+    """Add the time spent in the block to given stage of the plan"""
+
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_timing(stage, time.perf_counter() - started)
+
+
+def add_stage_stats(name, stats):
+    """Add the busy time of the stages of a pipeline.run() to the plan"""
+
+    for stage_name, stage_stats in stats.items():
+        add_timing("%s %s" % (name, stage_name), stage_stats["busy"])
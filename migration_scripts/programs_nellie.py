@@ -6,32 +6,36 @@ same as entry id in Epi. To update programs they first need to be deleted from C
 and then imported from Episerver by this script.
 
 """
+import asset_processing
 import config
+import cf_index
 import helpers
+from commit_graph import CommitGraph
+import epi_client
+import epi_markets
+import epi_snapshot
+import pipeline
+import plan
 import logging
 import unicodedata
 import re
 from argparse import ArgumentParser
+from catalog import LocalizedCatalog
+from destinations import DestinationResolver
 
 logging.basicConfig(
     format = '%(asctime)s %(levelname)-8s %(message)s',
     level = logging.INFO,
     datefmt = '%Y-%m-%d %H:%M:%S')
 
-CMS_API_URLS = {
-    "en": "https://global.hurtigruten.com/rest/b2b/programs",
-    "en-US": "https://www.hurtigruten.com/rest/b2b/programs",
-    "en-AU": "https://www.hurtigruten.com.au/rest/b2b/programs",
-    "de-DE": "https://www.hurtigruten.de/rest/b2b/programs",
-    "en-GB": "https://www.hurtigruten.co.uk/rest/b2b/programs",
-    "gsw-CH": "https://www.hurtigruten.ch/rest/b2b/programs",
-    "sv-SE": "https://www.hurtigrutenresan.se/rest/b2b/programs",
-    "nb-NO": "https://www.hurtigruten.no/rest/b2b/programs",
-    "da-DK": "https://www.hurtigruten.dk/rest/b2b/programs",
-    "fr-FR": "https://www.hurtigruten.fr/rest/b2b/programs",
-}
+CMS_API_URLS = epi_markets.market_urls("/rest/b2b/programs")
 
-programs_by_locale = {}
+# Fields of the EPI programs used by the sync, everything else is dropped while reading
+PROGRAM_FIELDS = [
+    'id', 'url', 'heading', 'title', 'intro', 'body', 'summary', 'secondaryBody',
+    'image', 'mediaContent', 'isFallbackContent', 'destinations', 'durationHours',
+    'durationDays', 'bookingCode', 'code', 'sellingPoints', 'price', 'priceValue', 'currency'
+]
 
 season_dict = {
     '1': 'Winter (Nov - Mar)',
@@ -49,21 +53,19 @@ def prepare_environment():
         config.CTFL_MGMT_API_KEY)
 
     logging.info('Using Contentful environment: %s' % config.CTFL_ENV_ID)
+    cf_index.load(contentful_environment)
     logging.info('Get all programs for locales: %s' % (", ".join([key for key, value in CMS_API_URLS.items()])))
 
-    epi_program_ids = []
-
-    for locale, url in CMS_API_URLS.items():
-        programs_by_locale[locale] = helpers.read_json_data(url)
-        epi_program_ids += [program['id'] for program in programs_by_locale[locale]]
-    #     logging.info(
-    #         'Number of programs in EPI: %s for locale: %s' % (len(programs_by_locale[locale]), locale))
+    program_catalog = LocalizedCatalog.from_urls(
+        CMS_API_URLS,
+        max_workers = config.EPI_MARKET_CONCURRENCY,
+        fields = PROGRAM_FIELDS)
 
     logging.info('-----------------------------------------------------')
     # logging.info('')
 
-    # Create distinct list
-    epi_program_ids = set(epi_program_ids)
+    # Distinct list
+    epi_program_ids = program_catalog.ids()
 
     # logging.info('Number of migrating programs: %s' % len(epi_program_ids))
     # logging.info('')
@@ -75,7 +77,9 @@ def prepare_environment():
     # logging.info('-----------------------------------------------------')
     # logging.info('')
 
-    return epi_program_ids, contentful_environment
+    destination_resolver = DestinationResolver.load(contentful_environment)
+
+    return epi_program_ids, contentful_environment, program_catalog, destination_resolver
 
 def remove_fields_if_fallback(dict, isFallback):
     if (not isFallback):
@@ -94,21 +98,11 @@ def relative_url_to_absolute_url(url):
         return 'https://www.hurtigruten.co.uk' + url
     return url
 
-def update_program(contentful_environment, program_id):
+def update_program(contentful_environment, program_id, program_catalog, destination_resolver):
     logging.info('Program migration started with ID: %s' % program_id)
 
-    program_by_locale = {}
-
-    for locale, programs in programs_by_locale.items():
-        if locale == 'en':
-            continue
-        
-        # Filter down to the one program by locale from all the programs
-        program = next((program for program in programs if str(program['id']) == str(program_id)), None)
-        if program is not None:
-            program_by_locale[locale] = program
-
-    default_program = program_by_locale.get(config.DEFAULT_LOCALE) or list(program_by_locale.values())[0]
+    program_by_locale = program_catalog.by_locale(program_id, exclude = ['en'])
+    default_program = program_catalog.default(program_id, config.DEFAULT_LOCALE, exclude = ['en'])
 
     if default_program is None:
         logging.info('Could not find default program detail for program ID: %s' % program_id)
@@ -133,6 +127,9 @@ def update_program(contentful_environment, program_id):
 
 
 
+    # the images, their wrappers and the program are written by graph.commit()
+    graph = CommitGraph('Program %s' % program_id)
+
     # image_gallery_id = "program-gallery-%s-" % str(program_id)
     image_wrapper_links_by_locale = {}
     # media_item = None
@@ -141,7 +138,9 @@ def update_program(contentful_environment, program_id):
         image_wrapper_links_by_locale[locale] = []
         for i, media_item in enumerate(program["mediaContent"]):
             image_link = (
-                helpers.add_or_reuse_asset(
+                graph.add(
+                    'asset',
+                    helpers.add_or_reuse_asset,
                     environment=contentful_environment,
                     asset_uri= relative_url_to_absolute_url(media_item["highResolutionUri"]),
                     id="prpo-%s" % media_item["id"],
@@ -184,7 +183,10 @@ def update_program(contentful_environment, program_id):
             
 
             image_wrapper_link = (
-                helpers.add_entry(
+                graph.add(
+                    'entry',
+                    helpers.add_entry,
+                    optional=True,
                     environment=contentful_environment,
                     id="prpo-%s" % media_item["id"],
                     content_type_id="imageWrapper",
@@ -272,7 +274,7 @@ def update_program(contentful_environment, program_id):
     #     ),
     # ) #if image_link is not None else None
 
-    destination_ids = list(filter(None, [helpers.destination_name_to_cf_id(contentful_environment, d) for d in default_program.get('destinations')]))
+    destination_ids = destination_resolver.names_to_cf_ids(default_program.get('destinations'))
     destination_links = [helpers.entry_link(di) for di in destination_ids]
     def epi_slug(p):
         parts = p.get('url', '').split('/')
@@ -288,7 +290,9 @@ def update_program(contentful_environment, program_id):
         slug = unicodedata.normalize('NFD', slug).encode('ascii', 'ignore').decode('utf8')
         return slug
 
-    helpers.add_entry(
+    graph.add(
+        'entry',
+        helpers.add_entry,
         environment = contentful_environment,
         id = str(program_id),
         content_type_id = "program",
@@ -316,6 +320,7 @@ def update_program(contentful_environment, program_id):
             }, program["isFallbackContent"] or False), None) for locale, program in program_by_locale.items()
         ))
     )
+    graph.commit()
 
     for locale, url in CMS_API_URLS.items():
         helpers.update_entry_database(program_id, locale)
@@ -323,6 +328,7 @@ def update_program(contentful_environment, program_id):
     logging.info('Program migration finished with ID: %s' % program_id)
 
 
+@plan.plannable('Programs')
 def run_sync(**kwargs):
     parameter_program_ids = kwargs.get('content_ids')
     
@@ -337,34 +343,61 @@ def run_sync(**kwargs):
             logging.info('Running program sync, skipping IDs: %s' % parameter_program_ids)
     else:
         logging.info('Running programs sync')
-    program_ids, contentful_environment = prepare_environment()
-    
-    logging.info('Migrating ' + str(len(program_ids)) + ' programs')
+    epi_client.reset_stats()
+    helpers.reset_write_stats()
+    epi_snapshot.use(kwargs.get("snapshot"))
+    with plan.timed('prepare'):
+        program_ids, contentful_environment, program_catalog, destination_resolver = prepare_environment()
+    asset_processing.start(contentful_environment)
+    try:
+        logging.info('Migrating ' + str(len(program_ids)) + ' programs')
     
-    for idx, program_id in enumerate(program_ids):
         if parameter_program_ids is not None:
-            # run only included programs
-            if include and program_id not in parameter_program_ids:
-                continue
-            # skip excluded programs
-            if not include and program_id in parameter_program_ids:
-                continue
-        try:
-            logging.info('Updating program %s/%s' % (idx, len(program_ids)))
-            update_program(contentful_environment, program_id)
-        except Exception as e:
+            # run only included programs, skip excluded programs
+            program_ids = [program_id for program_id in program_ids
+                           if (program_id in parameter_program_ids) == bool(include)]
+
+        def write_program(program_id):
+            logging.info('Updating program %s' % program_id)
+            update_program(contentful_environment, program_id, program_catalog, destination_resolver)
+
+        def on_error(program_id, stage, e):
             logging.error('Program migration error with ID: %s, error: %s' % (program_id, e))
             [helpers.remove_entry_id_from_memory(program_id, locale) for locale, url in CMS_API_URLS.items()]
 
+        def on_done(idx, program_id, result):
+            logging.info('Updated program %s/%s' % (idx + 1, len(program_ids)))
+
+        # EPI content of all programs is already in the catalog, so there is
+        # nothing to read ahead and the writes are the only stage
+        stats = pipeline.run(
+            program_ids,
+            [pipeline.Stage('write', write_program)],
+            queue_size = config.PIPELINE_QUEUE_SIZE,
+            on_error = on_error,
+            on_done = on_done,
+            name = 'Programs')
+        pipeline.log_stats('Programs', stats)
+        plan.add_stage_stats('Programs', stats)
+    finally:
+        asset_processing.finish(contentful_environment)
+    epi_client.log_stats()
+    helpers.log_write_stats()
+
 
 parser = ArgumentParser(prog = 'programs_nellie.py', description = 'Run program sync between Contentful and EPI')
 parser.add_argument("-ids", "--content_ids", nargs = '+', type = int, help = "Provide program IDs")
 parser.add_argument("-include", "--include", nargs = '?', type = helpers.str2bool, const = True, default = True,
                     help = "Specify if you want to include or exclude "
                            "program IDs")
+parser.add_argument("-snapshot", "--snapshot", type = str,
+                    help = "Read EPI content from a snapshot created by epi_snapshot.py")
+parser.add_argument("-plan", "--plan", nargs = '?', const = True,
+                    help = "Only plan the sync: log the writes it would make and save them to the given JSON file")
 args = parser.parse_args()
 
 if __name__ == '__main__':
     ids = vars(args)['content_ids']
     include = vars(args)['include']
-    run_sync(**{"content_ids": ids, "include": include})
+    snapshot = vars(args)['snapshot']
+    run_sync(**{"content_ids": ids, "include": include, "snapshot": snapshot, "plan": vars(args)['plan']})
@@ -5,6 +5,7 @@ starting with one of the keywords defined in the keywords array
 
 import helpers
 import config
+import publish_queue
 import logging
 import contentful_management
 from argparse import ArgumentParser
@@ -32,7 +33,7 @@ def prepare_environment():
     return contentful_environment
 
 
-def publish_asset(contentful_environment, asset_keyword, limit):
+def publish_asset(contentful_environment, asset_keyword, limit, asset_publish_queue):
     items_in_last_iteration = 1
     i = 0
     while items_in_last_iteration > 0:
@@ -49,13 +50,19 @@ def publish_asset(contentful_environment, asset_keyword, limit):
             if asset.is_published:
                 continue
             logging.info('Publishing %s' % asset.sys['id'])
-            try:
-                asset.publish()
-            except contentful_management.errors.UnprocessableEntityError:
-                logging.info("Asset cannot be processed, deleting asset")
-                asset.delete()
-            except Exception as e:
-                logging.error("Asset cannot be processed, error: %s" % e)
+            asset_publish_queue.add(asset)
+
+
+def delete_unprocessable_assets(contentful_environment, asset_publish_queue):
+    for kind, asset_id, error in asset_publish_queue.failures():
+        if not isinstance(error, contentful_management.errors.UnprocessableEntityError):
+            logging.error("Asset cannot be processed, error: %s" % error)
+            continue
+        logging.info("Asset %s cannot be processed, deleting asset" % asset_id)
+        try:
+            contentful_environment.assets().delete(asset_id)
+        except Exception as e:
+            logging.error("Asset %s cannot be deleted, error: %s" % (asset_id, e))
 
 
 def run_publish(**kwargs):
@@ -65,11 +72,18 @@ def run_publish(**kwargs):
     else:
         logging.info('Running asset publish')
     contentful_environment = prepare_environment()
+    asset_publish_queue = publish_queue.PublishQueue(
+        contentful_environment,
+        config.CTFL_SPACE_ID,
+        config.CTFL_MGMT_API_KEY)
     for asset_type in asset_types:
         if only_with_asset_types is not None and asset_type not in only_with_asset_types:
             continue
         for keyword in asset_types[asset_type]:
-            publish_asset(contentful_environment, keyword, 1000)
+            publish_asset(contentful_environment, keyword, 1000, asset_publish_queue)
+    asset_publish_queue.flush()
+    asset_publish_queue.log_summary()
+    delete_unprocessable_assets(contentful_environment, asset_publish_queue)
 
 
 parser = ArgumentParser(prog = 'publish_imported_assets.py', description = 'Run publish for import assets in Contentful')
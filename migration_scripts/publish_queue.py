@@ -0,0 +1,215 @@
+"""
+
+Batched publishing of Contentful entries and assets.
+
+Entries and assets are added to a queue while a run writes them and are
+published together through Contentful's bulk publish action, up to 200 per
+action, instead of one publish call each. The queue waits for every bulk
+action to finish. A bulk action fails as a whole when one of its items can't
+be published, the items Contentful reports as invalid are then published one
+by one and the rest is sent again as a new bulk action.
+
+    queue = PublishQueue(environment, config.CTFL_SPACE_ID, config.CTFL_MGMT_API_KEY)
+    queue.add(entry)
+    ...
+    queue.flush()
+
+"""
+import logging
+import threading
+import time
+
+import cf_index
+import cma_client
+import plan
+
+CMA_URL = "https://api.contentful.com"
+BULK_LIMIT = 200
+POLL_INTERVAL = 1.0
+POLL_TIMEOUT = 300
+
+
+def _key(resource):
+    return (resource.sys.get("type"), resource.id)
+
+
+class PublishQueue:
+    """Collects entries and assets to publish and publishes them in bulk"""
+
+    def __init__(self, environment, space_id, access_token, batch_size=BULK_LIMIT):
+        self.environment = environment
+        self.batch_size = max(1, min(batch_size, BULK_LIMIT))
+        self.url = "%s/spaces/%s/environments/%s/bulk_actions" % (
+            CMA_URL,
+            space_id,
+            environment.id,
+        )
+        self.headers = cma_client.headers(access_token)
+        self.pending = {}
+        self.results = {}
+        self.counters = {"bulk_actions": 0, "single_publishes": 0}
+        self._lock = threading.Lock()
+
+    def add(self, resource):
+        """
+        Publish the entry or asset with the next batch. Adding it again
+        before the batch is sent publishes it only once, in its latest version.
+        """
+
+        if plan.active():
+            plan.record("publish", self._kind(resource), resource.id)
+            return
+
+        with self._lock:
+            self.pending[_key(resource)] = resource
+            full = len(self.pending) >= self.batch_size
+        if full:
+            self.flush()
+
+    def flush(self):
+        """Publish everything queued so far, returns {(type, id): outcome}"""
+
+        with self._lock:
+            resources = list(self.pending.values())
+            self.pending = {}
+        outcomes = {}
+        for start in range(0, len(resources), self.batch_size):
+            outcomes.update(self._publish(resources[start : start + self.batch_size]))
+        with self._lock:
+            self.results.update(outcomes)
+        return outcomes
+
+    def _publish(self, resources, retry=True):
+        try:
+            action = self._run_bulk_action(resources)
+        except Exception as e:
+            logging.error("Bulk publish could not be run, error: %s" % e)
+            return self._publish_one_by_one(resources)
+
+        if action["sys"]["status"] == "succeeded":
+            for resource in resources:
+                self._mark_published(resource)
+            return {_key(resource): ("published", None) for resource in resources}
+
+        errors = self._errors_by_id(action)
+        invalid = [resource for resource in resources if resource.id in errors]
+        valid = [resource for resource in resources if resource.id not in errors]
+        for resource in invalid:
+            logging.info(
+                "%s %s failed in bulk publish: %s"
+                % (resource.sys.get("type"), resource.id, errors[resource.id])
+            )
+        if not invalid or not retry:
+            # nothing to tell the items apart, publish every item on its own
+            return self._publish_one_by_one(resources)
+
+        outcomes = self._publish_one_by_one(invalid)
+        if valid:
+            outcomes.update(self._publish(valid, retry=False))
+        return outcomes
+
+    def _run_bulk_action(self, resources):
+        items = [
+            {
+                "sys": {
+                    "type": "Link",
+                    "linkType": resource.sys.get("type"),
+                    "id": resource.id,
+                    "version": resource.sys.get("version"),
+                }
+            }
+            for resource in resources
+        ]
+        response = cma_client.request(
+            "post",
+            "%s/publish" % self.url,
+            headers=self.headers,
+            json={"entities": {"sys": {"type": "Array"}, "items": items}},
+        )
+        response.raise_for_status()
+        action = response.json()
+        with self._lock:
+            self.counters["bulk_actions"] += 1
+
+        started = time.monotonic()
+        while action["sys"]["status"] not in ("succeeded", "failed"):
+            if time.monotonic() - started > POLL_TIMEOUT:
+                raise TimeoutError(
+                    "Bulk action %s did not finish in %ss"
+                    % (action["sys"]["id"], POLL_TIMEOUT)
+                )
+            time.sleep(POLL_INTERVAL)
+            response = cma_client.request(
+                "get",
+                "%s/actions/%s" % (self.url, action["sys"]["id"]),
+                headers=self.headers,
+            )
+            response.raise_for_status()
+            action = response.json()
+        return action
+
+    @staticmethod
+    def _errors_by_id(action):
+        errors = {}
+        details = (action.get("error") or {}).get("details") or {}
+        for error in details.get("errors") or []:
+            entity_id = ((error.get("entity") or {}).get("sys") or {}).get("id")
+            if entity_id:
+                error_sys = (error.get("error") or {}).get("sys") or {}
+                errors[entity_id] = error_sys.get("id") or error.get("error")
+        return errors
+
+    def _publish_one_by_one(self, resources):
+        outcomes = {}
+        for resource in resources:
+            with self._lock:
+                self.counters["single_publishes"] += 1
+            try:
+                resource.publish()
+                cf_index.record(self.environment, self._kind(resource), resource)
+                outcomes[_key(resource)] = ("published", None)
+            except Exception as e:
+                logging.error(
+                    "%s %s could not be published, error: %s"
+                    % (resource.sys.get("type"), resource.id, e)
+                )
+                outcomes[_key(resource)] = ("failed", e)
+        return outcomes
+
+    def _mark_published(self, resource):
+        # a publish makes the current version the published one and
+        # increments the version, like resource.publish() does locally
+        version = resource.sys.get("version")
+        if version is None:
+            return
+        resource.sys["published_version"] = version
+        resource.sys["version"] = version + 1
+        cf_index.record(self.environment, self._kind(resource), resource)
+
+    @staticmethod
+    def _kind(resource):
+        return "asset" if resource.sys.get("type") == "Asset" else "entry"
+
+    def failures(self):
+        """Return [(type, id, error)] of everything that couldn't be published"""
+
+        with self._lock:
+            return [
+                (kind, resource_id, error)
+                for (kind, resource_id), (outcome, error) in self.results.items()
+                if outcome == "failed"
+            ]
+
+    def log_summary(self):
+        with self._lock:
+            published = sum(
+                1 for outcome, _ in self.results.values() if outcome == "published"
+            )
+            total = len(self.results)
+            counters = dict(self.counters)
+        logging.info(
+            "Published %s of %s entries and assets (%s bulk actions, %s single publishes)"
+            % (published, total, counters["bulk_actions"], counters["single_publishes"])
+        )
+        for kind, resource_id, error in self.failures():
+            logging.error("Not published: %s %s (%s)" % (kind, resource_id, error))
@@ -0,0 +1,173 @@
+"""
+
+Adaptive rate limiting for the HTTP clients of the sync scripts.
+
+A limiter guards one remote host. Requests wait for a token from a token
+bucket and for a free concurrency slot. While the host answers quickly the
+concurrency limit grows by one slot per healthy round of requests. When it
+is overloaded (5xx, 429 or timeouts) the limit and the request rate are
+halved, and every request to the host pauses for an exponential backoff
+with jitter before it is retried.
+
+"""
+import logging
+import random
+import threading
+import time
+
+
+class TokenBucket:
+    """Hands out `rate` tokens per second, up to `burst` at once"""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a token is available, 0 if one is available now"""
+
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+
+class AdaptiveLimiter:
+    """
+    Token bucket and additive increase / multiplicative decrease concurrency
+    limit for one host, shared by all threads talking to that host
+
+    Use acquire() before and release() after every request. The limiter is
+    not thread safe without them, all state is changed under its condition.
+    """
+
+    def __init__(
+        self,
+        name,
+        rate,
+        max_concurrency,
+        min_concurrency=1,
+        initial_concurrency=None,
+        target_latency=2.0,
+        backoff_base=0.5,
+        backoff_max=30.0,
+    ):
+        self.name = name
+        self.max_rate = float(rate)
+        self.min_rate = max(0.1, self.max_rate / 16)
+        self.max_concurrency = max(1, max_concurrency)
+        self.min_concurrency = max(1, min(min_concurrency, self.max_concurrency))
+        self.limit = initial_concurrency or max(
+            self.min_concurrency, self.max_concurrency // 2
+        )
+        self.target_latency = target_latency
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self._bucket = TokenBucket(rate, max(1, self.max_concurrency))
+        self._condition = threading.Condition()
+        self._in_flight = 0
+        self._healthy = 0
+        self._failures = 0
+        self._paused_until = 0.0
+        self._counters = {"requests": 0, "throttled": 0, "backoffs": 0, "waited": 0.0}
+
+    def acquire(self):
+        """Block until the host may receive another request"""
+
+        started = time.monotonic()
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wait = max(
+                    self._paused_until - now,
+                    self._bucket.wait_time(now),
+                )
+                if wait <= 0 and self._in_flight < self.limit:
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self._bucket.take(now)
+            self._in_flight += 1
+            self._counters["requests"] += 1
+            self._counters["waited"] += now - started
+
+    def release(self, latency, overloaded=False, retry_after=None):
+        """
+        Return the slot of a finished request and adapt the limits
+
+        Returns the number of seconds to wait before retrying when the host
+        was overloaded, 0 otherwise.
+        """
+
+        with self._condition:
+            self._in_flight -= 1
+            delay = 0
+            if overloaded:
+                delay = self._back_off(retry_after)
+            elif latency > self.target_latency:
+                self._healthy = 0
+                self.limit = max(self.min_concurrency, self.limit - 1)
+            else:
+                self._failures = 0
+                self._healthy += 1
+                if self._healthy >= self.limit:
+                    self._healthy = 0
+                    self.limit = min(self.max_concurrency, self.limit + 1)
+                    self._bucket.rate = min(self.max_rate, self._bucket.rate * 2)
+            self._condition.notify_all()
+            return delay
+
+    def _back_off(self, retry_after):
+        now = time.monotonic()
+        self._healthy = 0
+        self._counters["throttled"] += 1
+        if now < self._paused_until:
+            # other requests of the same burst already backed off
+            return self._paused_until - now
+
+        self._failures += 1
+        self._counters["backoffs"] += 1
+        self.limit = max(self.min_concurrency, self.limit // 2)
+        self._bucket.rate = max(self.min_rate, self._bucket.rate / 2)
+        delay = min(self.backoff_max, self.backoff_base * 2 ** (self._failures - 1))
+        # full jitter, so threads waiting for the same host don't retry at once
+        delay = random.uniform(delay / 2, delay)
+        if retry_after:
+            delay = max(delay, min(self.backoff_max, retry_after))
+        self._paused_until = now + delay
+        logging.warning(
+            "%s is overloaded, backing off %.1fs (concurrency %s, %.1f requests/s)"
+            % (self.name, delay, self.limit, self._bucket.rate)
+        )
+        return delay
+
+    def state(self):
+        """Current limits and counters, for monitoring"""
+
+        with self._condition:
+            return {
+                "concurrency": self.limit,
+                "in_flight": self._in_flight,
+                "rate": self._bucket.rate,
+                "paused_for": max(0.0, self._paused_until - time.monotonic()),
+                **self._counters,
+            }
+
+
+def parse_retry_after(value):
+    """Seconds from a Retry-After header, None for a missing or HTTP date value"""
+
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
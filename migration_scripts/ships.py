@@ -16,8 +16,16 @@ The class container entry needs to be deleted.
 
 """
 
+import asset_processing
 import helpers
+import epi_client
+import epi_markets
+import epi_snapshot
 import config
+import cf_index
+import plan
+import publish_queue
+from commit_graph import CommitGraph
 import logging
 from urllib.parse import urlparse
 from os.path import splitext, basename
@@ -37,6 +45,7 @@ def prepare_environment():
     )
 
     logging.info("Using Contentful environment: %s" % config.CTFL_ENV_ID)
+    cf_index.load(contentful_environment)
     logging.info("Get all ships from Contentful")
     contentful_ships = contentful_environment.entries().all(
         query={"content_type": "ship", "fields.code": "WW"}
@@ -45,7 +54,7 @@ def prepare_environment():
     #     ship
     #     for ship in contentful_ships
     #     if helpers.skip_entry_if_not_updated(
-    #         helpers.read_json_data(
+    #         epi_client.get_json(
     #             "%s/%s" % ("https://www.hurtigruten.com/rest/b2b/ships", ship.code)
     #         ),
     #         "en",
@@ -64,45 +73,40 @@ def prepare_environment():
     return contentful_ships, contentful_environment
 
 
-def update_ship(contentful_environment, ship):
+def update_ship(contentful_environment, ship, queue):
 
     logging.info("Migrating data for ship %s, %s, %s" % (ship.name, ship.id, ship.code))
 
-    ship_data = helpers.read_json_data(
-        "%s/%s" % ("https://www.hurtigruten.com/rest/b2b/ships", ship.code)
-    )
+    ship_data = epi_client.get_json(epi_markets.ship_url(ship.code))
+
+    # assets and entries are declared first and written together by
+    # graph.commit(), independent ones at the same time and the ship last
+    graph = CommitGraph("Ship %s" % ship.code)
 
     image_id = "shippic-%s" % ship.code
 
     # add ship image
     full_image_url = "https://www.hurtigruten.com%s" % ship_data["imageUrl"]
-    ship.images = [
-        helpers.add_asset(
-            environment=contentful_environment,
-            asset_uri=full_image_url,
-            id=image_id,
-            title=ship.name,
-        )
-    ]
-
-    try:
-        ship.save()
-    except Exception as e:
-        logging.error("Ship could not be saved: %s" % image_id)
-
-    try:
-        ship.publish()
-        logging.info("Ship %s image updated: %s" % (ship.name, image_id))
-    except Exception as e:
-        logging.error("Ship image could not be published: %s" % image_id)
+    ship_image = graph.add(
+        "asset",
+        helpers.add_asset,
+        optional=True,
+        environment=contentful_environment,
+        asset_uri=full_image_url,
+        id=image_id,
+        title=ship.name,
+    )
 
     # add cabin categories
+    cabin_category_links = {}
     for cabinCategory in ship_data["cabinCategories"]:
         cabinCategoryCode = "%s-%s" % (
             ship.code,
             helpers.extract_first_letters(cabinCategory["title"]),
         )
-        helpers.add_entry(
+        cabin_category_links[cabinCategoryCode] = graph.add(
+            "entry",
+            helpers.add_entry,
             environment=contentful_environment,
             id=cabinCategoryCode,
             content_type_id="cabinCategory",
@@ -120,25 +124,19 @@ def update_ship(contentful_environment, ship):
             ),
         )
 
-    logging.info("Added cabin category")
-
-    # add cabin category containers with media and cabin grades if not added already
+    # add cabin category containers with media and cabin grades
     cabin_category_container_links = []
     is_links_updated = False
     for cabinCategory in ship_data["cabinCategories"]:
-        cabin_container_id = "cabcatcont-%s-%s" % (
-            ship.code,
-            helpers.extract_first_letters(cabinCategory["title"]),
-        )
-        cabin_category_container_link = {}
-
         cabCatId = "%s-%s" % (
             ship.code,
             helpers.extract_first_letters(cabinCategory["title"]),
         )
 
         is_links_updated = True
-        cabin_category_container_link = helpers.add_entry(
+        cabin_category_container_link = graph.add(
+            "entry",
+            helpers.add_entry,
             environment=contentful_environment,
             market=None,
             id="cabcatcont-%s-%s"
@@ -147,9 +145,12 @@ def update_ship(contentful_environment, ship):
             fields=helpers.field_localizer(
                 config.DEFAULT_LOCALE,
                 {
-                    "category": helpers.entry_link(cabCatId),
+                    "category": cabin_category_links[cabCatId],
                     "media": [
-                        helpers.add_asset(
+                        graph.add(
+                            "asset",
+                            helpers.add_asset,
+                            optional=True,
                             environment=contentful_environment,
                             asset_uri=media_item["highResolutionUri"],
                             id="shCabCatPic-%s-%s-%d"
@@ -163,7 +164,9 @@ def update_ship(contentful_environment, ship):
                         for i, media_item in enumerate(cabinCategory["media"])
                     ],
                     "cabinGrades": [
-                        helpers.add_entry(
+                        graph.add(
+                            "entry",
+                            helpers.add_entry,
                             environment=contentful_environment,
                             market=None,
                             id="cg-%s-%s-%s"
@@ -206,17 +209,28 @@ def update_ship(contentful_environment, ship):
                                         ]
                                         if x is not None
                                     ],
-                                    "bed": helpers.add_entry_with_code_if_not_exist(
-                                        contentful_environment, "bed", cabinGrade["bed"]
+                                    "bed": graph.add(
+                                        "entry",
+                                        helpers.add_entry_with_code_if_not_exist,
+                                        contentful_environment,
+                                        "bed",
+                                        cabinGrade["bed"],
+                                        key=cabinGrade["bed"],
                                     ),
-                                    "window": helpers.add_entry_with_code_if_not_exist(
+                                    "window": graph.add(
+                                        "entry",
+                                        helpers.add_entry_with_code_if_not_exist,
                                         contentful_environment,
                                         "window",
                                         cabinGrade["window"],
+                                        key=cabinGrade["window"],
                                     ),
                                     "isSpecial": cabinGrade["isSpecial"],
                                     "media": [
-                                        helpers.add_asset(
+                                        graph.add(
+                                            "asset",
+                                            helpers.add_asset,
+                                            optional=True,
                                             environment=contentful_environment,
                                             asset_uri=image_url,
                                             id="shCabGr-%s-%s-%i"
@@ -254,27 +268,7 @@ def update_ship(contentful_environment, ship):
 
         cabin_category_container_links.append(cabin_category_container_link)
 
-    if is_links_updated:
-        ship.cabinCategories = cabin_category_container_links
-
-        try:
-            ship.save()
-        except Exception as e:
-            logging.error(
-                "Could not save ship cabin categories with name: %s, error: %s"
-                % (ship.name, e)
-            )
-
-        try:
-            ship.publish()
-            logging.info("Ship %s cabin categories updated" % ship.name)
-        except Exception as e:
-            logging.error(
-                "Could not publish ship cabin categories with name: %s, error: %s"
-                % (ship.name, e)
-            )
-
-    # add deck plans if not added already
+    # add deck plans
     deck_plan_links = []
     is_deck_plans_updated = False
     for deck in ship_data["decks"]:
@@ -282,7 +276,9 @@ def update_ship(contentful_environment, ship):
         deck_plan_id = "dplan-%s-%d" % (ship.code, deck_number)
 
         is_deck_plans_updated = True
-        deck_plan_link = helpers.add_entry(
+        deck_plan_link = graph.add(
+            "entry",
+            helpers.add_entry,
             environment=contentful_environment,
             market=None,
             id=deck_plan_id,
@@ -291,7 +287,10 @@ def update_ship(contentful_environment, ship):
                 config.DEFAULT_LOCALE,
                 {
                     "deck": deck_number,
-                    "plan": helpers.add_asset(
+                    "plan": graph.add(
+                        "asset",
+                        helpers.add_asset,
+                        optional=True,
                         environment=contentful_environment,
                         asset_uri=deck["deck"]["highResolutionUri"],
                         id="deckPic-%s-%d" % (ship.code, deck_number),
@@ -307,28 +306,42 @@ def update_ship(contentful_environment, ship):
 
         deck_plan_links.append(deck_plan_link)
 
-    if is_deck_plans_updated:
-        ship.deckPlans = deck_plan_links
-        try:
-            ship.save()
-        except Exception as e:
-            logging.error(
-                "Could not save ship deck plans with name: %s, error: %s"
-                % (ship.name, e)
-            )
-        try:
-            ship.publish()
-            logging.info("Ship %s deck plans updated" % ship.name)
-        except Exception as e:
-            logging.error(
-                "Could not publish ship deck plans with name: %s, error: %s"
-                % (ship.name, e)
+    def save_ship(images, cabin_categories, deck_plans):
+        # the ship is saved once, after everything it links is written
+        def apply_fields(entry):
+            entry.images = images
+            if is_links_updated:
+                entry.cabinCategories = cabin_categories
+            if is_deck_plans_updated:
+                entry.deckPlans = deck_plans
+
+        if plan.active():
+            plan.keep_entry(ship)
+            return helpers.plan_entry(
+                contentful_environment, ship.id, "ship", None, True, apply_fields
             )
+        apply_fields(ship)
+        ship.save()
+        helpers.invalidate_ship_codes()
+        queue.add(ship)
+        return helpers.entry_link(ship.id)
+
+    graph.add(
+        "entry",
+        save_ship,
+        key=ship.id,
+        images=[ship_image],
+        cabin_categories=cabin_category_container_links,
+        deck_plans=deck_plan_links,
+    )
+    graph.commit()
+    logging.info("Ship %s updated" % ship.name)
 
     if is_deck_plans_updated and is_links_updated:
         helpers.update_entry_database(ship.id, "en")
 
 
+@plan.plannable("Ships")
 def run_sync(**kwargs):
     ship_ids = kwargs.get("content_ids")
     include = kwargs.get("include")
@@ -340,20 +353,37 @@ def run_sync(**kwargs):
             logging.info("Running ship sync, skipping IDs: %s" % ship_ids)
     else:
         logging.info("Running ships sync")
-    ships, contentful_environment = prepare_environment()
-    for ship in ships:
-        if ship_ids is not None:
-            # run only included voyages
-            if include and ship.id not in ship_ids:
-                continue
-            # skip excluded voyages
-            if not include and ship.id in ship_ids:
-                continue
-        try:
-            update_ship(contentful_environment, ship)
-        except Exception as e:
-            logging.error("Ship migration error with ID: %s, error: %s" % (ship.id, e))
-            helpers.remove_entry_id_from_memory(ship.id, "en")
+    epi_client.reset_stats()
+    helpers.reset_write_stats()
+    epi_snapshot.use(kwargs.get("snapshot"))
+    with plan.timed("prepare"):
+        ships, contentful_environment = prepare_environment()
+    asset_processing.start(contentful_environment)
+    try:
+        ship_publish_queue = publish_queue.PublishQueue(
+            contentful_environment, config.CTFL_SPACE_ID, config.CTFL_MGMT_API_KEY
+        )
+        for ship in ships:
+            if ship_ids is not None:
+                # run only included voyages
+                if include and ship.id not in ship_ids:
+                    continue
+                # skip excluded voyages
+                if not include and ship.id in ship_ids:
+                    continue
+            try:
+                with plan.timed("Ships write"):
+                    update_ship(contentful_environment, ship, ship_publish_queue)
+            except Exception as e:
+                logging.error("Ship migration error with ID: %s, error: %s" % (ship.id, e))
+                helpers.remove_entry_id_from_memory(ship.id, "en")
+
+        ship_publish_queue.flush()
+        ship_publish_queue.log_summary()
+    finally:
+        asset_processing.finish(contentful_environment)
+    epi_client.log_stats()
+    helpers.log_write_stats()
 
 
 parser = ArgumentParser(
@@ -369,10 +399,31 @@ parser.add_argument(
     type=helpers.str2bool,
     help="Specify if you want to include or exclude ship IDs",
 )
+parser.add_argument(
+    "-snapshot",
+    "--snapshot",
+    type=str,
+    help="Read EPI content from a snapshot created by epi_snapshot.py",
+)
+parser.add_argument(
+    "-plan",
+    "--plan",
+    nargs="?",
+    const=True,
+    help="Only plan the sync: log the writes it would make and save them to the given JSON file",
+)
 args = parser.parse_args()
 
 
 if __name__ == "__main__":
     ids = vars(args)["content_ids"]
     include = vars(args)["include"]
-    run_sync(**{"content_ids": ids, "include": include})
+    snapshot = vars(args)["snapshot"]
+    run_sync(
+        **{
+            "content_ids": ids,
+            "include": include,
+            "snapshot": snapshot,
+            "plan": vars(args)["plan"],
+        }
+    )
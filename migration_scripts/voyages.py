@@ -9,17 +9,27 @@ deleted and re-imported.
 
 """
 import csv
+import asset_processing
 import config
+import cf_index
 import helpers
+from commit_graph import CommitGraph
+from destinations import DestinationResolver
+import epi_client
+import epi_markets
+import epi_snapshot
+import pipeline
+import plan
 import logging
 import json
 from argparse import ArgumentParser
 from typing import List
 import linecache
 import sys
+import threading
 
 logging.basicConfig(
-    format="%(asctime)s %(levelname)-8s %(message)s",
+    format="%(asctime)s %(levelname)-8s [%(threadName)s] %(message)s",
     level=logging.INFO,
     datefmt="%Y-%m-%d %H:%M:%S",
 )
@@ -33,18 +43,7 @@ def PrintException():
     line = linecache.getline(filename, lineno, f.f_globals)
     print('EXCEPTION IN ({}, LINE {} "{}"): {}'.format(filename, lineno, line.strip(), exc_obj))
 
-CMS_API_URLS = {
-    "en": "https://global.hurtigruten.com/rest/b2b/voyages",
-    "en-US": "https://www.hurtigruten.com/rest/b2b/voyages",
-    "en-AU": "https://www.hurtigruten.com.au/rest/b2b/voyages",
-    "en-GB": "https://www.hurtigruten.co.uk/rest/b2b/voyages",
-    "de-DE": "https://www.hurtigruten.de/rest/b2b/voyages",
-    "gsw-CH": "https://www.hurtigruten.ch/rest/b2b/voyages",
-    "sv-SE": "https://www.hurtigrutenresan.se/rest/b2b/voyages",
-    "nb-NO": "https://www.hurtigruten.no/rest/b2b/voyages",
-    "da-DK": "https://www.hurtigruten.dk/rest/b2b/voyages",
-    "fr-FR": "https://www.hurtigruten.fr/rest/b2b/voyages",
-}
+CMS_API_URLS = epi_markets.market_urls("/rest/b2b/voyages")
 
 
 def get_api_urls(market):
@@ -71,7 +70,24 @@ def remove_nones_from_list(list: List[str]) -> List[str]:
     return [item for item in list if item]
 
 
-def prepare_environment(market):
+def get_epi_voyage_ids(api_urls):
+    """Ids of the expedition voyages listed by given markets, in list order"""
+
+    voyage_ids = {}
+    for url in api_urls.values():
+        for voyage in epi_client.iter_json_items(url, ["id", "brandingType"]):
+            if voyage.get("brandingType") == "expedition":
+                voyage_ids.setdefault(str(voyage["id"]), None)
+    return list(voyage_ids)
+
+
+def prepare_environment(market, epi_voyage_ids=False):
+    if epi_voyage_ids and config.CTFL_ENV_ID == "master" and not plan.active():
+        # EPI lists can hold synthetic voyages, e.g. the ones of the stand-in
+        raise RuntimeError(
+            "Voyages listed by EPI are only synced into master in plan mode"
+        )
+
     logging.info("Setup Contentful environment")
     contentful_environment = helpers.create_contentful_environment(
         config.CTFL_SPACE_ID, config.CTFL_ENV_ID, config.CTFL_MGMT_API_KEY
@@ -79,6 +95,7 @@ def prepare_environment(market):
 
     api_urls = get_api_urls(market)
     logging.info("Using Contentful environment: %s" % config.CTFL_ENV_ID)
+    cf_index.load(contentful_environment)
     logging.info(
         "Get all voyages for locales: %s"
         % (", ".join([key for key, value in api_urls.items()]))
@@ -86,8 +103,11 @@ def prepare_environment(market):
 
     logging.info('getting cf ids')
     
-    cf_ids_raw = contentful_environment.content_types().find('voyage').entries().all({"limit": 1000, "select": "sys.id"})
-    voyage_ids = [e.id for e in cf_ids_raw if e.id.isnumeric()]
+    if epi_voyage_ids:
+        voyage_ids = get_epi_voyage_ids(api_urls)
+    else:
+        cf_ids_raw = contentful_environment.content_types().find('voyage').entries().all({"limit": 1000, "select": "sys.id"})
+        voyage_ids = [e.id for e in cf_ids_raw if e.id.isnumeric()]
 
     # voyage_ids = []
     # epi_voyage_ids = []
@@ -96,12 +116,12 @@ def prepare_environment(market):
     #     # instead of looping the entire entries twice over.
     #     voyage_ids += [
     #         voyage["id"]
-    #         for voyage in helpers.read_json_data(value)
+    #         for voyage in epi_client.get_json(value)
     #         # commmenting this line means all entries in EPI will be migrated
     #         # if helpers.skip_entry_if_not_updated(voyage, key, voyage["id"])
     #         if voyage["brandingType"] == "expedition"
     #     ]
-    #     # epi_voyage_ids += [voyage["id"] for voyage in helpers.read_json_data(value)]
+    #     # epi_voyage_ids += [voyage["id"] for voyage in epi_client.get_json(value)]
 
     # # Create distinct list
     # voyage_ids = set(voyage_ids)
@@ -115,7 +135,9 @@ def prepare_environment(market):
     # logging.info("-----------------------------------------------------")
     # logging.info("")
 
-    return voyage_ids, contentful_environment
+    destination_resolver = DestinationResolver.load(contentful_environment)
+
+    return voyage_ids, contentful_environment, destination_resolver
 
 
 def getInternalName(heading, bookingCodes):
@@ -129,21 +151,68 @@ def map_epi_locale_to_cf_locale(locale):
 
     return locale
 
-def update_voyage(contentful_environment, voyage_id, market):
-    logging.info("Voyage migration started with ID: %s" % voyage_id)
 
-    voyage_detail_by_locale = {}
-    update_api_urls = get_api_urls(None)
-    # print(update_api_urls)
+def fetch_voyage_detail_by_locale(voyage_id, api_urls):
+    """
+    Load all fields for the particular voyage by calling GET voyages/{id}
+    on every market at the same time
 
-    # {"uk": "uk json content for voyage with id: voyage_id", "au": "au json content for au voyage with id: voyage_id"}
+    Returns {"uk": "uk json content for voyage with id: voyage_id", ...}.
+    Markets that fail are logged and left out, update_voyage fails the
+    voyage when the default locale is one of them.
+    """
 
-    for locale, url in update_api_urls.items():
-        # load all fields for the particular voyage by calling GET voyages/{id}
-        contentful_locale = map_epi_locale_to_cf_locale(locale)
-        voyage_detail_by_locale[contentful_locale] = helpers.read_json_data(
-            "%s/%s" % (url, voyage_id)
+    voyage_urls_by_locale = {
+        map_epi_locale_to_cf_locale(locale): "%s/%s" % (url, voyage_id)
+        for locale, url in api_urls.items()
+    }
+    return epi_client.get_json_many(
+        voyage_urls_by_locale, max_workers=config.EPI_MARKET_CONCURRENCY
+    )
+
+
+def fetch_voyage(voyage_id):
+    """
+    Read everything the voyage sync needs from EPI: the voyage details of all
+    markets and the excursions and programs of the voyage
+    """
+
+    epi_voyage = {
+        "id": voyage_id,
+        "detail_by_locale": fetch_voyage_detail_by_locale(voyage_id, get_api_urls(None)),
+        "excursions": None,
+        "programs": None,
+    }
+    if epi_voyage["detail_by_locale"]:
+        epi_voyage["excursions"] = epi_client.get_json(
+            epi_markets.voyage_excursions_url(voyage_id)
         )
+        epi_voyage["programs"] = epi_client.get_json(
+            epi_markets.voyage_programs_url(voyage_id)
+        )
+    return epi_voyage
+
+
+def update_voyage(
+    contentful_environment, voyage_id, market, destination_resolver, epi_voyage=None
+):
+    logging.info("Voyage migration started with ID: %s" % voyage_id)
+
+    update_api_urls = get_api_urls(None)
+    if epi_voyage is None:
+        epi_voyage = fetch_voyage(voyage_id)
+    voyage_detail_by_locale = epi_voyage["detail_by_locale"]
+    if not voyage_detail_by_locale:
+        logging.error("Could not read voyage ID %s from any market" % voyage_id)
+        return
+    if config.DEFAULT_LOCALE not in voyage_detail_by_locale:
+        # other markets' texts would end up in the default locale fields
+        raise RuntimeError(
+            "Could not read voyage ID %s from the %s market"
+            % (voyage_id, config.DEFAULT_LOCALE)
+        )
+    # the map asset ids of the default locale end with the last market locale
+    locale = list(update_api_urls)[-1]
 
     if (voyage_detail_by_locale.get(config.DEFAULT_LOCALE)):
         default_voyage_detail = voyage_detail_by_locale.get(config.DEFAULT_LOCALE)
@@ -160,10 +229,17 @@ def update_voyage(contentful_environment, voyage_id, market):
         )
         return
 
+    # assets and entries are declared first and written together by
+    # graph.commit(), independent ones at the same time
+    graph = CommitGraph("Voyage %s" % voyage_id)
+
     map_wrappers = {}
     map_assets = {}
     
-    asset_ = helpers.add_asset(
+    asset_ = graph.add(
+                        "asset",
+                        helpers.add_asset,
+                        optional=True,
                         environment=contentful_environment,
                         asset_uri=default_voyage_detail["largeMap"]["highResolutionUri"],
                         id=default_voyage_detail["largeMap"]["id"].replace(":", "-") + '-' + locale.replace('-', '').lower(),
@@ -184,7 +260,9 @@ def update_voyage(contentful_environment, voyage_id, market):
                 if (locale != 'en' and map_assets.get("en") is not None and asset_uri == (default_voyage_detail["largeMap"] or {}).get("highResolutionUri")):
                     asset = map_assets["en"]
                 else:
-                    asset = helpers.add_asset(
+                    asset = graph.add(
+                        "asset",
+                        helpers.add_asset,
                         environment=contentful_environment,
                         asset_uri=voyage["largeMap"]["highResolutionUri"],
                         id=voyage["largeMap"]["id"].replace(":", "-") + '-' + locale.replace('-', '').lower(),
@@ -193,10 +271,12 @@ def update_voyage(contentful_environment, voyage_id, market):
                     )
                     map_assets[locale] = asset
                 
-                if asset is None:
-                    continue
                 logging.info('adding map iwrapper')
-                wrapper = helpers.add_entry(
+                # written only if its map asset is, the voyage without it
+                wrapper = graph.add(
+                    "entry",
+                    helpers.add_entry,
+                    optional=True,
                     environment=contentful_environment,
                     id=(default_voyage_detail["largeMap"] or voyage["largeMap"])["id"].replace(":", "-") + '-' + locale.replace('-', '').lower(),
                     content_type_id="imageWrapper",
@@ -216,7 +296,9 @@ def update_voyage(contentful_environment, voyage_id, market):
     image_gallery_id = ""
     image_wrapper_links = []
     for i, media_item in enumerate(default_voyage_detail["mediaContent"]):
-        media_link = helpers.add_or_reuse_asset(
+        media_link = graph.add(
+            "asset",
+            helpers.add_or_reuse_asset,
             environment=contentful_environment,
             asset_uri=media_item["highResolutionUri"],
             id=media_item["id"],
@@ -247,7 +329,10 @@ def update_voyage(contentful_environment, voyage_id, market):
             )
         )
 
-        image_wrapper_link = helpers.add_entry(
+        image_wrapper_link = graph.add(
+            "entry",
+            helpers.add_entry,
+            optional=True,
             environment=contentful_environment,
             id=media_item["id"],
             content_type_id="imageWrapper",
@@ -261,7 +346,10 @@ def update_voyage(contentful_environment, voyage_id, market):
     if (helpers.is_entry_exists(contentful_environment, image_gallery_id)):
         image_gallery_link = helpers.entry_link(image_gallery_id)
     else:
-        image_gallery_link = helpers.add_entry(
+        image_gallery_link = graph.add(
+            "entry",
+            helpers.add_entry,
+            optional=True,
             environment=contentful_environment,
             id=image_gallery_id,
             content_type_id="imageGallery",
@@ -303,7 +391,10 @@ def update_voyage(contentful_environment, voyage_id, market):
         itinerary_day_images = []
         it_day_media_content = day["mediaContent"]
         for media_item in it_day_media_content:
-            it_day_image_wrapper = helpers.add_entry(
+            it_day_image_wrapper = graph.add(
+                "entry",
+                helpers.add_entry,
+                optional=True,
                 environment=contentful_environment,
                 id=media_item["id"],
                 content_type_id="imageWrapper",
@@ -320,7 +411,9 @@ def update_voyage(contentful_environment, voyage_id, market):
                         config.DEFAULT_LOCALE,
                         {
                             "internalName": media_item["alternateText"],
-                            "image": helpers.add_or_reuse_asset(
+                            "image": graph.add(
+                                "asset",
+                                helpers.add_or_reuse_asset,
                                 environment=contentful_environment,
                                 asset_uri=media_item["highResolutionUri"],
                                 id=media_item["id"],
@@ -375,7 +468,9 @@ def update_voyage(contentful_environment, voyage_id, market):
         ))
 
         itinerary.append(
-            helpers.add_entry(
+            graph.add(
+            "entry",
+            helpers.add_entry,
             environment=contentful_environment,
             id="itday%s-%d" % (voyage_id, i),
             content_type_id="itinerary",
@@ -384,19 +479,16 @@ def update_voyage(contentful_environment, voyage_id, market):
             )
         )    
 
-    destination_cfid = helpers.destination_epi_id_to_cf_id(
-        contentful_environment, default_voyage_detail["destinationId"]
+    destination_cfid = destination_resolver.epi_id_to_cf_id(
+        default_voyage_detail["destinationId"]
     )
     logging.info("Found dcfid %s" % destination_cfid)
     destination_links = (
         [helpers.entry_link(destination_cfid)] if destination_cfid is not None else []
     )
     
-    excursions_url = "https://www.hurtigruten.com/rest/excursion/voyages/" + str(voyage_id) + "/excursions"
-    programs_url = "https://www.hurtigruten.com/rest/program/voyages/" + str(voyage_id) + "/excursions"
-    
-    excursions = helpers.read_json_data(excursions_url)
-    programs = helpers.read_json_data(programs_url)
+    excursions = epi_voyage["excursions"]
+    programs = epi_voyage["programs"]
     
     excursion_links =[helpers.entry_link(excursion) for excursion in excursions if excursion is not None and helpers.is_entry_exists(contentful_environment, excursion)]
     program_links = [helpers.entry_link(program) for program in programs if program is not None and helpers.is_entry_exists(contentful_environment, program)]
@@ -497,26 +589,33 @@ def update_voyage(contentful_environment, voyage_id, market):
             merged_fields["bookable"] = {}
         merged_fields["bookable"] = {**merged_fields["bookable"], **{ locale: voyage_detail["isBookable"] }}
     
-    helpers.add_entry(
+    graph.add(
+        "entry",
+        helpers.add_entry,
         environment=contentful_environment,
         id=str(voyage_id),
         content_type_id="voyage",
         market=market or None,
         fields=merged_fields,
     )
+    graph.commit()
 
     for locale, url in update_api_urls.items():
-        helpers.update_entry_database(voyage_id, locale)
+        # markets that couldn't be read weren't synced
+        if map_epi_locale_to_cf_locale(locale) in voyage_detail_by_locale:
+            helpers.update_entry_database(voyage_id, locale)
 
     logging.info("Voyage migration finished with ID: %s" % voyage_id)
 
 
 
 
+@plan.plannable("Voyages")
 def run_sync(**kwargs):
     parameter_voyage_ids = kwargs.get("content_ids")
     include = kwargs.get("include")
     market = kwargs.get("market")
+    workers = max(1, kwargs.get("workers") or config.VOYAGE_WORKERS)
 
     if parameter_voyage_ids is not None:
         if include:
@@ -533,37 +632,80 @@ def run_sync(**kwargs):
             )
     else:
         logging.info("Running voyages sync")
+    epi_client.reset_stats()
+    helpers.reset_write_stats()
+    epi_snapshot.use(kwargs.get("snapshot"))
 
-    voyage_ids, contentful_environment = prepare_environment(None)
-    
-    logging.info("")
-    logging.info("Number of voyages to update: %s" % len(voyage_ids))
-    logging.info("-----------------------------------------------------")
+    with plan.timed("prepare"):
+        voyage_ids, contentful_environment, destination_resolver = prepare_environment(
+            None, kwargs.get("epi_voyage_ids")
+        )
+    asset_processing.start(contentful_environment)
+    try:
+        logging.info("")
+        logging.info("Number of voyages to update: %s" % len(voyage_ids))
+        logging.info("-----------------------------------------------------")
 
-    total_voyages = len(voyage_ids)
-    
-    for idx, voyage_id in enumerate(voyage_ids):
         if parameter_voyage_ids is not None:
-            # run only included voyages
-            if include and voyage_id not in parameter_voyage_ids:
-                continue
-            # skip excluded voyages
-            if not include and voyage_id in parameter_voyage_ids:
-                continue
-        try:
-            logging.info('yay')
-            update_voyage(contentful_environment, voyage_id, market)
-        except Exception as e:
+            # run only included voyages, skip excluded voyages
+            voyage_ids = [
+                voyage_id
+                for voyage_id in voyage_ids
+                if (voyage_id in parameter_voyage_ids) == bool(include)
+            ]
+        total_voyages = len(voyage_ids)
+
+        def write_voyage(epi_voyage):
+            update_voyage(
+                contentful_environment,
+                epi_voyage["id"],
+                market,
+                destination_resolver,
+                epi_voyage,
+            )
+
+        def on_error(voyage_id, stage, e):
             PrintException()
             logging.info(f"Error is {e}")
             logging.error(
                 "Voyage migration error with ID: %s, error: %s" % (voyage_id, e)
             )
-            logging.info("Entry %s/%s" % (idx, len(voyage_ids)))
-           
-        logging.info("-----------------------------------------------------")
-        logging.info(f"Completed {idx+1}/{total_voyages} Voyages.")
-        logging.info("-----------------------------------------------------")
+
+        progress_lock = threading.Lock()
+        completed = {"total": 0}
+
+        def on_done(idx, voyage_id, result):
+            worker = threading.current_thread().name
+            with progress_lock:
+                completed["total"] += 1
+                completed[worker] = completed.get(worker, 0) + 1
+                done, done_by_worker = completed["total"], completed[worker]
+            logging.info("-----------------------------------------------------")
+            logging.info(
+                f"Completed {done}/{total_voyages} Voyages ({voyage_id}, {done_by_worker} by {worker})."
+            )
+            logging.info("-----------------------------------------------------")
+
+        # voyages are read from EPI while the previous ones are written to
+        # Contentful, `workers` voyages at a time
+        logging.info("Syncing voyages with %s workers" % workers)
+        stats = pipeline.run(
+            voyage_ids,
+            [
+                pipeline.Stage("fetch", fetch_voyage, workers=workers),
+                pipeline.Stage("write", write_voyage, workers=workers),
+            ],
+            queue_size=max(config.PIPELINE_QUEUE_SIZE, workers),
+            on_error=on_error,
+            on_done=on_done,
+            name="Voyages",
+        )
+        pipeline.log_stats("Voyages", stats)
+        plan.add_stage_stats("Voyages", stats)
+    finally:
+        asset_processing.finish(contentful_environment)
+    epi_client.log_stats()
+    helpers.log_write_stats()
 
 
 parser = ArgumentParser(
@@ -581,9 +723,45 @@ parser.add_argument(
     default=True,
     help="Specify if you want to include or exclude voyage IDs",
 )
+parser.add_argument(
+    "-snapshot",
+    "--snapshot",
+    type=str,
+    help="Read EPI content from a snapshot created by epi_snapshot.py",
+)
+parser.add_argument(
+    "-workers",
+    "--workers",
+    type=int,
+    help="Number of voyages synced at the same time (default SYNC_VOYAGE_WORKERS)",
+)
+parser.add_argument(
+    "-epi-voyage-ids",
+    "--epi_voyage_ids",
+    action="store_true",
+    help="Sync the voyages listed by EPI instead of the ones in Contentful, not into master unless planning",
+)
+parser.add_argument(
+    "-plan",
+    "--plan",
+    nargs="?",
+    const=True,
+    help="Only plan the sync: log the writes it would make and save them to the given JSON file",
+)
 args = parser.parse_args()
 
 if __name__ == "__main__":
     ids = vars(args)["content_ids"]
     include = vars(args)["include"]
-    run_sync(**{"content_ids": ids, "include": include})
\ No newline at end of file
+    snapshot = vars(args)["snapshot"]
+    workers = vars(args)["workers"]
+    run_sync(
+        **{
+            "content_ids": ids,
+            "include": include,
+            "snapshot": snapshot,
+            "workers": workers,
+            "epi_voyage_ids": vars(args)["epi_voyage_ids"],
+            "plan": vars(args)["plan"],
+        }
+    )
\ No newline at end of file
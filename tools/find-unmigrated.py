@@ -1,11 +1,16 @@
-import json
-import contentful_management
 import contentful
 import os
-from urllib.request import urlopen, Request
+import sys
 from dotenv import load_dotenv
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'migration_scripts'))
+import epi_client
+import epi_markets
+import cma_client
+import cf_loader
+
 
 def entry_conditions(entry_, entry_type_):
     if (entry_type_ == 'voyage'):
@@ -38,29 +43,10 @@ if (not entry_type in valid_entry_types):
 
 epi_ids = []
 
-base_urls_by_locale = [
-    "https://global.hurtigruten.com/rest/b2b/",
-    "https://www.hurtigruten.com.au/rest/b2b/",
-    "https://www.hurtigruten.co.uk/rest/b2b/",
-    "https://www.hurtigruten.com/rest/b2b/",
-    "https://www.hurtigruten.de/rest/b2b/",
-    "https://www.hurtigruten.ch/rest/b2b/",
-    "https://www.hurtigrutenresan.se/rest/b2b/",
-    "https://www.hurtigruten.no/rest/b2b/",
-    "https://www.hurtigruten.dk/rest/b2b/",
-    "https://www.hurtigruten.fr/rest/b2b/",
-]
+base_urls_by_locale = list(epi_markets.market_urls("/rest/b2b/").values())
 
 for idx, url in enumerate(base_urls_by_locale):
-    headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'User-Agent': 'Magic ZBrowser'
-    }
-
-    req = Request(url + entry_type + 's', headers=headers)
-
-    res = urlopen(req).read()
-    epi_entries = json.loads(res.decode('utf-8'))
+    epi_entries = epi_client.get_json(url + entry_type + 's')
 
     ids = [str(entry['id'])
            for entry in epi_entries if entry_conditions(entry, entry_type)]
@@ -85,17 +71,18 @@ cf_entry_ids = set(cf_entry_ids)
 unmigrated_ids = epi_ids.difference(cf_entry_ids)
 
 # Check with CMA if any of these are archived
-cma = contentful_management.Client(CONTENTFUL_CMA_KEY)
+cma = cma_client.get_client(CONTENTFUL_CMA_KEY)
 cma_env = cma.environments(CONTENTFUL_SPACE_ID).find(CONTENTFUL_ENVIRONMENT)
 cma_entry_type = cma_env.content_types().find(entry_type)
-archived_ids = []
-for unmigrated_id in unmigrated_ids:
-    try:
-        entry = cma_entry_type.entries().find(
-            unmigrated_id, {"sys.archivedAt[exists]": True})
-        archived_ids.append(unmigrated_id)
-    except Exception as e:
-        pass
+archived_loader = cf_loader.Loader(lambda ids: {
+    entry.id: entry for entry in cma_entry_type.entries().all(query={
+        'sys.id[in]': ','.join(ids),
+        'sys.archivedAt[exists]': True,
+        'limit': len(ids)
+    })
+})
+archived_entries = archived_loader.load_many(list(unmigrated_ids))
+archived_ids = [entry_id for entry_id, entry in archived_entries.items() if entry is not None]
 unmigrated_ids = unmigrated_ids.difference(archived_ids)
 unmigrated_ids = sorted(list(unmigrated_ids))
 
@@ -105,3 +92,4 @@ print(unmigrated_ids)
 print('---- %s archived %ss -------' % (len(archived_ids), entry_type))
 print(archived_ids)
 print('----------------------------------')
+epi_client.log_stats()
@@ -1,7 +1,7 @@
 from util import entry_link, map_usp_heading_id_to_icon, map_usp_heading_id_to_type
 
 
-def create_usp_collection_entry(cm_env, usp_collection, booking_codes: list[str]):
+def create_usp_collection_entry(cm_env, usp_collection, booking_codes: list[str], publish_queue):
     if (usp_collection == {}):
         print('[WARNING]: Empty USP collection')
         return
@@ -30,7 +30,7 @@ def create_usp_collection_entry(cm_env, usp_collection, booking_codes: list[str]
 
     try:
         entry = cm_env.entries().create(None, entry_attributes)
-        entry.publish()
+        publish_queue.add(entry)
         return {"entry_link": entry_link(entry.id), "locales": locales}
     except Exception as e:
         print(f'Unable to create/publish usp collection: {e}')
@@ -1,13 +1,12 @@
-import json
-from urllib.request import Request, urlopen
+import os
+import sys
 
 from util import html_to_rt
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', '..', 'migration_scripts'))
+import epi_client
 
-headers = {
-    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-    'User-Agent': 'Magic ZBrowser'
-}
 
 urls = {
     "en": "https://global.hurtigruten.com/rest/b2b/voyages/",
@@ -28,9 +27,7 @@ def get_voyage_field(voyage_id, field_name):
     field = {}
     for locale, url in urls.items():
         try:
-            req = Request(url + voyage_id, headers=headers)
-            res = urlopen(req).read()
-            epi_voyage = json.loads(res.decode('utf-8'))
+            epi_voyage = epi_client.get_json(url + voyage_id)
 
             is_fallback = epi_voyage["isFallbackContent"]
             if (is_fallback):
@@ -1,12 +1,18 @@
 import os
+import sys
 from dotenv import load_dotenv
-from contentful_management import Client as CMClient
 from contentful import Client as CDClient
 import time
 from typing import Union
 
 from get_voyage_included import get_voyage_not_included
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', '..', 'migration_scripts'))
+import publish_queue
+import cma_client
+import cf_loader
+
 load_dotenv()
 
 CONTENTFUL_SPACE_ID = os.getenv('CONTENTFUL_SPACE_ID')
@@ -16,9 +22,11 @@ CONTENTFUL_ENVIRONMENT = os.getenv('CONTENTFUL_ENVIRONMENT')
 
 print(CONTENTFUL_ENVIRONMENT)
 
-cm_client = CMClient(access_token=CONTENTFUL_CMA_KEY, default_locale="en")
+cm_client = cma_client.get_client(CONTENTFUL_CMA_KEY, default_locale="en")
 cm_env = cm_client.environments(
     CONTENTFUL_SPACE_ID).find(CONTENTFUL_ENVIRONMENT)
+voyage_publish_queue = publish_queue.PublishQueue(
+    cm_env, CONTENTFUL_SPACE_ID, CONTENTFUL_CMA_KEY)
 cd_client = CDClient(
     space_id=CONTENTFUL_SPACE_ID,
     access_token=CONTENTFUL_CDN_KEY,
@@ -48,6 +56,9 @@ voyage_ids = [v.id for v in voyage_ids]
 
 voyage_ids = list(filter(lambda x: x.isnumeric(), voyage_ids))
 num_voyages = len(voyage_ids)
+# voyages are read by id in batches of 100
+voyage_loader = cf_loader.entries(cm_env)
+voyage_loader.prime(voyage_ids)
 
 voyage_ids_with_errors = []
 for i, id in enumerate(voyage_ids):
@@ -61,7 +72,9 @@ for i, id in enumerate(voyage_ids):
         print(f'No voyage with id {id} found in EPI. Skipping...')
         continue
 
-    voyage = cm_env.entries().find(id)
+    voyage = voyage_loader.load(id)
+    if voyage is None:
+        voyage = cm_env.entries().find(id)
     was_published = voyage.is_published
 
     changed = False
@@ -75,8 +88,11 @@ for i, id in enumerate(voyage_ids):
 
     voyage.save()
     if (was_published):
-        try:
-            voyage.publish()
-        except:
-            voyage_ids_with_errors.append(id)
+        voyage_publish_queue.add(voyage)
+
+voyage_publish_queue.flush()
+voyage_publish_queue.log_summary()
+voyage_ids_with_errors.extend(
+    voyage_id for _, voyage_id, _ in voyage_publish_queue.failures())
+print('Voyage ids with error: ', voyage_ids_with_errors)
     
\ No newline at end of file
@@ -1,6 +1,6 @@
 import os
+import sys
 from dotenv import load_dotenv
-from contentful_management import Client as CMClient, errors as cm_errors
 from contentful import Client as CDClient
 from bs4 import BeautifulSoup
 import time
@@ -11,6 +11,12 @@ from headings import Heading
 from create_usp_collection_entry import create_usp_collection_entry
 from soup_to_usp_collection import soup_to_usp_collections
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', '..', 'migration_scripts'))
+import publish_queue
+import cma_client
+import cf_loader
+
 load_dotenv()
 
 CONTENTFUL_SPACE_ID = os.getenv('CONTENTFUL_SPACE_ID')
@@ -25,9 +31,14 @@ parser.add_argument('--ids', dest='ids',
 args = parser.parse_args()
 voyage_ids = [str(id) for id in args.ids.split(',')]
 
-cm_client = CMClient(access_token=CONTENTFUL_CMA_KEY, default_locale="en")
+cm_client = cma_client.get_client(CONTENTFUL_CMA_KEY, default_locale="en")
 cm_env = cm_client.environments(
     CONTENTFUL_SPACE_ID).find(CONTENTFUL_ENVIRONMENT)
+usp_publish_queue = publish_queue.PublishQueue(
+    cm_env, CONTENTFUL_SPACE_ID, CONTENTFUL_CMA_KEY)
+# voyages and USP collections are read by id in batches of 100
+entry_loader = cf_loader.entries(cm_env)
+entry_loader.prime(voyage_ids)
 cd_client = CDClient(
     space_id=CONTENTFUL_SPACE_ID,
     access_token=CONTENTFUL_CDN_KEY,
@@ -97,16 +108,20 @@ def try_save(e):
 
 
 def try_publish(e):
-    try:
-        e.publish()
-    except:
-        print('Failed to publish, retrying in 5...', e)
-        # time.sleep(5)
-        # try_publish(e)
+    # published with the USP collections of the voyage in one bulk action
+    usp_publish_queue.add(e)
+
+
+def find_entry(cm_env, id: str):
+    entry = entry_loader.load(id)
+    if entry is None:
+        # not found, raise the error of a single find
+        entry = cm_env.entries().find(id)
+    return entry
 
 
 def relink_included_new(cm_env, voyage_id: str, usp_collection_entry_links, update_locales: list[str]):
-    voyage = cm_env.entries().find(voyage_id)
+    voyage = find_entry(cm_env, voyage_id)
     was_published = voyage.is_published
 
     # print(usp_collection_entry_links, update_locales)
@@ -137,17 +152,19 @@ def relink_included_new(cm_env, voyage_id: str, usp_collection_entry_links, upda
     if (was_published):
         try_publish(voyage)
 
+    outcomes = usp_publish_queue.flush()
+    failed = [key for key, (outcome, _) in outcomes.items() if outcome == 'failed']
+    if failed:
+        print('Failed to publish', failed)
+
     print('Deleting %s old USP collections' % len(old_usp_collection_ids))
     # Delete old entries
+    old_usp_collections = entry_loader.load_many(old_usp_collection_ids)
     for usp_collection_id in old_usp_collection_ids:
-        entry = None
-        try:
-            entry = cm_env.entries().find(usp_collection_id)
-        except cm_errors.NotFoundError:
-            pass
-
+        entry = old_usp_collections[usp_collection_id]
         if (entry is None):
             continue
+        entry_loader.set(usp_collection_id, None)
         try:
             entry.unpublish()
         except:
@@ -157,9 +174,11 @@ def relink_included_new(cm_env, voyage_id: str, usp_collection_entry_links, upda
         except Exception as e:
             print('Failed to delete USP Collection', e)
 
+    return not failed
+
 
 def get_booking_codes(cm_env, id: str) -> list[str]:
-    voyage = cm_env.entries().find(id)
+    voyage = find_entry(cm_env, id)
     booking_codes: list[str] = []
     for locale in valid_locales:
         codes = voyage._fields.get(locale, {}).get('booking_code', [])
@@ -218,7 +237,7 @@ for i, id in enumerate(voyage_ids):
     # We get back entry links, and their applicable locales
     print('Creating USP Collection entries...')
     usp_collections_entries = [create_usp_collection_entry(
-        cm_env, c, booking_codes) for c in (grouped_usp_collections_list + unknown_usp_collections)]
+        cm_env, c, booking_codes, usp_publish_queue) for c in (grouped_usp_collections_list + unknown_usp_collections)]
 
     if None in usp_collections_entries:
         voyage_ids_with_errors.append(id)
@@ -230,6 +249,8 @@ for i, id in enumerate(voyage_ids):
 
     print('Relinking voyage...')
     # Relink the USP Collections to the voyage
-    relink_included_new(cm_env, id, usp_collections_entries, update_locales)
+    if not relink_included_new(cm_env, id, usp_collections_entries, update_locales):
+        voyage_ids_with_errors.append(id)
 
+usp_publish_queue.log_summary()
 print('Voyage ids with error: ', voyage_ids_with_errors)
@@ -1,11 +1,16 @@
-import json
-import contentful_management
 import contentful
 import os
-from urllib.request import urlopen, Request
+import sys
 from dotenv import load_dotenv
 import argparse
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'migration_scripts'))
+import epi_client
+import epi_markets
+import cma_client
+import cf_loader
+
 
 def entry_link(entry_id):
     if entry_id is None:
@@ -32,28 +37,21 @@ CONTENTFUL_ENVIRONMENT = os.getenv('CONTENTFUL_ENVIRONMENT')
 
 
 def get_excursion_ids_for_voyage(voyage_id: float):
-    headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'User-Agent': 'Magic ZBrowser'
-    }
-
-    base_urls = ['https://www.hurtigruten.com.au/rest/',
-                 'https://www.hurtigruten.de/rest/']
+    base_urls = [epi_markets.market_url('en-AU', '/rest/'),
+                 epi_markets.market_url('de-DE', '/rest/')]
 
     eids = []
     for base in base_urls:
         url = base + entry_type + '/voyages/' + voyage_id + '/' + entry_type + 's'
 
-        req = Request(url, headers=headers)
-        res = urlopen(req).read()
-        eids.extend([str(id) for id in json.loads(res.decode('utf-8'))])
+        eids.extend([str(id) for id in epi_client.get_json(url)])
 
     return list(set(eids))
 
 
 print('Relinking activities in env: %s' % CONTENTFUL_ENVIRONMENT)
 
-cma = contentful_management.Client(CONTENTFUL_CMA_KEY)
+cma = cma_client.get_client(CONTENTFUL_CMA_KEY)
 cma_env = cma.environments(CONTENTFUL_SPACE_ID).find(CONTENTFUL_ENVIRONMENT)
 voyageType = cma_env.content_types().find('voyage')
 
@@ -84,11 +82,19 @@ for i, vid in enumerate(cf_voyage_ids):
     print('Retrieved voyage info %s/%s' %
           (i, len(cf_voyage_ids)), end='\r')
 
+epi_client.log_stats()
+
 # This is marvelously stupid, should turn dict around and map voyage_id -> [activity_ids]
 print('Updating activities')
+# voyages are read by id in batches of 100
+voyage_loader = cf_loader.entries(cma_env)
+for voyage_ids in voyages_for_activity.values():
+    voyage_loader.prime(voyage_ids)
 for activity_id, voyage_ids in voyages_for_activity.items():
     for voyage_id in voyage_ids:
-        voyage = voyageType.entries().find(voyage_id)
+        voyage = voyage_loader.load(voyage_id)
+        if voyage is None:
+            voyage = voyageType.entries().find(voyage_id)
         was_published = voyage.is_published
         activities = voyage.fields('en').get(entry_type + 's')
         if activities is not None and activity_id in [str(activity.id) for activity in activities]:
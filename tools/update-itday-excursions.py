@@ -1,11 +1,15 @@
-import json
-import contentful_management
 import contentful
 import os
-from urllib.request import urlopen, Request
+import sys
 from dotenv import load_dotenv
 import time
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), '..', 'migration_scripts'))
+import epi_client
+import epi_markets
+import cma_client
+
 env_vars = load_dotenv()
 
 CONTENTFUL_SPACE_ID = os.getenv('CONTENTFUL_SPACE_ID')
@@ -43,24 +47,12 @@ def show_unmigrated_excursions(epi_voyages):
 
 epi_ids = []
 
-base_urls_by_locale = ["https://global.hurtigruten.com/rest/b2b/voyages",
-                       "https://www.hurtigruten.com.au/rest/b2b/voyages",
-                       "https://www.hurtigruten.co.uk/rest/b2b/voyages",
-                       "https://www.hurtigruten.com/rest/b2b/voyages",
-                       "https://www.hurtigruten.de/rest/b2b/voyages"
-                       ]
+base_urls_by_locale = [epi_markets.market_url(locale, "/rest/b2b/voyages")
+                       for locale in ["en", "en-AU", "en-GB", "en-US", "de-DE"]]
 
 epi_voyages = []
 for url in base_urls_by_locale:
-    headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'User-Agent': 'Magic ZBrowser'
-    }
-
-    req = Request(url, headers = headers)
-
-    res = urlopen(req).read()
-    epi_entries = json.loads(res.decode('utf-8'))
+    epi_entries = epi_client.get_json(url)
 
     epi_voyages.extend(epi_entries)
     
@@ -96,7 +88,7 @@ while(len(cf_entries) < total):
     
 print('Retrieved %s voyages from CF' % len(cf_entries))
 
-cma = contentful_management.Client(CONTENTFUL_CMA_KEY)
+cma = cma_client.get_client(CONTENTFUL_CMA_KEY)
 cma_env = cma.environments(CONTENTFUL_SPACE_ID).find(CONTENTFUL_ENVIRONMENT)
 itineraryType = cma_env.content_types().find('itinerary')
 
@@ -108,15 +100,7 @@ def entry_link(entry_id):
 def get_epi_voyage(id):
     # print(f'Attempting to find individual voyage {id}')
     for url in base_urls_by_locale:
-        headers = {
-            'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-            'User-Agent': 'Magic ZBrowser'
-        }
-
-        req = Request(url + '/' + id, headers = headers)
-
-        res = urlopen(req).read()
-        epi_voyage = json.loads(res.decode('utf-8'))
+        epi_voyage = epi_client.get_json(url + '/' + id)
 
         if (epi_voyage):
             return epi_voyage